@@ -43,6 +43,8 @@ from collections import OrderedDict
 from shutil import *
 from subprocess import Popen, PIPE, CalledProcessError
 from math import log, ceil
+from time import time
+import pickle
 
 # Third party
 sys.path.insert(0, "./")  # For stand alone executable, where dependencies are packaged with BuddySuite
@@ -67,6 +69,22 @@ from Bio.Alphabet import IUPAC
 GAP_CHARS = ["-", ".", " "]
 VERSION = br.Version("AlignBuddy", 1, 1, br.contributors)
 
+MSA_TOOL_URLS = {'mafft': 'http://mafft.cbrc.jp/alignment/software/',
+                 'prank': 'http://wasabiapp.org/software/prank/prank_installation/',
+                 'pagan': 'http://wasabiapp.org/software/pagan/pagan_installation/',
+                 'muscle': 'http://www.drive5.com/muscle/downloads.htm',
+                 'clustalw': 'http://www.clustal.org/clustal2/#Download',
+                 'clustalw2': 'http://www.clustal.org/clustal2/#Download',
+                 'clustalomega': 'http://www.clustal.org/omega/#Download',
+                 'clustalo': 'http://www.clustal.org/omega/#Download'}
+
+# How to set the number of threads for the alignment tools that are multi-threaded
+MSA_THREAD_PARAMS = {'mafft': '--thread %s', 'clustalomega': '--threads=%s', 'clustalo': '--threads=%s',
+                     'pagan': '--threads %s'}
+
+# Number of reference rows used to build the consensus that the built-in aligner adds new sequences against
+PROFILE_CONSENSUS_SAMPLE = 1000
+
 
 # #################################################### ALIGNBUDDY #################################################### #
 class AlignBuddy(object):  # Open a file or read a handle and parse, or convert raw into a Seq object
@@ -135,21 +153,11 @@ class AlignBuddy(object):  # Open a file or read a handle and parse, or convert
             alignments = _input
 
         elif str(type(_input)) == "<class '_io.TextIOWrapper'>" or isinstance(_input, StringIO):
-            if self._in_format == "phylipss":
-                alignments = list(br.phylip_sequential_read(_input.read(), relaxed=False))
-            elif self._in_format == "phylipsr":
-                alignments = list(br.phylip_sequential_read(_input.read()))
-            else:
-                alignments = list(AlignIO.parse(_input, self._in_format))
+            alignments = _parse_alignments(_input, self._in_format)
 
         elif os.path.isfile(_input):
             with open(_input, "r") as _input:
-                if self._in_format == "phylipss":
-                    alignments = list(br.phylip_sequential_read(_input.read(), relaxed=False))
-                elif self._in_format == "phylipsr":
-                    alignments = list(br.phylip_sequential_read(_input.read()))
-                else:
-                    alignments = list(AlignIO.parse(_input, self._in_format))
+                alignments = _parse_alignments(_input, self._in_format)
 
         else:  # May be unreachable
             alignments = None
@@ -261,6 +269,19 @@ class AlignBuddy(object):  # Open a file or read a handle and parse, or convert
 
 
 # ################################################# HELPER FUNCTIONS ################################################# #
+def _parse_alignments(handle, in_format):
+    """
+    :param handle: Open text handle
+    :param in_format: Any format supported by Bio.AlignIO, or phylipss/phylipsr
+    :return: List of MultipleSeqAlignment objects
+    """
+    if in_format == "phylipss":
+        return list(br.phylip_sequential_read(handle.read(), relaxed=False))
+    elif in_format == "phylipsr":
+        return list(br.phylip_sequential_read(handle.read()))
+    return list(AlignIO.parse(handle, in_format))
+
+
 def guess_alphabet(alignments):
     """
     :param alignments: Duck typed --> AlignBuddy object, list of alignment objects, or a single alignment object
@@ -465,7 +486,192 @@ class FeatureReMapper:
             return feature
 
 
+def _profile_consensus(alignment):
+    # Majority residue for every column of (a sample of) the alignment. Columns that are all gaps get an ambiguous
+    # character so the consensus never contains gaps itself.
+    records = list(alignment)
+    if len(records) > PROFILE_CONSENSUS_SAMPLE:
+        step = len(records) / PROFILE_CONSENSUS_SAMPLE
+        records = [records[int(indx * step)] for indx in range(PROFILE_CONSENSUS_SAMPLE)]
+    ambig_char = "X" if guess_alphabet(alignment) == IUPAC.protein else "N"
+    consensus = ""
+    for column in zip(*[str(rec.seq).upper() for rec in records]):
+        counts = {}
+        for residue in column:
+            if residue not in "-.":
+                counts.setdefault(residue, 0)
+                counts[residue] += 1
+        consensus += max(sorted(counts), key=lambda res: counts[res]) if counts else ambig_char
+    return consensus
+
+
+def _profile_align(consensus, sequence):
+    # Global alignment against the consensus, projected onto the existing columns. Residues that would need a new
+    # column are returned separately, as {column they go in front of: residues}.
+    from Bio import pairwise2
+    aligned_cons, aligned_seq = pairwise2.align.globalms(consensus, sequence.upper(), 2, -1, -4, -1,
+                                                         penalize_end_gaps=False, one_alignment_only=True)[0][:2]
+    aligned = []
+    insertions = OrderedDict()
+    seq_indx = 0
+    for cons_res, res in zip(aligned_cons, aligned_seq):
+        if res != "-":
+            res = sequence[seq_indx]
+            seq_indx += 1
+        if cons_res != "-":
+            aligned.append(res)
+        elif res != "-":
+            insertions[len(aligned)] = insertions.get(len(aligned), "") + res
+    return "".join(aligned), insertions
+
+
+def _insert_columns(row, insertions, widths):
+    # Add new columns to a row (widths is {column they go in front of: number of new columns}), with any inserted
+    # residues at the start of their block of columns
+    parts = []
+    prev_column = 0
+    for column in sorted(widths):
+        parts += [row[prev_column:column], insertions.get(column, "").ljust(widths[column], "-")]
+        prev_column = column
+    parts.append(row[prev_column:])
+    return "".join(parts)
+
+
+def _drop_insertions(old_rec, new_rec, insertions):
+    # Features are remapped onto the full row (with all of the original residues) first, and then the inserted columns
+    # are taken back out. Features that only cover dropped residues are lost.
+    widths = dict([(column, len(residues)) for column, residues in insertions.items()])
+    full_rec = SeqRecord(Seq(_insert_columns(str(new_rec.seq), insertions, widths)), id=new_rec.id)
+    br.remap_gapped_features([old_rec], [full_rec])
+    position_map = FeatureReMapper()
+    for column in range(len(new_rec.seq) + 1):
+        for _ in range(widths.get(column, 0)):
+            position_map.extend(False)
+        if column < len(new_rec.seq):
+            position_map.extend(True)
+    position_map.remap_features([full_rec], [new_rec])
+    return new_rec
+
+
+def _restore_case(aligned, original):
+    # Some tools (e.g., MAFFT) change the case of the residues they return
+    original = re.sub("[-.]", "", original)
+    if len(original) != len(re.sub("[-.]", "", aligned)):
+        return aligned
+    residues = iter(original)
+    return "".join([res if res in "-." else next(residues) for res in aligned])
+
+
 # ################################################ MAIN API FUNCTIONS ################################################ #
+def add_to_alignment(alignbuddy, seqbuddy, tool="mafft", params=None, keep_length=True, quiet=False):
+    """
+    Add new sequences to an existing alignment without realigning it from scratch
+    :param alignbuddy: AlignBuddy object holding a single alignment
+    :param seqbuddy: SeqBuddy object with the (unaligned) sequences to add
+    :param tool: 'mafft' (--add, or --addfragments if included in params), 'clustalo', or 'builtin'. The built-in
+    profile aligner is also used if the requested tool can not be found in $PATH.
+    :param params: Additional parameters to be passed to the alignment tool
+    :param keep_length: Keep the existing columns fixed (MAFFT --keeplength). With 'builtin', residues that would need
+    a new column are dropped (with a warning) if True, or gap columns are added to the reference if False.
+    :param quiet: Suppress stderr output
+    :return: The modified AlignBuddy object
+    """
+    if len(alignbuddy.alignments) != 1:
+        raise ValueError("add_to_alignment() requires an AlignBuddy object with exactly one alignment.")
+
+    params = "" if params is None else params
+    tool = tool.lower()
+    if tool not in ["mafft", "clustalo", "clustalomega", "builtin"]:
+        raise AttributeError("{0} is not a supported tool for adding sequences to an alignment.".format(tool))
+
+    if tool != "builtin" and which(tool) is None:
+        _stderr("#### Could not find {0} in $PATH, using the built-in profile aligner instead. ####\n"
+                "Please go to {1} to install {0}.\n".format(tool, MSA_TOOL_URLS[tool]), quiet)
+        tool = "builtin"
+
+    ref_recs = list(alignbuddy.alignments[0])
+    new_recs = seqbuddy.records
+    if not new_recs:
+        return alignbuddy
+
+    original_seqs = [str(rec.seq) for rec in ref_recs]
+    all_recs = ref_recs + new_recs
+    hash_map = Sb.hash_ids(Sb.SeqBuddy(all_recs, alpha=alignbuddy.alpha), 8).hash_map
+    hashes = list(hash_map.keys())
+
+    dropped = {}
+    try:
+        if tool == "builtin":
+            consensus = _profile_consensus(alignbuddy.alignments[0])
+            profiles = [(rec.id, _profile_align(consensus, re.sub("[-.]", "", str(rec.seq)))) for rec in new_recs]
+            if keep_length:
+                aligned_seqs = dict([(rec_id, row) for rec_id, (row, insertions) in profiles])
+                dropped = dict([(rec_id, insertions) for rec_id, (row, insertions) in profiles if insertions])
+                aligned_seqs.update([(rec.id, str(rec.seq)) for rec in ref_recs])
+            else:
+                widths = {}
+                for rec_id, (row, insertions) in profiles:
+                    for column, residues in insertions.items():
+                        widths[column] = max(widths.get(column, 0), len(residues))
+                aligned_seqs = dict([(rec_id, _insert_columns(row, insertions, widths))
+                                     for rec_id, (row, insertions) in profiles])
+                aligned_seqs.update([(rec.id, _insert_columns(str(rec.seq), {}, widths)) for rec in ref_recs])
+        else:
+            tmp_dir = MyFuncs.TempDir()
+            with open("%s/reference.fa" % tmp_dir.path, "w") as ofile:
+                ofile.write("".join([">%s\n%s\n" % (rec.id, rec.seq) for rec in ref_recs]))
+            with open("%s/new.fa" % tmp_dir.path, "w") as ofile:
+                ofile.write("".join([">%s\n%s\n" % (rec.id, re.sub("[-.]", "", str(rec.seq))) for rec in new_recs]))
+
+            if tool == "mafft":
+                add_flag = "--addfragments" if "--addfragments" in params else "--add"
+                params = re.sub("--addfragments", "", params)
+                if keep_length and "--keeplength" not in params:
+                    params += " --keeplength"
+                command = "mafft {0} {1}/new.fa {2} {1}/reference.fa".format(add_flag, tmp_dir.path, params)
+            else:
+                command = "{0} --profile1 {1}/reference.fa -i {1}/new.fa -o {1}/result --outfmt=fasta --force " \
+                          "{2}".format(tool, tmp_dir.path, params)
+
+            output = Popen(command, shell=True, universal_newlines=True, stdout=PIPE,
+                           stderr=PIPE if quiet else None).communicate()[0]
+            if tool != "mafft":
+                with open("%s/result" % tmp_dir.path, "r") as ifile:
+                    output = ifile.read()
+            aligned_seqs = dict([(rec.id, str(rec.seq)) for rec in AlignIO.read(StringIO(output), "fasta")])
+            if len(aligned_seqs) != len(hashes):
+                raise RuntimeError("{0} did not return all of the sequences.\n{1}".format(tool, command))
+    finally:
+        br.rename_records_from_map(all_recs, hash_map)
+
+    records = []
+    for hash_id, old_rec in zip(hashes, all_recs):
+        new_seq = _restore_case(aligned_seqs[hash_id], str(old_rec.seq))
+        records.append(SeqRecord(Seq(new_seq, alphabet=alignbuddy.alpha), id=old_rec.id, name=old_rec.name,
+                                 description=old_rec.description, annotations=old_rec.annotations))
+
+    # Reference rows that kept their gap pattern keep their features as-is, everything else is remapped
+    old_recs = []
+    remap_recs = []
+    for indx, rec in enumerate(records):
+        if indx < len(ref_recs) and str(rec.seq) == original_seqs[indx]:
+            rec.features = ref_recs[indx].features
+        elif hashes[indx] in dropped:
+            num_features = len(all_recs[indx].features)
+            _drop_insertions(all_recs[indx], rec, dropped[hashes[indx]])
+            _stderr("Warning: {0} residues in {1} do not fit the existing columns and were dropped, along with {2} "
+                    "feature(s). Use keep_length=False to add columns for them.\n"
+                    .format(sum([len(residues) for residues in dropped[hashes[indx]].values()]), rec.id,
+                            num_features - len(rec.features)), quiet)
+        else:
+            old_recs.append(all_recs[indx])
+            remap_recs.append(rec)
+    br.remap_gapped_features(old_recs, remap_recs)
+
+    alignbuddy.alignments[0] = MultipleSeqAlignment(records, alphabet=alignbuddy.alpha)
+    return alignbuddy
+
+
 def alignment_lengths(alignbuddy):
     """
     Returns a list of alignment lengths
@@ -795,20 +1001,11 @@ def generate_msa(seqbuddy, tool, params=None, keep_temp=None, quiet=False):
             sys.exit()
         keep_temp = os.path.abspath(keep_temp)
 
-    tool_urls = {'mafft': 'http://mafft.cbrc.jp/alignment/software/',
-                 'prank': 'http://wasabiapp.org/software/prank/prank_installation/',
-                 'pagan': 'http://wasabiapp.org/software/pagan/pagan_installation/',
-                 'muscle': 'http://www.drive5.com/muscle/downloads.htm',
-                 'clustalw': 'http://www.clustal.org/clustal2/#Download',
-                 'clustalw2': 'http://www.clustal.org/clustal2/#Download',
-                 'clustalomega': 'http://www.clustal.org/omega/#Download',
-                 'clustalo': 'http://www.clustal.org/omega/#Download'}
-
-    if tool not in tool_urls:
+    if tool not in MSA_TOOL_URLS:
         raise AttributeError("{0} is not a supported alignment tool.".format(tool))
     if which(tool) is None:
         _stderr('#### Could not find {0} in $PATH. ####\n'.format(tool), quiet)
-        _stderr('Please go to {0} to install {1}.\n'.format(tool_urls[tool], tool))
+        _stderr('Please go to {0} to install {1}.\n'.format(MSA_TOOL_URLS[tool], tool))
         sys.exit()
     else:
         valve = MyFuncs.SafetyValve(global_reps=10)
@@ -934,28 +1131,29 @@ def generate_msa(seqbuddy, tool, params=None, keep_temp=None, quiet=False):
                     output = contents
                 alignbuddy = AlignBuddy(output, out_format=seqbuddy.out_format)
 
+                # IDs are unique hashes at this point, so records can be matched up with a dict
+                sb_recs_by_id = OrderedDict([(sb_rec.id, sb_rec) for sb_rec in seqbuddy.records])
                 seqbuddy_recs = []
+                aligned_recs = []
                 for alb_rec in alignbuddy.records():
-                    for indx, sb_rec in enumerate(seqbuddy.records):
-                        if sb_rec.id == alb_rec.id:
-                            seqbuddy_recs.append(sb_rec)
-                            del seqbuddy.records[indx]
-                            break
+                    sb_rec = sb_recs_by_id.pop(alb_rec.id, None)
+                    if sb_rec is not None:
+                        seqbuddy_recs.append(sb_rec)
+                        aligned_recs.append(alb_rec)
 
                 seqbuddy.records = seqbuddy_recs
-                br.remap_gapped_features(seqbuddy_recs, alignbuddy.records())
+                br.remap_gapped_features(seqbuddy_recs, aligned_recs)
 
-                for _hash, sb_rec in seqbuddy.hash_map.items():
-                    rename(alignbuddy, _hash, sb_rec)
+                br.rename_records_from_map(alignbuddy.records(), seqbuddy.hash_map)
 
                 if keep_temp:
                     # Loop through each saved file and rename any hashes that have been carried over
+                    hash_regex = br.map_regex(seqbuddy.hash_map)
                     for root, dirs, files in os.walk(tmp_dir.path):
                         for next_file in files:
                             with open("%s/%s" % (root, next_file), "r") as ifile:
                                 contents = ifile.read()
-                            for _hash, sb_rec in seqbuddy.hash_map.items():
-                                contents = re.sub(_hash, sb_rec, contents)
+                            contents = br.rename_from_map(contents, seqbuddy.hash_map, hash_regex)
                             with open("%s/%s" % (root, next_file), "w") as ofile:
                                 ofile.write(contents)
 
@@ -970,6 +1168,86 @@ def generate_msa(seqbuddy, tool, params=None, keep_temp=None, quiet=False):
         return alignbuddy
 
 
+def generate_msa_groups(groups, tool, params=None, threads=1, max_processes=0, out_dir=None, quiet=False):
+    """
+    Align many groups of sequences (e.g., the output of Sb.make_groups()) with a pool of worker processes, each running
+    one alignment at a time. A group that fails is reported, but does not stop the others.
+    :param groups: List of SeqBuddy objects, or list of sequence files/directories/glob patterns (one group per file)
+    :param tool: The alignment tool to be used (pagan/prank/muscle/clustalw2/clustalomega/mafft)
+    :param params: Additional parameters to be passed to the alignment tool for every group
+    :param threads: Number of threads given to each alignment, for the tools that support it (see MSA_THREAD_PARAMS)
+    :param max_processes: Number of alignments run at the same time (0 uses all available cores)
+    :param out_dir: Also write each alignment to <out_dir>/<group name>.<ext>
+    :param quiet: Suppress stderr output
+    :return: (AlignBuddy object with one alignment per successful group,
+              list of (group name, status, seconds, detail) tuples in the same order as groups)
+    """
+    tool = tool.lower()
+    if tool not in MSA_TOOL_URLS:
+        raise AttributeError("{0} is not a supported alignment tool.".format(tool))
+    if which(tool) is None:
+        _stderr('#### Could not find {0} in $PATH. ####\n'.format(tool), quiet)
+        _stderr('Please go to {0} to install {1}.\n'.format(MSA_TOOL_URLS[tool], tool))
+        sys.exit()
+
+    if groups and isinstance(groups[0], str):  # Files are only read by the worker that aligns them
+        groups = br.batch_files(groups)
+        names = [os.path.splitext(os.path.basename(file_path))[0] for file_path in groups]
+    else:
+        names = [getattr(seqbuddy, "identifier", "group_%s" % indx) for indx, seqbuddy in enumerate(groups)]
+    if not groups:
+        raise ValueError("No sequence groups to align.")
+
+    params = params if params else ""
+    if tool in MSA_THREAD_PARAMS and threads:
+        params = "%s %s" % (MSA_THREAD_PARAMS[tool] % threads, params)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    tmp_dir = MyFuncs.TempDir()
+
+    def align_group(indx):
+        start = time()
+        status, detail = "ok", ""
+        try:
+            seqbuddy = Sb.SeqBuddy(groups[indx]) if isinstance(groups[indx], str) else groups[indx]
+            alignment = generate_msa(seqbuddy, tool, params, quiet=True)
+            if not alignment or not alignment.alignments:
+                raise ValueError("No alignment returned by %s" % tool)
+            with open("%s/%s.pkl" % (tmp_dir.path, indx), "wb") as ofile:
+                pickle.dump((alignment._out_format, alignment.alignments), ofile)
+            if out_dir:
+                detail = os.path.join(out_dir, "%s.%s" % (names[indx], br.format_to_extension.get(
+                    alignment._out_format, alignment._out_format)))
+                alignment.write(detail)
+        except SystemExit as e:  # generate_msa() exits if the tool can't be run
+            status, detail = "failed", "SystemExit: %s" % e.code
+        except Exception as e:
+            status, detail = "failed", "%s: %s" % (e.__class__.__name__, str(e).replace("\n", " ").replace("\t", " "))
+        with open("%s/%s.tsv" % (tmp_dir.path, indx), "w") as ofile:
+            ofile.write("%s\t%s\t%s" % (status, time() - start, detail))
+
+    MyFuncs.run_multicore_function(list(range(len(groups))), align_group, max_processes=max_processes, quiet=quiet,
+                                   out_type=sys.stderr)
+
+    alignments = []
+    out_format = None
+    report = []
+    for indx, name in enumerate(names):
+        if not os.path.isfile("%s/%s.tsv" % (tmp_dir.path, indx)):
+            report.append((name, "failed", 0., "Worker process exited unexpectedly"))
+            continue
+        with open("%s/%s.tsv" % (tmp_dir.path, indx), "r") as ifile:
+            status, seconds, detail = ifile.read().split("\t")
+        report.append((name, status, float(seconds), detail))
+        if status == "ok":
+            with open("%s/%s.pkl" % (tmp_dir.path, indx), "rb") as ifile:
+                out_format, group_alignments = pickle.load(ifile)
+            alignments += group_alignments
+
+    alignbuddy = AlignBuddy(alignments, out_format=out_format) if alignments else None
+    return alignbuddy, report
+
+
 def hash_ids(alignbuddy, hash_length=10):
     """
     Replace all IDs with random hashes
@@ -1313,25 +1591,28 @@ def uppercase(alignbuddy):
 # ################################################# COMMAND LINE UI ################################################## #
 def argparse_init():
     # Catching params to prevent weird collisions with alignment program arguments
-    if '--generate_alignment' in sys.argv:
-        sys.argv[sys.argv.index('--generate_alignment')] = '-ga'
-    if '-ga' in sys.argv:
-        ga_indx = sys.argv.index('-ga')
-        if len(sys.argv) > ga_indx + 1:
-            extra_args = None
-            for indx, param in enumerate(sys.argv[ga_indx + 1:]):
-                if param in ["-f", "--in_format", "-i", "--in_place", "-k", "--keep_temp", "-o", "--out_format",
-                             "-q", "--quiet", "-t", "--test"]:
-                    extra_args = ga_indx + 1 + indx
-                    break
+    # param_pos is where the alignment program parameters sit, relative to the flag
+    for long_flag, flag, param_pos in [('--generate_alignment', '-ga', 2), ('--generate_alignment_groups', '-gag', 2),
+                                       ('--add_to_alignment', '-ata', 3)]:
+        if long_flag in sys.argv:
+            sys.argv[sys.argv.index(long_flag)] = flag
+        if flag in sys.argv:
+            ga_indx = sys.argv.index(flag)
+            if len(sys.argv) > ga_indx + 1:
+                extra_args = None
+                for indx, param in enumerate(sys.argv[ga_indx + 1:]):
+                    if param in ["-f", "--in_format", "-i", "--in_place", "-k", "--keep_temp", "-o", "--out_format",
+                                 "-od", "--out_dir", "-q", "--quiet", "-t", "--test"]:
+                        extra_args = ga_indx + 1 + indx
+                        break
 
-            if extra_args == ga_indx + 1 or extra_args == ga_indx + 2:
-                # No conflicts possible, continue on your way
-                pass
+                if extra_args and extra_args <= ga_indx + param_pos:
+                    # No conflicts possible, continue on your way
+                    pass
 
-            elif len(sys.argv) > ga_indx + 2 or extra_args:
-                # There must be optional arguments being passed into the alignment tool
-                sys.argv[ga_indx + 2] = " %s" % sys.argv[ga_indx + 2].rstrip()
+                elif len(sys.argv) > ga_indx + param_pos:
+                    # There must be optional arguments being passed into the alignment tool
+                    sys.argv[ga_indx + param_pos] = " %s" % sys.argv[ga_indx + param_pos].rstrip()
 
     import argparse
 
@@ -1354,6 +1635,14 @@ def argparse_init():
 
     in_args = parser.parse_args()
 
+    module = sys.modules[__name__]
+    br.start_profiler("AlignBuddy", in_args, [(module, "guess_format", "guess_format"),
+                                              (AlignBuddy, "__init__", "load"),
+                                              (module, "_parse_alignments", "parse"),
+                                              (module, "guess_alphabet", "guess_alphabet"),
+                                              (module, "make_copy", "make_copy"),
+                                              (AlignBuddy, "__str__", "serialize")])
+
     alignbuddy = []
     align_set = ""
 
@@ -1364,9 +1653,23 @@ def argparse_init():
             _stderr("%s\n" % str(e))
             sys.exit()
 
+    if in_args.estimate or os.environ.get("BUDDY_MEMORY_BUDGET"):
+        try:
+            br.preflight(in_args, "alignments", br.alb_flags,
+                         lambda file_path, command: Sb.estimate_resources(file_path, command, in_args.in_format,
+                                                                          "AlignBuddy"))
+        except br.GuessError as e:
+            _stderr("GuessError: %s\n" % e, in_args.quiet)
+            sys.exit()
+        if in_args.estimate:
+            sys.exit()
+
+    if in_args.batch:  # Each file is read independently by command_line_ui()
+        return in_args, alignbuddy
+
     try:
         # Some tools do not start with AlignBuddy objs, so skip this for those rare cases
-        if not in_args.generate_alignment:
+        if not in_args.generate_alignment and not in_args.generate_alignment_groups:
             for align_set in in_args.alignments:
                 if isinstance(align_set, TextIOWrapper) and align_set.buffer.raw.isatty():
                     sys.exit("Warning: No input detected. Process will be aborted.")
@@ -1402,14 +1705,10 @@ def command_line_ui(in_args, alignbuddy, skip_exit=False):
     def _print_aligments(_alignbuddy):
         try:
             _output = str(_alignbuddy)
-        except ValueError as err:
-            _stderr("ValueError: %s\n" % str(err))
-            return False
-        except TypeError as err:
-            _stderr("TypeError: %s\n" % str(err))
-            return False
-        except br.PhylipError as err:
-            _stderr("PhylipError: %s\n" % str(err))
+        except (ValueError, TypeError, br.PhylipError) as err:
+            if getattr(in_args, "batch_job", False):
+                raise
+            _stderr("%s: %s\n" % (err.__class__.__name__, str(err)))
             return False
 
         if in_args.test:
@@ -1452,10 +1751,44 @@ def command_line_ui(in_args, alignbuddy, skip_exit=False):
                     break
             if re_raise:
                 raise _err
+        if getattr(in_args, "batch_job", False):
+            raise _err  # br.run_batch() reports the error against the file being processed
         _stderr("{0}: {1}\n".format(_err.__class__.__name__, str(_err)), in_args.quiet)
         _exit(_tool)
 
     # ############################################## COMMAND LINE LOGIC ############################################## #
+    # Batch mode
+    if in_args.batch:
+        def _build(file_path):
+            if in_args.generate_alignment or in_args.generate_alignment_groups:  # Raw sequences are read later
+                return []
+            return AlignBuddy(file_path, in_args.in_format, in_args.out_format)
+
+        try:
+            results = br.run_batch(in_args, "alignments", command_line_ui, _build, br.alb_flags, in_args.out_dir)
+        except ValueError as e:
+            _raise_error(e, "batch")
+            return
+        br.batch_report(results, in_args.quiet)
+        _exit("batch")
+        return
+
+    # Add sequences to an alignment
+    if in_args.add_to_alignment:
+        args = in_args.add_to_alignment[0]
+        try:
+            seqbuddy = Sb.SeqBuddy(args[0])
+        except br.GuessError as e:
+            _raise_error(e, "add_to_alignment")
+            return
+        tool = args[1] if len(args) > 1 else "mafft"
+        params = re.sub("\[(.*)\]", "\1", args[2]) if len(args) > 2 else None
+        try:
+            _print_aligments(add_to_alignment(alignbuddy, seqbuddy, tool, params, quiet=in_args.quiet))
+        except (AttributeError, ValueError, RuntimeError) as e:
+            _raise_error(e, "add_to_alignment")
+        _exit("add_to_alignment")
+
     # Alignment lengths
     if in_args.alignment_lengths:
         counts = alignment_lengths(alignbuddy)
@@ -1629,6 +1962,43 @@ def command_line_ui(in_args, alignbuddy, skip_exit=False):
             _raise_error(e, "generate_alignment", "is not a supported alignment tool")
         _exit("generate_alignment")
 
+    # Generate alignments for groups of sequences
+    if in_args.generate_alignment_groups:
+        args = in_args.generate_alignment_groups[0]
+        if not args:
+            for tool in ['mafft', 'pagan', 'muscle', 'clustalomega', 'prank', 'clustalw2']:
+                if which(tool):
+                    args = [tool]
+                    break
+        if not args:
+            _raise_error(AttributeError("Unable to identify any supported alignment tools on your system."),
+                         "generate_alignment_groups")
+
+        params = re.sub("\[(.*)\]", "\1", args[1]) if len(args) > 1 else None
+        try:
+            # Share the cores out when there are fewer groups than cores
+            threads = max(1, int(MyFuncs.usable_cpu_count() / len(br.batch_files(in_args.alignments))))
+            generated_msas, report = generate_msa_groups(in_args.alignments, args[0], params, threads,
+                                                         out_dir=in_args.out_dir, quiet=in_args.quiet)
+        except (AttributeError, ValueError) as e:
+            _raise_error(e, "generate_alignment_groups")
+            return
+
+        if in_args.out_dir:
+            for name, status, seconds, detail in report:
+                _stdout("%s\t%s\t%s\t%s\n" % (name, status, round(seconds, 3), detail))
+        else:
+            for name, status, seconds, detail in report:
+                if status != "ok":
+                    _stderr("# %s failed: %s\n" % (name, detail), in_args.quiet)
+            if generated_msas:
+                if in_args.out_format:
+                    generated_msas.set_format(in_args.out_format)
+                _print_aligments(generated_msas)
+        _stderr("# %s groups aligned, %s failed\n" % (len([x for x in report if x[1] == "ok"]),
+                                                       len([x for x in report if x[1] != "ok"])), in_args.quiet)
+        _exit("generate_alignment_groups")
+
     # Hash ids
     if in_args.hash_ids:
         if in_args.hash_ids[0] == 0:
@@ -1830,19 +2200,29 @@ def command_line_ui(in_args, alignbuddy, skip_exit=False):
         _print_aligments(uppercase(alignbuddy))
         _exit("uppercase")
 
-if __name__ == '__main__':
+
+def main():
     initiation = []
     try:
         initiation = argparse_init()  # initiation = [in_agrs, alignbuddy]
-        command_line_ui(*initiation)
+        if br.PROFILER:
+            br.PROFILER.run_tool(command_line_ui, *initiation)
+        else:
+            command_line_ui(*initiation)
     except (KeyboardInterrupt, br.GuessError) as _e:
         print(_e)
     except SystemExit:
         pass
     except Exception as _e:
         function = ""
-        for next_arg in vars(initiation[0]):
+        for next_arg in vars(initiation[0]) if initiation else []:
             if getattr(initiation[0], next_arg) and next_arg in br.alb_flags:
                 function = next_arg
                 break
         br.send_traceback("AlignBuddy", function, _e)
+    finally:
+        br.stop_profiler()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This program is free software in the public domain as stipulated by the Copyright Law
+of the United States of America, chapter 1, subsection 105. You may modify it and/or redistribute it
+without restriction.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+name: BuddyServer.py
+author: Stephen R. Bond
+email: steve.bond@nih.gov
+institute: Computational and Statistical Genomics Branch, Division of Intramural Research,
+           National Human Genome Research Institute, National Institutes of Health
+           Bethesda, MD
+repository: https://github.com/biologyguy/BuddySuite
+© license: None, this work is public domain
+
+Description: Optional warm server for SeqBuddy, AlignBuddy, and PhyloBuddy. The server keeps Biopython, dendropy, and
+             the Buddy modules loaded, and forks a fresh worker for every request, so a crashing request can't take
+             the server down with it. The client only imports the standard library, and hands its argv, environment,
+             and stdin/stdout/stderr file descriptors to the worker, so output streams straight back to the caller.
+             If no server is running, the client runs the command in its own process instead.
+             Usage: python3 BuddyServer.py serve [--socket <path>] [--workers <num>]
+                    python3 BuddyServer.py stop [--socket <path>]
+                    python3 BuddyServer.py SeqBuddy "/path/to/seq_file" -<cmd>  (or AlignBuddy/PhyloBuddy)
+"""
+
+import sys
+import os
+import json
+import socket
+import tempfile
+from array import array
+from importlib import import_module
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+TOOLS = {"SeqBuddy": "SeqBuddy", "sb": "SeqBuddy", "AlignBuddy": "AlignBuddy", "alb": "AlignBuddy",
+         "PhyloBuddy": "PhyloBuddy", "pb": "PhyloBuddy"}
+
+SOCKET_PATH = os.environ.get("BUDDYSUITE_SOCKET", "%s/buddysuite_%s.sock" %
+                             (tempfile.gettempdir(), os.getuid() if hasattr(os, "getuid") else "user"))
+
+
+# ################################################# HELPER FUNCTIONS ################################################# #
+def _run_local(tool, argv):
+    """
+    Run a Buddy command line call in the current process
+    :param tool: SeqBuddy, AlignBuddy, or PhyloBuddy
+    :param argv: List of command line arguments, not including the program name
+    :return: Exit status
+    """
+    sys.argv = ["%s.py" % tool] + list(argv)
+    try:
+        import_module(tool).main()
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return 0 if e.code is None else e.code
+        sys.stderr.write("%s\n" % e.code)
+        return 1
+    return 0
+
+
+def _recv_request(conn):
+    """
+    Read a newline terminated json request, along with any file descriptors sent with it
+    :param conn: Connected socket
+    :return: (request dict, list of file descriptors), or (None, []) if the connection closed without a request
+    """
+    fds = array("i")
+    data, ancdata, flags, addr = conn.recvmsg(65536, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, _type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and _type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if not data:  # e.g., ping()
+        return None, list(fds)
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    if not data.endswith(b"\n"):
+        raise ValueError("Incomplete request received by BuddySuite server.")
+    return json.loads(data.decode()), list(fds)
+
+
+def _run_request(request, fds):
+    """
+    Executed in a forked worker. Take over the client's stdin/stdout/stderr, working directory, and environment,
+    then run the command.
+    :param request: Request dict from the client
+    :param fds: The client's stdin, stdout, and stderr file descriptors
+    :return: Exit status
+    """
+    import random
+    for stream in [sys.stdout, sys.stderr]:
+        if stream:
+            stream.flush()
+    for target, fd in enumerate(fds[:3]):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", closefd=False)
+    sys.stderr = open(2, "w", closefd=False)
+    random.seed()  # Otherwise every worker inherits the same random state from the server
+    os.environ.clear()
+    os.environ.update(request["env"])
+    os.chdir(request["cwd"])
+    try:
+        status = _run_local(request["tool"], request["argv"])
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return status
+
+
+# ##################################################### SERVER ####################################################### #
+def serve(socket_path=SOCKET_PATH, max_workers=0):
+    """
+    Load the Buddy modules and answer requests on a unix domain socket until a 'stop' request comes in
+    :param socket_path: Location of the socket file
+    :param max_workers: Maximum number of requests run at the same time (0 uses the number of CPUs)
+    :return: None
+    """
+    if ping(socket_path):
+        raise RuntimeError("A BuddySuite server is already listening on %s" % socket_path)
+    if os.path.exists(socket_path):  # Left behind by a server that did not shut down cleanly
+        os.remove(socket_path)
+
+    for tool in sorted(set(TOOLS.values())):  # Warm up. Workers inherit these modules when they are forked
+        import_module(tool)
+    max_workers = max_workers if max_workers > 0 else os.cpu_count() or 1
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)  # Only the current user can connect
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(128)
+    sys.stderr.write("BuddySuite server listening on %s\n" % socket_path)
+
+    workers = set()
+    try:
+        while True:
+            conn = server.accept()[0]
+            try:
+                request, fds = _recv_request(conn)
+            except (ValueError, OSError) as e:
+                sys.stderr.write("%s: %s\n" % (e.__class__.__name__, e))
+                conn.close()
+                continue
+
+            if not request:
+                conn.close()
+                continue
+
+            if request.get("command") == "stop":
+                conn.sendall(json.dumps({"status": 0}).encode())
+                conn.close()
+                break
+
+            if request.get("tool") not in TOOLS.values() or len(fds) != 3:
+                conn.sendall(json.dumps({"status": 1, "error": "Invalid request"}).encode())
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+                continue
+
+            # Clean up finished workers, and wait for one to finish if too many are running
+            while workers:
+                pid = os.waitpid(-1, 0 if len(workers) >= max_workers else os.WNOHANG)[0]
+                if not pid:
+                    break
+                workers.discard(pid)
+
+            pid = os.fork()
+            if not pid:  # Worker
+                server.close()
+                status = 1
+                try:
+                    status = _run_request(request, fds)
+                finally:
+                    try:
+                        conn.sendall(json.dumps({"status": status}).encode())
+                    finally:
+                        os._exit(0)
+
+            sys.stderr.write("Worker %s: %s %s\n" % (pid, request["tool"], " ".join(request["argv"])))
+            sys.stderr.flush()
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            workers.add(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    return
+
+
+# ##################################################### CLIENT ####################################################### #
+def _connect(socket_path):
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    return client
+
+
+def _reply(client):
+    reply = b""
+    while True:
+        chunk = client.recv(4096)
+        if not chunk:
+            break
+        reply += chunk
+    client.close()
+    return json.loads(reply.decode()) if reply else None
+
+
+def ping(socket_path=SOCKET_PATH):
+    """
+    Check whether a server is accepting connections
+    :param socket_path: Location of the socket file
+    :return: bool
+    """
+    client = _connect(socket_path)
+    if client:
+        client.close()
+        return True
+    return False
+
+
+def stop(socket_path=SOCKET_PATH):
+    """
+    Ask a running server to shut down
+    :param socket_path: Location of the socket file
+    :return: True if a server was stopped
+    """
+    client = _connect(socket_path)
+    if not client:
+        return False
+    client.sendall(("%s\n" % json.dumps({"command": "stop"})).encode())
+    return bool(_reply(client))
+
+
+def run(tool, argv, socket_path=SOCKET_PATH):
+    """
+    Send a command line call to the server, or run it in this process if no server is listening
+    :param tool: SeqBuddy, AlignBuddy, or PhyloBuddy (or sb, alb, pb)
+    :param argv: List of command line arguments, not including the program name
+    :param socket_path: Location of the socket file
+    :return: Exit status
+    """
+    if tool not in TOOLS:
+        raise ValueError("Unknown tool '%s'. Choose from %s" % (tool, ", ".join(sorted(TOOLS))))
+    tool = TOOLS[tool]
+    client = _connect(socket_path)
+    if not client:
+        return _run_local(tool, argv)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    request = ("%s\n" % json.dumps({"tool": tool, "argv": list(argv), "cwd": os.getcwd(),
+                                    "env": dict(os.environ)})).encode()
+    sent = client.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", [0, 1, 2]))])
+    client.sendall(request[sent:])
+    reply = _reply(client)
+    if not reply:
+        sys.stderr.write("Error: The BuddySuite server worker exited before finishing the request.\n")
+        return 1
+    return reply["status"]
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in TOOLS:
+        sys.exit(run(sys.argv[1], sys.argv[2:]))
+
+    import argparse
+    parser = argparse.ArgumentParser(prog="BuddyServer.py", description="Warm server for the BuddySuite command line "
+                                                                        "tools. To send a call through the server use "
+                                                                        "'BuddyServer.py SeqBuddy <args>'.")
+    parser.add_argument("command", choices=["serve", "stop", "status"])
+    parser.add_argument("-s", "--socket", action="store", default=SOCKET_PATH, help="Location of the socket file")
+    parser.add_argument("-w", "--workers", action="store", type=int, default=0,
+                        help="Maximum number of requests run at the same time")
+    in_args = parser.parse_args()
+
+    if in_args.command == "serve":
+        try:
+            serve(in_args.socket, in_args.workers)
+        except RuntimeError as e:
+            sys.exit("RuntimeError: %s" % e)
+    elif in_args.command == "stop":
+        if not stop(in_args.socket):
+            sys.exit("No BuddySuite server is listening on %s" % in_args.socket)
+    else:
+        print("running" if ping(in_args.socket) else "stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -48,12 +48,10 @@ import cmd
 from subprocess import Popen, PIPE
 from io import TextIOWrapper, StringIO
 import warnings
-import readline
 import pickle
 
 # Third party
 sys.path.insert(0, "./")  # For stand alone executable, where dependencies are packaged with BuddySuite
-from Bio import Entrez
 from Bio import SeqIO
 from Bio import BiopythonWarning
 warnings.simplefilter('ignore', BiopythonWarning)
@@ -611,6 +609,15 @@ def terminal_colors():
         _counter += 1
 
 
+def _entrez():
+    """
+    Bio.Entrez is only needed by the NCBI client, so it is imported the first time the client uses it
+    :return: The Bio.Entrez module
+    """
+    from Bio import Entrez
+    return Entrez
+
+
 def check_database(_database):
     _output = []
     if type(_database) == list:
@@ -855,8 +862,9 @@ class UniProtRestClient(object):
 
 class NCBIClient(object):
     def __init__(self, _dbbuddy):
-        Entrez.email = CONFIG["email"]
-        Entrez.tool = "buddysuite"
+        entrez = _entrez()
+        entrez.email = CONFIG["email"]
+        entrez.tool = "buddysuite"
         self.dbbuddy = _dbbuddy
         self.temp_dir = TempDir()
         self.http_errors_file = "%s/errors.txt" % self.temp_dir.path
@@ -908,7 +916,7 @@ class NCBIClient(object):
         timer = time()
         for i in range(self.max_attempts):
             try:
-                handle = Entrez.esummary(db="taxonomy", id=_taxa_ids, retmax=10000)
+                handle = _entrez().esummary(db="taxonomy", id=_taxa_ids, retmax=10000)
                 '''
                 Example output: esummary.fcgi?db=taxonomy&id=649
                     <eSummaryResult>
@@ -956,7 +964,7 @@ class NCBIClient(object):
 
         _output = {}
         for result in results:
-            for summary in Entrez.parse(StringIO(result)):
+            for summary in _entrez().parse(StringIO(result)):
                 _output[summary["TaxId"]] = summary["ScientificName"]
         return _output
 
@@ -967,7 +975,7 @@ class NCBIClient(object):
         timer = time()
         for i in range(self.max_attempts):
             try:
-                handle = Entrez.efetch(db="nucleotide", id=accns, rettype="gi", retmax=10000)
+                handle = _entrez().efetch(db="nucleotide", id=accns, rettype="gi", retmax=10000)
                 '''
                 Example output: efetch.fcgi?db=nucleotide&id=XP_010103297.1,XP_010103298.1,XP_010103299.1&rettype=gi
                     703125407
@@ -1015,7 +1023,7 @@ class NCBIClient(object):
         for i in range(self.max_attempts):
             try:
                 # db needs to be set to something, but if using gi nums it doesn't matter if protein or nucleotide.
-                handle = Entrez.esummary(db="nucleotide", id=gi_nums, retmax=10000)
+                handle = _entrez().esummary(db="nucleotide", id=gi_nums, retmax=10000)
                 '''
                 Example output: esummary.fcgi?db=nucleotide&id=728840875
                     <eSummaryResult>
@@ -1075,7 +1083,7 @@ class NCBIClient(object):
         _output = {}
         taxa = []
         for result in results:
-            for summary in Entrez.parse(StringIO(result)):
+            for summary in _entrez().parse(StringIO(result)):
                 _rec = OrderedDict()
                 _rec["gi_num"] = str(summary["Gi"])
                 # status can be 'live', 'dead', 'withdrawn', 'replaced'
@@ -1149,8 +1157,8 @@ class NCBIClient(object):
     def search_ncbi(self, database):  # database in ["nucleotide", "protein"]
         for _term in self.dbbuddy.search_terms:
             try:
-                count = Entrez.read(Entrez.esearch(db=database, term=_term, rettype="count"))["Count"]
-                handle = Entrez.esearch(db=database, term=_term, retmax=count)
+                count = _entrez().read(_entrez().esearch(db=database, term=_term, rettype="count"))["Count"]
+                handle = _entrez().esearch(db=database, term=_term, retmax=count)
                 '''
                 Example output: esearch.fcgi?db=nucleotide&term=perk1&retmax=5
                 <eSearchResult>
@@ -1177,7 +1185,7 @@ class NCBIClient(object):
                     <QueryTranslation>perk1[All Fields]</QueryTranslation>
                 </eSearchResult>
                 '''
-                result = Entrez.read(handle)
+                result = _entrez().read(handle)
                 for _id in result["IdList"]:
                     if _id not in self.dbbuddy.records:
                         self.dbbuddy.records[_id] = Record(_id)
@@ -1206,7 +1214,7 @@ class NCBIClient(object):
         timer = time()
         for i in range(self.max_attempts):
             try:
-                handle = Entrez.efetch(db=database, id=accns, rettype="gb", retmode="text", retmax=10000)
+                handle = _entrez().efetch(db=database, id=accns, rettype="gb", retmode="text", retmax=10000)
                 '''
                 Example output: efetch.fcgi?db=protein&id=920714169&rettype=gb&retmode=text
                 LOCUS       KOM54257                 441 aa            linear   PLN 21-AUG-2015
@@ -1501,6 +1509,7 @@ class LiveSearch(cmd.Cmd):
         :param _dbbuddy: pre-instantiated DbBuddy object
         :param crash_file: MyFuncs.TempFile object instantiated in binary mode
         """
+        import readline
         self.terminal_default = "\033[m\033[40m%s" % WHITE
         cmd.Cmd.__init__(self)
         hash_heading = ""
@@ -1568,6 +1577,7 @@ Further details about each command can be accessed by typing 'help <command>'
     #    open("a file that doesn't exist")
 
     def precmd(self, line):
+        import readline
         readline.write_history_file(self.history_path)
         return line
 
@@ -23,7 +23,7 @@ Description: Collection of useful classes and functions
 
 from multiprocessing import Process, cpu_count
 import sys
-from time import time
+from time import time, perf_counter
 from math import floor, ceil
 import os
 from tempfile import TemporaryDirectory
@@ -36,14 +36,19 @@ from random import choice
 class Timer(object):
     def __init__(self):
         self.current_time = round(time())
+        self.precise_time = perf_counter()
 
     def start(self):
         self.current_time = round(time())
+        self.precise_time = perf_counter()
         return
 
     def end(self):
         return pretty_time(round(time()) - self.current_time)
 
+    def elapsed(self):  # Seconds since start, as a float
+        return perf_counter() - self.precise_time
+
 
 class RunTime(object):
     def __init__(self, prefix="", postfix="", out_type=sys.stdout):
@@ -28,7 +28,7 @@ from __future__ import print_function
 
 # BuddySuite specific
 import buddy_resources as br
-from MyFuncs import TempDir, walklevel
+from MyFuncs import TempDir, walklevel, run_multicore_function, usable_cpu_count
 import AlignBuddy as Alb
 
 # Standard library
@@ -38,11 +38,15 @@ import random
 import string
 import re
 import shutil
-from math import log, ceil
+from math import log, ceil, sqrt
 from io import StringIO, TextIOWrapper
 from subprocess import Popen, CalledProcessError, check_output, PIPE
 from collections import OrderedDict
 from copy import deepcopy
+from time import time
+from hashlib import md5
+import json
+import pickle
 
 # Third party
 # import Bio.Phylo
@@ -50,30 +54,11 @@ from copy import deepcopy
 sys.path.insert(0, "./")  # For stand alone executable, where dependencies are packaged with BuddySuite
 from Bio.Alphabet import IUPAC
 
-try:
-    import ete3
-    from ete3.coretype.tree import TreeError
-except ImportError:
-    confirm = input("PhyloBuddy requires ETE v3+, which was not detected on your system. Try to install [y]/n? ")
-    if confirm.lower() in ["", "y", "yes"]:
-        Popen("pip install --upgrade  https://github.com/jhcepas/ete/archive/3.0.zip", shell=True).wait()
-        Popen("pip install six", shell=True).wait()
-        try:
-            import ete3
-            from ete3.coretype.tree import TreeError
-
-        except ImportError:
-            sys.exit("Failed to install ETE3, please see http://etetoolkit.org/download/ for further details")
-    else:
-        sys.exit("Aborting. Please see http://etetoolkit.org/download/ for installation details\n")
-
 try:
     import dendropy
 except ImportError:
     confirm = input("PhyloBuddy requires dendropy, which was not detected on your system. Try to install [y]/n? ")
     if confirm.lower() in ["", "y", "yes"]:
-        from subprocess import Popen
-
         Popen("pip install dendropy", shell=True).wait()
         try:
             import dendropy
@@ -85,7 +70,6 @@ except ImportError:
 from dendropy.datamodel.treemodel import Tree, Node
 from dendropy.datamodel.treecollectionmodel import TreeList
 from dendropy.datamodel.taxonmodel import TaxonNamespace
-from dendropy.calculate import treecompare
 
 
 # ##################################################### WISH LIST #################################################### #
@@ -115,10 +99,189 @@ VERSION = br.Version("PhyloBuddy", 1, 1, br.contributors)
 OUTPUT_FORMATS = ["newick", "nexus", "nexml"]
 PHYLO_INFERENCE_TOOLS = ["raxml", "phyml", "fasttree"]
 
+# Tree comparisons are spread over multiple processes when at least this many pairs are requested
+DISTANCE_PARALLEL_SIZE = 10000
+
+# Commands that work one tree at a time, so the command line reads their input lazily (see TreeStream)
+LAZY_COMMANDS = ["hash_ids", "num_tips", "prune_taxa", "rename_ids", "root", "unroot"]
+
+# Only the start of a file is needed to guess its format
+GUESS_SIZE = 1048576
+
+# Quoted labels, comments, punctuation, and everything else (unquoted labels and branch lengths)
+NEWICK_TOKENS = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^\s(),:;\[\]']+")
+
 
 # #################################################### PHYLOBUDDY #################################################### #
+class TreeStream(object):
+    """
+    Trees that are only parsed from file as they are iterated over, so huge tree files can be processed in constant
+    memory (see PhyloBuddy(lazy=True)). Per-tree tools queue their changes with add_step(), and these are applied to
+    each tree as it is read.
+    """
+    def __init__(self, tree_file, in_format, tmp_dir=None):
+        self.tree_file = tree_file
+        self.in_format = in_format
+        self.steps = []
+        self._tmp_dir = tmp_dir  # Keeps a copy of piped input alive for as long as it's needed
+
+    def add_step(self, func):
+        self.steps.append(func)
+        return
+
+    def __iter__(self):
+        for _tree in _yield_trees(self.tree_file, self.in_format):
+            _prepare_tree(_tree)
+            for func in self.steps:
+                func(_tree)
+            yield _tree
+
+
+class CompactTree(object):
+    """
+    Array based tree for very large Newick trees (see PhyloBuddy(compact=True)). Nodes are stored in pre-order, so
+    node 0 is the root and every node comes after its parent.
+    """
+    def __init__(self):
+        self.parent = []
+        self.labels = []
+        self.lengths = []
+        self.comments = {}  # {node index: '[...]'}, written back out unchanged
+        self.rooted = None
+        self.label = None
+
+    def add_node(self, parent):
+        self.parent.append(parent)
+        self.labels.append(None)
+        self.lengths.append(None)
+        return len(self.parent) - 1
+
+    def children(self):
+        children = [[] for _ in self.parent]
+        for indx, parent in enumerate(self.parent):
+            if parent != -1:
+                children[parent].append(indx)
+        return children
+
+    def leaves(self):
+        has_children = [False] * len(self.parent)
+        for parent in self.parent:
+            if parent != -1:
+                has_children[parent] = True
+        return [indx for indx, internal in enumerate(has_children) if not internal]
+
+    def prune(self, remove):
+        """
+        Delete leaves in a single mark-and-sweep pass, dropping internal nodes that lose all of their children and
+        merging those left with a single child (as dendropy's prune_taxa() does)
+        :param remove: Function that takes a leaf label and returns True if the leaf should be deleted
+        :return: None
+        """
+        num_kept = [0] * len(self.parent)
+        keep = [False] * len(self.parent)
+        leaves = set(self.leaves())
+        for indx in range(len(self.parent) - 1, -1, -1):  # Children always come after their parents
+            if indx in leaves:
+                keep[indx] = not remove(self.labels[indx])
+            else:
+                keep[indx] = num_kept[indx] > 0
+            if keep[indx] and self.parent[indx] != -1:
+                num_kept[self.parent[indx]] += 1
+
+        parent, labels, lengths, comments = [], [], [], {}
+        anchor = [-1] * len(self.parent)  # New index that the children of each old node hang from
+        carry = [0.] * len(self.parent)  # Length of merged edges, added on to the next node down
+        for indx in range(len(self.parent)):
+            if not keep[indx]:
+                continue
+            old_parent = self.parent[indx]
+            attach = anchor[old_parent] if old_parent != -1 else -1
+            extra = carry[old_parent] if old_parent != -1 else 0.
+            if old_parent != -1 and num_kept[indx] == 1:
+                anchor[indx] = attach
+                carry[indx] = extra + (self.lengths[indx] if self.lengths[indx] else 0.)
+                continue
+            anchor[indx] = len(parent)
+            parent.append(attach)
+            labels.append(self.labels[indx])
+            length = self.lengths[indx]
+            lengths.append(length + extra if length is not None else (extra if extra else None))
+            if indx in self.comments:
+                comments[anchor[indx]] = self.comments[indx]
+
+        if len(parent) > 1 and parent.count(0) == 1:  # The root was left with a single child
+            parent = [-1] + [x - 1 for x in parent[2:]]
+            if lengths[0] is not None:  # The old root's edge is merged into the new one, as dendropy does
+                lengths[1] = lengths[0] if lengths[1] is None else lengths[1] + lengths[0]
+            labels, lengths = labels[1:], lengths[1:]
+            comments = dict([(indx - 1, comment) for indx, comment in comments.items() if indx])
+        self.parent, self.labels, self.lengths, self.comments = parent, labels, lengths, comments
+        return
+
+    def as_string(self):
+        def _node_string(_indx):
+            label = self.labels[_indx]
+            if label is None:
+                label = ""
+            elif re.search("[()\\[\\]':;,\t\n_]", label):
+                label = "'%s'" % label.replace("'", "''")
+            else:
+                label = label.replace(" ", "_")
+            label += self.comments.get(_indx, "")
+            return label if self.lengths[_indx] is None else "%s:%s" % (label, self.lengths[_indx])
+
+        output = ["[&R] " if self.rooted else "" if self.rooted is None else "[&U] "]
+        if self.parent:
+            children = self.children()
+            stack = [(0, False)]
+            while stack:  # Iterative, so very deep trees don't hit the recursion limit
+                indx, closing = stack.pop()
+                if closing:
+                    output.append(")%s" % _node_string(indx))
+                elif indx == -1:
+                    output.append(",")
+                elif children[indx]:
+                    output.append("(")
+                    stack.append((indx, True))
+                    for pos in range(len(children[indx]) - 1, -1, -1):
+                        stack.append((children[indx][pos], False))
+                        if pos:
+                            stack.append((-1, False))
+                else:
+                    output.append(_node_string(indx))
+        output.append(";\n")
+        return "".join(output)
+
+    def to_dendropy(self, taxon_namespace=None):
+        """
+        Build the equivalent dendropy Tree, for tools that need more than the compact form provides
+        :param taxon_namespace: dendropy TaxonNamespace shared by all of the trees
+        :return: dendropy Tree object (comments are not carried over)
+        """
+        taxon_namespace = TaxonNamespace() if taxon_namespace is None else taxon_namespace
+        tree = Tree(taxon_namespace=taxon_namespace, label=self.label)
+        tree.is_rooted = self.rooted
+        if not self.parent:
+            return tree
+        leaves = set(self.leaves())
+        nodes = [tree.seed_node]
+        for indx in range(1, len(self.parent)):
+            node = Node()
+            nodes[self.parent[indx]].add_child(node)
+            nodes.append(node)
+        for indx, node in enumerate(nodes):
+            if indx in leaves and self.labels[indx] is not None:
+                node.taxon = taxon_namespace.require_taxon(label=self.labels[indx])
+            else:
+                node.label = self.labels[indx]
+            node.edge.length = self.lengths[indx]
+        return tree
+
+
 class PhyloBuddy(object):
-    def __init__(self, _input, _in_format=None, _out_format=None):
+    compact_trees = None  # List of CompactTree objects, converted to dendropy Trees when .trees is first used
+
+    def __init__(self, _input, _in_format=None, _out_format=None, lazy=False, compact=False):
         # ####  IN AND OUT FORMATS  #### #
         # Holders for input type. Used for some error handling below
 
@@ -128,6 +291,24 @@ class PhyloBuddy(object):
         self.trees = []
         self.hash_map = []  # Only used when hash_ids() function is called
         tree_classes = [Tree]  # Dendropy Tree
+
+        if lazy:  # Trees are only parsed as they are needed, see TreeStream
+            tmp_dir = None
+            if str(type(_input)) == "<class '_io.TextIOWrapper'>":
+                tmp_dir = TempDir()
+                with open("%s/tree.tmp" % tmp_dir.path, "w") as _ofile:
+                    shutil.copyfileobj(_input, _ofile)
+                _input = "%s/tree.tmp" % tmp_dir.path
+            if not isinstance(_input, str) or not os.path.isfile(_input):
+                raise TypeError("Lazy reading requires a tree file or file handle.")
+
+            self.in_format = _in_format if _in_format else _guess_format(_input)
+            if not self.in_format:
+                raise br.GuessError("Could not automatically determine the format of '{0}'.\n"
+                                    "Try explicitly setting it with the -f flag.".format(_input))
+            self.out_format = self.in_format if not _out_format else _out_format
+            self.trees = TreeStream(_input, self.in_format, tmp_dir)
+            return
         # Handles
         if str(type(_input)) == "<class '_io.TextIOWrapper'>":
             if not _input.seekable():  # Deal with input streams (e.g., stdout pipes)
@@ -178,7 +359,20 @@ class PhyloBuddy(object):
 
         # ####  RECORDS  #### #
         if type(_input) == PhyloBuddy:
-            self.trees = _input.trees
+            if _input.compact_trees is not None:
+                self.compact_trees = _input.compact_trees
+            else:
+                self.trees = _input.trees
+
+        elif compact and self.in_format == "newick" and (in_handle is not None or in_file):
+            if in_handle is None:
+                with open(in_file, "r") as ifile:
+                    in_handle = ifile.read()
+            self.compact_trees = _parse_compact_newick(in_handle)
+            if not [length for _tree in self.compact_trees for length in _tree.lengths if length]:
+                for _tree in self.compact_trees:
+                    _tree.lengths = [1.0] * len(_tree.lengths)
+            return
 
         elif isinstance(_input, list):
             # make sure that the list is actually Bio.Phylo records (just test a few...)
@@ -209,12 +403,8 @@ class PhyloBuddy(object):
                 self.trees.append(_tree)
 
         elif os.path.isfile(_input):
-            figtree = _extract_figtree_metadata(_input)  # FigTree data being discarded here too
-            if figtree is not None:
-                tmp_dir = TempDir()
-                with open("%s/tree.tmp" % tmp_dir.path, "w") as _ofile:
-                    _ofile.write(figtree[0])
-                _input = "%s/tree.tmp" % tmp_dir.path
+            if self.in_format == 'nexus':
+                _input, tmp_dir = _strip_figtree(_input)  # FigTree data being discarded here too
             if self.in_format != 'nexml':
                 _trees = Tree.yield_from_files(files=[_input], schema=self.in_format, extract_comment_metadata=True)
             else:
@@ -239,12 +429,31 @@ class PhyloBuddy(object):
                 for _node in _tree.nodes():
                     _node.edge_length = 1.0
 
+    @property
+    def trees(self):
+        # Compact trees are only converted to dendropy when a tool needs them
+        if self.compact_trees is not None:
+            taxon_namespace = TaxonNamespace()
+            self._trees = [_tree.to_dendropy(taxon_namespace) for _tree in self.compact_trees]
+            self.compact_trees = None
+        return self._trees
+
+    @trees.setter
+    def trees(self, _trees):
+        self._trees = _trees
+        self.compact_trees = None
+
     def print(self):
         print(self)
         return
 
     def __str__(self):
-        if len(self.trees) == 0:
+        if self.compact_trees is not None and self.out_format == "newick":
+            if not self.compact_trees:
+                return "Error: No trees in object.\n"
+            return "".join([_tree.as_string() for _tree in self.compact_trees])
+
+        if not isinstance(self.trees, TreeStream) and len(self.trees) == 0:
             return "Error: No trees in object.\n"
 
         tree_list = TreeList()
@@ -266,12 +475,66 @@ class PhyloBuddy(object):
         return _output
 
     def write(self, _file_path):
-        with open(_file_path, "w") as _ofile:
-            _ofile.write(str(self))
+        if hasattr(_file_path, "write"):
+            self._write_trees(_file_path)
+        else:
+            with open(_file_path, "w") as _ofile:
+                self._write_trees(_ofile)
+        return
+
+    def _write_trees(self, _handle):
+        # Lazily read Newick trees are written one at a time. Other formats need the whole tree list at once.
+        if self.compact_trees is not None and self.out_format == "newick":
+            for _tree in self.compact_trees:
+                _handle.write(_tree.as_string())
+        elif isinstance(self.trees, TreeStream) and self.out_format == "newick":
+            for _tree in self.trees:
+                _handle.write(_tree.as_string(schema="newick", annotations_as_nhx=False, suppress_annotations=False))
+        else:
+            _handle.write(str(self))
         return
 
 
 # ################################################# HELPER FUNCTIONS ################################################# #
+def _combine_patterns(patterns):
+    """
+    Merge regex patterns into a single compiled search, so each label is only scanned once
+    :param patterns: List of regex strings
+    :return: Function that takes a label and returns True if any of the patterns match it
+    """
+    # Back references and inline flags don't survive being joined together, so those are searched one at a time
+    if not [pattern for pattern in patterns if re.search(r"\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)", pattern)]:
+        try:
+            combined = re.compile("|".join(["(?:%s)" % pattern for pattern in patterns]))
+            return lambda label: label is not None and combined.search(label) is not None
+        except re.error:
+            pass
+    compiled = [re.compile(pattern) for pattern in patterns]
+    return lambda label: label is not None and any([regex.search(label) for regex in compiled])
+
+
+def _import_ete3():
+    """
+    ETE3 is slow to import and is only needed by a few tools, so it is loaded the first time one of them is called
+    :return: The ete3 module
+    """
+    try:
+        import ete3
+    except ImportError:
+        confirm = input("PhyloBuddy requires ETE v3+, which was not detected on your system. Try to install [y]/n? ")
+        if confirm.lower() in ["", "y", "yes"]:
+            Popen("pip install --upgrade  https://github.com/jhcepas/ete/archive/3.0.zip", shell=True).wait()
+            Popen("pip install six", shell=True).wait()
+            try:
+                import ete3
+
+            except ImportError:
+                sys.exit("Failed to install ETE3, please see http://etetoolkit.org/download/ for further details")
+        else:
+            sys.exit("Aborting. Please see http://etetoolkit.org/download/ for installation details\n")
+    return ete3
+
+
 def _convert_to_ete(_tree, ignore_color=False):
     """
     Converts dendropy trees to ete trees
@@ -284,6 +547,7 @@ def _convert_to_ete(_tree, ignore_color=False):
         _ofile.write(re.sub('!color', 'pb_color', _tree.as_string(schema='newick', annotations_as_nhx=True,
                                                                   suppress_annotations=False, suppress_rooting=True)))
 
+    ete3 = _import_ete3()
     ete_tree = ete3.TreeNode(newick="%s/tree.tmp" % tmp_dir.path)
 
     if not ignore_color:  # Converts color annotations from figtree into NodeStyle objects.
@@ -351,7 +615,7 @@ def _guess_format(_input):
 
     if str(type(_input)) == "<class '_io.TextIOWrapper'>" or isinstance(_input, StringIO):
         # Die if file is empty
-        contents = _input.read()
+        contents = _input.read(GUESS_SIZE)
         if contents == "":
             sys.exit("Input file is empty.")
         _input.seek(0)
@@ -370,6 +634,293 @@ def _guess_format(_input):
         raise br.GuessError("Unsupported _input argument in guess_format(). %s" % _input)
 
 
+def _map_trees(phylobuddy, func, compact_func=None):
+    # Per-tree tools go through here, so lazily read trees are changed as they stream past instead of all at once.
+    # Compact trees are only converted to dendropy if the tool has no compact_func.
+    if phylobuddy.compact_trees is not None and compact_func:
+        for tree in phylobuddy.compact_trees:
+            compact_func(tree)
+    elif isinstance(phylobuddy.trees, TreeStream):
+        phylobuddy.trees.add_step(func)
+    else:
+        for tree in phylobuddy.trees:
+            func(tree)
+    return phylobuddy
+
+
+def _parse_compact_newick(text):
+    """
+    Linear time Newick parser, building CompactTree objects
+    :param text: Newick string, which may hold several trees
+    :return: List of CompactTree objects
+    """
+    trees = []
+    tree = None
+    current = -1
+    expect_length = False
+    for token in NEWICK_TOKENS.findall(text):
+        if tree is None:
+            if token == ";":
+                continue
+            tree = CompactTree()
+            current = tree.add_node(-1)
+
+        if token == "(":
+            current = tree.add_node(current)
+        elif token == ",":
+            if tree.parent[current] == -1:
+                raise br.GuessError("Malformed Newick: unexpected ',' at the root of tree %s." % (len(trees) + 1))
+            current = tree.add_node(tree.parent[current])
+        elif token == ")":
+            if tree.parent[current] == -1:
+                raise br.GuessError("Malformed Newick: unbalanced ')' in tree %s." % (len(trees) + 1))
+            current = tree.parent[current]
+        elif token == ":":
+            expect_length = True
+        elif token == ";":
+            if current != 0:
+                raise br.GuessError("Malformed Newick: unbalanced '(' in tree %s." % (len(trees) + 1))
+            trees.append(tree)
+            tree = None
+        elif token.startswith("["):
+            if token.upper() in ["[&R]", "[&U]"] and len(tree.parent) == 1 and tree.labels[0] is None:
+                tree.rooted = token.upper() == "[&R]"
+            else:
+                tree.comments[current] = tree.comments.get(current, "") + token
+        elif expect_length:
+            try:
+                tree.lengths[current] = float(token)
+            except ValueError:
+                raise br.GuessError("Malformed Newick: '%s' is not a branch length." % token)
+            expect_length = False
+        elif token.startswith("'"):
+            tree.labels[current] = token[1:-1].replace("''", "'")
+        else:
+            tree.labels[current] = token.replace("_", " ")
+
+    if tree is not None:
+        raise br.GuessError("Malformed Newick: tree %s is missing its closing ';'." % (len(trees) + 1))
+    return trees
+
+
+def _postorder(children, start):
+    # Iterative post-order over a list of child index lists, so very deep trees don't hit the recursion limit
+    stack = [(start, False)]
+    while stack:
+        indx, visited = stack.pop()
+        if visited:
+            yield indx
+        else:
+            stack.append((indx, True))
+            for child in reversed(children[indx]):
+                stack.append((child, False))
+
+
+def _prepare_tree(_tree):
+    # Lazy counterpart of the clean up done in PhyloBuddy.__init__(), applied to one tree at a time. The edge lengths
+    # are set to 1.0 if they are all zero or None in this tree (rather than in the whole file).
+    all_none = True
+    for _node in _tree.nodes():
+        if _node.has_annotations:
+            _node.annotations._item_list = sorted(_node.annotations._item_list, key=lambda x: x.name)
+            _node.annotations._item_set = set(_node.annotations._item_list)
+        if _node.edge_length not in [0, 0.0, None]:
+            all_none = False
+    if all_none:
+        for _node in _tree.nodes():
+            _node.edge_length = 1.0
+    return _tree
+
+
+def _split_distance(splits1, splits2, method):
+    # Mirrors dendropy.calculate.treecompare: every split of tree2 (repeats included) is visited before the splits only
+    # found in tree1, and repeated splits take the length of their last edge
+    if method == 'uwrf':
+        return len(set([split for split, length in splits1]) ^ set([split for split, length in splits2]))
+    lengths1 = OrderedDict(splits1)
+    lengths2 = dict(splits2)
+    length_diffs = []
+    for split, length in splits2:
+        length_diffs.append((lengths2[split], lengths1.pop(split, 0.)))
+    for split, length in lengths1.items():
+        length_diffs.append((length, 0.))
+    if method == 'wrf':
+        return sum([abs(length1 - length2) for length1, length2 in length_diffs])
+    return sqrt(sum([pow(length1 - length2, 2) for length1, length2 in length_diffs]))
+
+
+def _split_distances(tree_splits, pairs, method, max_processes=0):
+    """
+    Distances between many pairs of trees, on multiple cores for large jobs
+    :param tree_splits: List of [(bitmask, edge length), ...] lists, one per tree (see _tree_splits())
+    :param pairs: List of (index1, index2) tuples
+    :param method: 'wrf', 'uwrf', or 'euclid'
+    :param max_processes: Number of processes used for large jobs (0 uses all available cores)
+    :return: List of distances, in the same order as pairs
+    """
+    if len(pairs) < DISTANCE_PARALLEL_SIZE or max_processes == 1:
+        return [_split_distance(tree_splits[indx1], tree_splits[indx2], method) for indx1, indx2 in pairs]
+
+    max_processes = usable_cpu_count() if not max_processes else max_processes
+    chunk_size = int(len(pairs) / (max_processes * 4)) + 1
+    chunks = [(indx, pairs[indx:indx + chunk_size]) for indx in range(0, len(pairs), chunk_size)]
+    tmp_dir = TempDir()
+
+    def compare_chunk(chunk):
+        indx, chunk_pairs = chunk
+        dists = [_split_distance(tree_splits[indx1], tree_splits[indx2], method) for indx1, indx2 in chunk_pairs]
+        with open("%s/%s.pkl" % (tmp_dir.path, indx), "wb") as ofile:
+            pickle.dump(dists, ofile)
+
+    run_multicore_function(chunks, compare_chunk, max_processes=max_processes, quiet=True)
+
+    distances = []
+    for indx, chunk_pairs in chunks:
+        if not os.path.isfile("%s/%s.pkl" % (tmp_dir.path, indx)):
+            raise RuntimeError("Worker process exited unexpectedly while comparing trees.")
+        with open("%s/%s.pkl" % (tmp_dir.path, indx), "rb") as ifile:
+            distances += pickle.load(ifile)
+    return distances
+
+
+def _strip_figtree(_file_path):
+    """
+    Removes the figtree block (and anything after it) from a nexus file, reading one line at a time
+    :param _file_path: Specifies the tree file path
+    :return: (path to a file without the figtree block, TempDir holding that file or None if there was no block)
+    """
+    tmp_dir = TempDir()
+    found = False
+    with open(_file_path, "r") as _ifile, open("%s/tree.tmp" % tmp_dir.path, "w") as _ofile:
+        # The last character is held back, because _extract_figtree_metadata() also drops the one before the block
+        pending = ""
+        for line in _ifile:
+            start = line.find('begin figtree;')
+            if start != -1:
+                _ofile.write((pending + line[:start])[:-1])
+                found = True
+                break
+            line = pending + line
+            _ofile.write(line[:-1])
+            pending = line[-1:]
+        else:
+            _ofile.write(pending)
+    if not found:
+        return _file_path, None
+    return "%s/tree.tmp" % tmp_dir.path, tmp_dir
+
+
+def _add_taxon_bits(taxon_bits, taxon_namespace):
+    # Taxa get the bit of their position in the taxon namespace, because unrooted splits are normalized on the lowest
+    # bit in each tree and this has to match treecompare when the trees' leaf sets differ
+    for taxon in taxon_namespace:
+        if taxon.label not in taxon_bits:
+            taxon_bits[taxon.label] = 1 << len(taxon_bits)
+    return taxon_bits
+
+
+def _tree_splits(trees):
+    """
+    Encode the bipartitions of every tree once, the same way dendropy's Tree.encode_bipartitions() does (without
+    changing the trees)
+    :param trees: List of dendropy Tree objects
+    :return: List of [(bitmask, edge length), ...] lists, one per tree, with every edge in post-order
+    """
+    taxon_bits = {}
+    for namespace in OrderedDict([(id(tree.taxon_namespace), tree.taxon_namespace) for tree in trees]).values():
+        _add_taxon_bits(taxon_bits, namespace)
+    return [_encode_tree_splits(tree, taxon_bits) for tree in trees]
+
+
+def _encode_tree_splits(tree, taxon_bits):
+    """
+    Bipartitions of a single tree, encoded as in _tree_splits()
+    :param tree: dendropy Tree object
+    :param taxon_bits: dict of {taxon label: bit}, shared by all of the trees being compared (new taxa are added)
+    :return: List of (bitmask, edge length) tuples, with every edge (root and leaf edges included) in post-order
+    """
+    nodes = list(tree.postorder_node_iter())
+    node_indx = dict([(id(node), indx) for indx, node in enumerate(nodes)])
+    children = [[node_indx[id(child)] for child in node.child_node_iter()] for node in nodes]
+    lengths = [node.edge.length for node in nodes]
+    parent = [None] * len(nodes)
+    for indx, kids in enumerate(children):
+        for child in kids:
+            parent[child] = indx
+    seed = len(nodes) - 1
+    rooted = bool(tree.is_rooted)
+
+    # An unrooted basal bifurcation is collapsed into a trifurcation (Tree.collapse_basal_bifurcation())
+    if not rooted and len(children[seed]) == 2:
+        to_keep = to_del = None
+        if len(children[children[seed][1]]) >= 2:
+            to_keep, to_del = children[seed]
+        elif len(children[children[seed][0]]) >= 2:
+            to_del, to_keep = children[seed]
+        if to_del is not None:
+            if lengths[to_keep] is not None and lengths[to_del] is not None:
+                lengths[to_keep] += lengths[to_del]
+            children[seed] = [to_keep] + children[to_del]
+            for child in children[to_del]:
+                parent[child] = seed
+
+    # Nodes with a single child are merged into it (Tree.suppress_unifurcations())
+    for indx in _postorder(children, seed):
+        if len(children[indx]) != 1:
+            continue
+        child = children[indx][0]
+        if lengths[indx] is not None:
+            lengths[child] = lengths[indx] if lengths[child] is None else lengths[child] + lengths[indx]
+        if parent[indx] is None:
+            seed = child
+            parent[child] = None
+        else:
+            siblings = children[parent[indx]]
+            siblings[siblings.index(indx)] = child
+            parent[child] = parent[indx]
+
+    leafsets = [0] * len(nodes)
+    splits = []
+    for indx in _postorder(children, seed):
+        if children[indx]:
+            for child in children[indx]:
+                leafsets[indx] |= leafsets[child]
+        elif nodes[indx].taxon is not None:
+            if nodes[indx].taxon.label not in taxon_bits:
+                taxon_bits[nodes[indx].taxon.label] = 1 << len(taxon_bits)
+            leafsets[indx] = taxon_bits[nodes[indx].taxon.label]
+        splits.append((indx, float(lengths[indx]) if lengths[indx] else 0.))
+
+    all_taxa = leafsets[seed]
+    lowest_bit = all_taxa & -all_taxa
+    return [(leafsets[indx] ^ all_taxa if not rooted and leafsets[indx] & lowest_bit else leafsets[indx], length)
+            for indx, length in splits]
+
+
+def _yield_trees(tree_files, in_format=None, taxon_namespace=None):
+    """
+    Parse trees one at a time, so large tree files never have to be held in memory all at once
+    :param tree_files: File path or handle, or a list of them
+    :param in_format: Tree file format (guessed if not provided)
+    :param taxon_namespace: dendropy TaxonNamespace shared by all of the trees
+    :return: Generator of dendropy Tree objects
+    """
+    tree_files = tree_files if isinstance(tree_files, list) else [tree_files]
+    taxon_namespace = TaxonNamespace() if taxon_namespace is None else taxon_namespace
+    for tree_file in tree_files:
+        schema = in_format if in_format else _guess_format(tree_file)
+        if not schema:
+            raise br.GuessError("Could not automatically determine the format of '{0}'.\n"
+                                "Try explicitly setting it with the -f flag.".format(tree_file))
+        tmp_dir = None
+        if isinstance(tree_file, str) and schema == 'nexus':
+            tree_file, tmp_dir = _strip_figtree(tree_file)  # FigTree data is discarded
+        kwargs = {} if schema == 'nexml' else {"extract_comment_metadata": True}
+        for tree in Tree.yield_from_files(files=[tree_file], schema=schema, taxon_namespace=taxon_namespace,
+                                          **kwargs):
+            yield tree
+
+
 def make_copy(_phylobuddy):
     """
     Returns a copy of the PhyloBuddy object
@@ -381,6 +932,14 @@ def make_copy(_phylobuddy):
 
 
 def num_taxa(phylobuddy, nodes=False, split=False):
+    if phylobuddy.compact_trees is not None:
+        count = []
+        for tree in phylobuddy.compact_trees:
+            leaves = set(tree.leaves())
+            count.append(len([indx for indx, label in enumerate(tree.labels)
+                              if label and (nodes or indx in leaves)]))
+        return count if split else sum(count)
+
     count = [0]
     for indx, tree in enumerate(phylobuddy.trees):
         if split and indx > 0:
@@ -419,6 +978,64 @@ def consensus_tree(phylobuddy, frequency=.5):  # ToDo: Remove the length paramet
     return phylobuddy
 
 
+def consensus_tree_stream(tree_files, frequency=.5, burnin=0, thin=1, in_format=None, split_table=None):
+    """
+    Build a consensus tree from split frequencies while reading the trees one at a time, so very large tree samples
+    (e.g., BEAST or MrBayes output) never have to be held in memory at once.
+    :param tree_files: File path or handle, or a list of them
+    :param frequency: The frequency threshold of a split for it to be included in the new tree (0.5 is majority-rule)
+    :param burnin: Number of trees to discard from the start of the sample
+    :param thin: Only use every nth tree after the burn-in
+    :param in_format: Tree file format (guessed if not provided)
+    :param split_table: Also write the split frequencies to this file (tab delimited)
+    :return: A PhyloBuddy object containing the consensus tree
+    """
+    taxon_namespace = TaxonNamespace()
+    taxon_bits, split_counts, num_trees = split_frequencies(_yield_trees(tree_files, in_format, taxon_namespace),
+                                                            burnin, thin)
+    if not num_trees:
+        raise ValueError("No trees left to build a consensus from after burn-in and thinning.")
+
+    labels = sorted(taxon_bits, key=lambda label: taxon_bits[label])
+    all_taxa = (1 << len(labels)) - 1
+    has_lengths = any([length_sum for count, length_sum in split_counts.values()])
+
+    if split_table:
+        with open(split_table, "w") as ofile:
+            ofile.write("split\tcount\tfrequency\tmean_length\n")
+            for mask, (count, length_sum) in sorted(split_counts.items(), key=lambda x: -x[1][0]):
+                taxa = ",".join([label for indx, label in enumerate(labels) if mask & (1 << indx)])
+                ofile.write("%s\t%s\t%s\t%s\n" % (taxa, count, count / num_trees, length_sum / count))
+
+    # Splits are accepted from most to least frequent (ties broken on bitmask, as dendropy does), skipping any that
+    # conflict with those already accepted
+    accepted = []
+    for mask, (count, length_sum) in sorted(split_counts.items(), key=lambda x: (-x[1][0], -x[0])):
+        if count / num_trees < frequency or bin(mask).count("1") < 2 or bin(all_taxa ^ mask).count("1") < 2:
+            continue  # Trivial splits are leaf edges (a single taxon, or the complement of one)
+        if all([mask & other in [0, mask, other] for other in accepted]):
+            accepted.append(mask)
+
+    # Larger clades are placed first, so each new clade goes under the smallest clade already holding its taxa
+    tree = Tree(taxon_namespace=taxon_namespace)
+    tree.is_rooted = False
+    deepest = dict([(bit, tree.seed_node) for bit in range(len(labels))])
+    for mask in sorted(accepted, key=lambda x: -bin(x).count("1")):
+        count, length_sum = split_counts[mask]
+        bits = [bit for bit in range(len(labels)) if mask & (1 << bit)]
+        node = deepest[bits[0]].new_child(label="%s" % round(count / num_trees, 4))
+        node.edge.length = length_sum / count if has_lengths else None
+        for bit in bits:
+            deepest[bit] = node
+
+    for bit, label in enumerate(labels):
+        leaf = deepest[bit].new_child(taxon=taxon_namespace.get_taxon(label))
+        count, length_sum = split_counts.get(1 << bit, split_counts.get(all_taxa ^ (1 << bit), [0, 0.]))
+        leaf.edge.length = length_sum / count if has_lengths and count else None
+
+    return PhyloBuddy([tree])
+
+
 def display_trees(phylobuddy):
     """
     Displays trees in an ETE GUI window, one-by-one.
@@ -433,13 +1050,7 @@ def display_trees(phylobuddy):
     return True
 
 
-def distance(phylobuddy, method='weighted_robinson_foulds'):
-    """
-    Calculates distance metrics between pairs of trees
-    :param phylobuddy: PhyloBuddy object
-    :param method: The tree comparison method ([un]weighted_robinson_foulds/euclidean_distance)
-    :return: A dictionary of dictonaries containing the distances between tree pairs. dict[tree1][tree2]
-    """
+def _distance_method(method):
     method = method.lower()
     if method in ['wrf', 'weighted_robinson_foulds']:
         method = 'wrf'
@@ -451,37 +1062,75 @@ def distance(phylobuddy, method='weighted_robinson_foulds'):
         method = 'euclid'
     else:
         raise AttributeError('{0} is an invalid comparison method.'.format(method))
+    return method
+
+
+def _distance_keys(phylobuddy):
+    return [tree.label if tree.label not in [None, ''] else 'tree_{0}'.format(indx + 1)
+            for indx, tree in enumerate(phylobuddy.trees)]
+
+
+def distance(phylobuddy, method='weighted_robinson_foulds', reference=None, max_processes=0):
+    """
+    Calculates distance metrics between pairs of trees
+    :param phylobuddy: PhyloBuddy object
+    :param method: The tree comparison method ([un]weighted_robinson_foulds/euclidean_distance)
+    :param reference: Only compare this tree (index or key) against all of the others
+    :param max_processes: Number of processes used for large jobs (0 uses all available cores)
+    :return: A dictionary of dictonaries containing the distances between tree pairs. dict[tree1][tree2]
+    """
+    method = _distance_method(method)
+    keys = _distance_keys(phylobuddy)
+
+    if reference is not None:
+        if reference in keys:
+            reference = keys.index(reference)
+        elif not isinstance(reference, int) or not -len(keys) <= reference < len(keys):
+            raise ValueError("Reference tree '%s' not found." % reference)
+        reference %= len(keys)
+        pairs = [(reference, indx) for indx in range(len(keys)) if indx != reference]
+    else:
+        pairs = [(indx1, indx2) for indx1 in range(len(keys)) for indx2 in range(indx1 + 1, len(keys))]
+
+    distances = _split_distances(_tree_splits(phylobuddy.trees), pairs, method, max_processes)
 
     output = OrderedDict()
-    keypairs = []
-
-    for indx1, tree1 in enumerate(phylobuddy.trees):  # Compares all-by-all
-        for indx2, tree2 in enumerate(phylobuddy.trees):
-            if tree1 is not tree2:  # Will not compare to itself
-                key1 = 'tree_{0}'.format(indx1 + 1) if tree1.label not in [None, ''] else tree1.label
-                key2 = 'tree_{0}'.format(indx2 + 1) if tree2.label not in [None, ''] else tree2.label
-                if key1 not in output.keys():
-                    output[key1] = OrderedDict()
-                if key2 not in output.keys():
-                    output[key2] = OrderedDict()
-                if (key2, key1) not in keypairs:  # Prevent repeated (reversed) searches
-                    keypairs.append((key1, key2))
-                    if method == 'wrf':
-                        output[key1][key2] = treecompare.weighted_robinson_foulds_distance(tree1, tree2)
-                        output[key2][key1] = output[key1][key2]
-                    elif method == 'uwrf':
-                        output[key1][key2] = treecompare.symmetric_difference(tree1, tree2)
-                        output[key2][key1] = output[key1][key2]
-                    # elif _method == 'mgk':
-                    #     _output[_key1][_key2] = treecompare.mason_gamer_kellogg_score(_tree1, _tree2)
-                    #     _output[_key2][_key1] = _output[_key1][_key2]
-                    else:
-                        output[key1][key2] = treecompare.euclidean_distance(tree1, tree2)
-                        output[key2][key1] = output[key1][key2]
+    if reference is not None:
+        output[keys[reference]] = OrderedDict([(keys[indx2], dist) for (indx1, indx2), dist in zip(pairs, distances)])
+        return output
+
+    for key in keys:
+        if key not in output:
+            output[key] = OrderedDict()
+    for (indx1, indx2), dist in zip(pairs, distances):
+        output[keys[indx1]][keys[indx2]] = dist
+        output[keys[indx2]][keys[indx1]] = dist
     return output
 
 
-def generate_tree(alignbuddy, tool, params=None, keep_temp=None, quiet=False):
+def distance_matrix(phylobuddy, method='weighted_robinson_foulds', max_processes=0):
+    """
+    All-by-all tree distances as a symmetric NumPy matrix
+    :param phylobuddy: PhyloBuddy object
+    :param method: The tree comparison method ([un]weighted_robinson_foulds/euclidean_distance)
+    :param max_processes: Number of processes used for large jobs (0 uses all available cores)
+    :return: (list of tree keys, numpy.ndarray of distances in the same order)
+    """
+    import numpy
+    method = _distance_method(method)
+    keys = _distance_keys(phylobuddy)
+    pairs = [(indx1, indx2) for indx1 in range(len(keys)) for indx2 in range(indx1 + 1, len(keys))]
+    distances = _split_distances(_tree_splits(phylobuddy.trees), pairs, method, max_processes)
+
+    matrix = numpy.zeros((len(keys), len(keys)), dtype=int if method == 'uwrf' else float)
+    if pairs:
+        rows, cols = zip(*pairs)
+        matrix[rows, cols] = distances
+        matrix[cols, rows] = distances
+    return keys, matrix
+
+
+def generate_tree(alignbuddy, tool, params=None, keep_temp=None, quiet=False, threads=None):
     # ToDo Check that this works for other versions of RAxML and PhyML
     """
     Calls tree building tools to generate trees
@@ -490,6 +1139,8 @@ def generate_tree(alignbuddy, tool, params=None, keep_temp=None, quiet=False):
     :param params: Additional parameters to be passed to the tree building tool
     :param keep_temp: Determines if/where the temporary files will be kept
     :param quiet: Suppress all output form alignment programs
+    :param threads: Number of threads for RAxML (-T, at least 2) and FastTreeMP (OMP_NUM_THREADS). Default uses all
+    available cores.
     :return: A PhyloBuddy object containing the trees produced.
     """
 
@@ -537,8 +1188,8 @@ def generate_tree(alignbuddy, tool, params=None, keep_temp=None, quiet=False):
 
         if tool == 'raxml':
             params = remove_invalid_params({'-s': True, '-n': True, '-w': True})
-            if '-T' not in params:  # Num threads
-                params += ' -T 2'
+            if '-T' not in params:  # Num threads (the pthreads version of RAxML needs at least 2)
+                params += ' -T {0}'.format(max(2, threads if threads else usable_cpu_count()))
             if '-m' not in params:  # An evolutionary model is required
                 if alignbuddy.alpha in [IUPAC.ambiguous_dna, IUPAC.unambiguous_dna, IUPAC.ambiguous_rna,
                                         IUPAC.unambiguous_rna]:
@@ -576,6 +1227,8 @@ def generate_tree(alignbuddy, tool, params=None, keep_temp=None, quiet=False):
                 command = '{0} {1} -nt {2}'.format(tool, params, tmp_in)  # fasttree must be told what alphabet to use
             else:
                 command = '{0} {1} {2}'.format(tool, params, tmp_in)
+            if threads:  # Only used by the multi-threaded build of FastTree
+                command = 'OMP_NUM_THREADS={0} {1}'.format(threads, command)
         else:
             raise AttributeError("'%s' is an unknown phylogenetics tool." % tool)  # Should be unreachable
 
@@ -620,16 +1273,20 @@ def generate_tree(alignbuddy, tool, params=None, keep_temp=None, quiet=False):
 
         phylobuddy = PhyloBuddy(output)
 
-        for _hash, _id in alignbuddy.hash_map.items():
-            rename(phylobuddy, _hash, _id)
+        hash_regex = br.map_regex(alignbuddy.hash_map)
+        for tree in phylobuddy.trees:
+            for node in tree:
+                if node.label:
+                    node.label = br.rename_from_map(node.label, alignbuddy.hash_map, hash_regex)
+                if node.taxon and node.taxon.label:
+                    node.taxon.label = br.rename_from_map(node.taxon.label, alignbuddy.hash_map, hash_regex)
 
         if keep_temp:
             _root, dirs, files = next(walklevel(keep_temp))
             for file in files:
                 with open("%s/%s" % (_root, file), "r") as ifile:
                     contents = ifile.read()
-                for _hash, _id in alignbuddy.hash_map.items():
-                    contents = re.sub(_hash, _id, contents)
+                contents = br.rename_from_map(contents, alignbuddy.hash_map, hash_regex)
                 with open("%s/%s" % (_root, file), "w") as ofile:
                     ofile.write(contents)
 
@@ -638,6 +1295,113 @@ def generate_tree(alignbuddy, tool, params=None, keep_temp=None, quiet=False):
         return phylobuddy
 
 
+def generate_tree_batch(alignbuddy, tool, params=None, bootstraps=0, max_processes=0, threads=None,
+                        resume_dir=None, seed=None, quiet=False):
+    """
+    Build a tree for every alignment (and for bootstrap replicates of each alignment) with a pool of worker processes.
+    The available cores are shared out between the jobs that run at the same time. If resume_dir is given, finished
+    trees are kept there and are not rebuilt when the same batch is run again after an interruption.
+    :param alignbuddy: The AlignBuddy object containing the alignments for building the trees
+    :param tool: The tree building tool to be used (raxml/phyml/fasttree)
+    :param params: Additional parameters to be passed to the tree building tool for every job
+    :param bootstraps: Number of bootstrap replicates of each alignment to build trees for
+    :param max_processes: Number of trees built at the same time (0 uses all available cores)
+    :param threads: Number of threads given to each job (default divides the available cores between the workers)
+    :param resume_dir: Directory where finished trees are stored and picked up again on restart
+    :param seed: Random seed for the bootstrap replicates
+    :param quiet: Suppress stderr output
+    :return: (PhyloBuddy object with the trees in input order (each alignment followed by its replicates),
+              list of (job name, status, seconds, detail) tuples in the same order)
+    """
+    tool = tool.lower()
+    if tool not in PHYLO_INFERENCE_TOOLS:
+        raise AttributeError("{0} is not a valid alignment tool.".format(tool))
+    if shutil.which(tool) is None:
+        raise ProcessLookupError('#### Could not find {0} in $PATH. ####\nInstallation instructions '
+                                 'may be found at {1}.\n'.format(tool, _get_tree_binaries(tool)))
+    if not alignbuddy.alignments:
+        raise ValueError("No alignments to build trees from.")
+
+    params = params if params else ""
+    jobs = []
+    for aln_indx in range(len(alignbuddy.alignments)):
+        for rep_indx in range(bootstraps + 1):
+            jobs.append(("aln%s" % (aln_indx + 1) if not rep_indx else "aln%s_bs%s" % (aln_indx + 1, rep_indx),
+                         aln_indx, rep_indx))
+
+    # The batch is fingerprinted so a resume directory can not be mixed up with a different run
+    seed = random.randint(1, 999999999) if seed is None else seed
+    fingerprint = md5(("%s\t%s\t%s\t%s" % (tool, params, bootstraps, "".join(
+        [aln.format("fasta") for aln in alignbuddy.alignments]))).encode()).hexdigest()
+    if resume_dir:
+        os.makedirs(resume_dir, exist_ok=True)
+        work_dir = resume_dir
+        manifest = os.path.join(resume_dir, "manifest.json")
+        if os.path.isfile(manifest):
+            with open(manifest, "r") as ifile:
+                manifest = json.load(ifile)
+            if manifest["fingerprint"] != fingerprint:
+                raise ValueError("%s holds the results of a different tree batch." % resume_dir)
+            seed = manifest["seed"]
+        else:
+            with open(manifest, "w") as ofile:
+                json.dump({"fingerprint": fingerprint, "seed": seed, "tool": tool, "params": params}, ofile)
+    else:
+        tmp_dir = TempDir()
+        work_dir = tmp_dir.path
+
+    pending = [indx for indx, job in enumerate(jobs) if not os.path.isfile("%s/%s.nwk" % (work_dir, job[0]))]
+    if pending:
+        _stderr("Building %s trees (%s already done)\n" % (len(pending), len(jobs) - len(pending)), quiet)
+    cpus = usable_cpu_count()
+    max_processes = min(max_processes if max_processes else cpus, max(1, len(pending)))
+    threads = threads if threads else max(1, int(cpus / max_processes))
+
+    def build_tree(indx):
+        name, aln_indx, rep_indx = jobs[indx]
+        start = time()
+        status, detail = "ok", ""
+        try:
+            job_alignbuddy = Alb.AlignBuddy([alignbuddy.alignments[aln_indx]], out_format=alignbuddy._out_format)
+            if rep_indx:
+                random.seed("%s_%s_%s" % (seed, aln_indx, rep_indx))
+                job_alignbuddy = Alb.bootstrap(job_alignbuddy)
+            phylobuddy = generate_tree(job_alignbuddy, tool, params, quiet=True, threads=threads)
+            phylobuddy.out_format = "newick"
+            # Written under a temporary name first, so a killed job never looks finished
+            phylobuddy.write("%s/%s.nwk.part" % (work_dir, name))
+            os.rename("%s/%s.nwk.part" % (work_dir, name), "%s/%s.nwk" % (work_dir, name))
+        except Exception as e:
+            status, detail = "failed", "%s: %s" % (e.__class__.__name__, str(e).replace("\n", " ").replace("\t", " "))
+        with open("%s/%s.tsv" % (work_dir, name), "w") as ofile:
+            ofile.write("%s\t%s\t%s" % (status, time() - start, detail))
+
+    if pending:
+        run_multicore_function(pending, build_tree, max_processes=max_processes, quiet=quiet, out_type=sys.stderr)
+
+    trees = ""
+    report = []
+    for name, aln_indx, rep_indx in jobs:
+        if not os.path.isfile("%s/%s.nwk" % (work_dir, name)):
+            if os.path.isfile("%s/%s.tsv" % (work_dir, name)):
+                with open("%s/%s.tsv" % (work_dir, name), "r") as ifile:
+                    status, seconds, detail = ifile.read().split("\t")
+                report.append((name, status, float(seconds), detail))
+            else:
+                report.append((name, "failed", 0., "Worker process exited unexpectedly"))
+            continue
+        with open("%s/%s.nwk" % (work_dir, name), "r") as ifile:
+            trees += ifile.read()
+        seconds = 0.
+        if os.path.isfile("%s/%s.tsv" % (work_dir, name)):
+            with open("%s/%s.tsv" % (work_dir, name), "r") as ifile:
+                seconds = float(ifile.read().split("\t")[1])
+        report.append((name, "ok", seconds, ""))
+
+    phylobuddy = PhyloBuddy(trees, "newick") if trees else None
+    return phylobuddy, report
+
+
 def hash_ids(phylobuddy, hash_length=10, nodes=False):
     """
     Replaces the sequence IDs with random hashes
@@ -692,7 +1456,9 @@ def hash_ids(phylobuddy, hash_length=10, nodes=False):
                          "Hash length must be increased.")
 
     hashes = HashFactory()
-    for tree in phylobuddy.trees:
+    taxon_hashes = {}  # Compact trees don't share taxa, so repeated tip labels are tracked here instead
+
+    def _hash_tree(tree):
         hashes.add_tree()
         for node in tree:
             if nodes and node.label:
@@ -701,7 +1467,20 @@ def hash_ids(phylobuddy, hash_length=10, nodes=False):
             if node.taxon and node.taxon.label:
                 node.taxon.label = hashes.new_hash(str(node.taxon.label))
 
-    phylobuddy.hash_map = hashes.hash_map
+    def _hash_compact(tree):
+        hashes.add_tree()
+        leaves = set(tree.leaves())
+        for indx, label in enumerate(tree.labels):
+            if not label:
+                continue
+            if indx in leaves:
+                tree.labels[indx] = hashes.new_hash(taxon_hashes.get(label, label))
+                taxon_hashes[label] = tree.labels[indx]
+            elif nodes:
+                tree.labels[indx] = hashes.new_hash(label)
+
+    _map_trees(phylobuddy, _hash_tree, _hash_compact)
+    phylobuddy.hash_map = hashes.hash_map  # Filled in as the trees are read, if they are being read lazily
     return phylobuddy
 
 
@@ -712,6 +1491,12 @@ def list_ids(phylobuddy):
     :return: A dictionary of tree names and node labels
     """
     output = OrderedDict()
+    if phylobuddy.compact_trees is not None:
+        for indx, tree in enumerate(phylobuddy.compact_trees):
+            labels = [tree.labels[leaf] for leaf in tree.leaves() if tree.labels[leaf]]
+            output['tree_{0}'.format(str(indx + 1))] = labels
+        return output
+
     for indx, tree in enumerate(phylobuddy.trees):
         namespace = TaxonNamespace()
         for node in tree:
@@ -729,18 +1514,27 @@ def prune_taxa(phylobuddy, *patterns):
     :param patterns: One or more regex patterns.
     :return: The same PhyloBuddy object after pruning.
     """
-    for tree in phylobuddy.trees:
-        taxa_to_prune = []
-        namespace = TaxonNamespace()
-        for node in tree:  # Populate the namespace for easy iteration
-            if node.taxon:
-                namespace.add_taxon(node.taxon)
-        for taxon in namespace.labels():
-            for pattern in patterns:
-                if re.search(pattern, taxon):  # Sets aside the names of the taxa to be pruned
-                    taxa_to_prune.append(taxon)
-        for taxon in taxa_to_prune:  # Removes the nodes from the tree
-            tree.prune_taxa_with_labels(StringIO(taxon))
+    matches = _combine_patterns(patterns)
+
+    def _prune(tree):
+        # Single post-order sweep. Children are always visited before their parents, so a node is kept if it is an
+        # unmatched tip or if any of its children survived.
+        keep = {}
+        for node in list(tree.postorder_node_iter()):
+            if node.is_leaf():
+                keep[node] = not (node.taxon and matches(node.taxon.label))
+            else:
+                children = node.child_nodes()
+                kept = [child for child in children if keep[child]]
+                if len(kept) != len(children):
+                    node.set_child_nodes(kept)
+                keep[node] = len(kept) > 0
+        tree.suppress_unifurcations()
+
+    def _prune_compact(tree):
+        tree.prune(matches)
+
+    return _map_trees(phylobuddy, _prune, _prune_compact)
 
 
 def rename(phylobuddy, query, replace):
@@ -751,13 +1545,19 @@ def rename(phylobuddy, query, replace):
     :param replace: The string to replace the matches with
     :return: The modified PhyloBuddy object
     """
-    for indx, tree in enumerate(phylobuddy.trees):
+    query = re.compile(query)
+
+    def _rename(tree):
         for node in tree:
             if node.label:
-                node.label = re.sub(query, replace, node.label)
+                node.label = query.sub(replace, node.label)
             if node.taxon and node.taxon.label:
-                node.taxon.label = re.sub(query, replace, node.taxon.label)
-    return phylobuddy
+                node.taxon.label = query.sub(replace, node.taxon.label)
+
+    def _rename_compact(tree):
+        tree.labels = [query.sub(replace, label) if label else label for label in tree.labels]
+
+    return _map_trees(phylobuddy, _rename, _rename_compact)
 
 
 def root(phylobuddy, *root_nodes):
@@ -768,22 +1568,23 @@ def root(phylobuddy, *root_nodes):
     node will be rooted on
     :return: The modified PhyloBuddy object
     """
+    matches = _combine_patterns(root_nodes) if root_nodes else None
+
     def _root(_tree, _root_nodes=None):
         if _root_nodes:
-            all_nodes = []
-            for regex in root_nodes:
-                for indx, id_list in list_ids(PhyloBuddy([_tree])).items():
-                    for next_id in id_list:
-                        if re.search(regex, next_id):
-                            all_nodes.append(next_id)
+            # Index the labelled nodes once, instead of searching the tree for every match
+            label_index = OrderedDict()
+            for node in _tree:
+                if node.taxon and node.taxon.label not in label_index:
+                    label_index[node.taxon.label] = node
+            all_nodes = [node for label, node in label_index.items() if matches(label)]
+
             mrca = None
             if len(all_nodes) == 1:
-                leaf_node = _tree.find_node_with_taxon_label(all_nodes[0])
-                if leaf_node:
-                    mrca = leaf_node._parent_node
+                mrca = all_nodes[0]._parent_node
 
-            else:
-                mrca = _tree.mrca(taxon_labels=all_nodes)
+            elif all_nodes:
+                mrca = _tree.mrca(taxa=[node.taxon for node in all_nodes])
 
             if mrca:
                 _tree.reroot_at_node(mrca, update_bipartitions=True, suppress_unifurcations=False)
@@ -794,11 +1595,11 @@ def root(phylobuddy, *root_nodes):
             # in their development branch but it is not yet in the main branch
             _tree.reroot_at_midpoint(update_bipartitions=True, suppress_unifurcations=False)
 
-    for tree in phylobuddy.trees:
+    def _root_tree(tree):
         _root(tree, root_nodes)
         tree.is_rooted = True
 
-    return phylobuddy
+    return _map_trees(phylobuddy, _root_tree)
 
 
 def show_diff(phylobuddy):  # Doesn't work.
@@ -879,6 +1680,7 @@ def show_unique(phylobuddy):
 
     trees = [_convert_to_ete(phylobuddy.trees[0], ignore_color=True),
              _convert_to_ete(phylobuddy.trees[1], ignore_color=True)]  # Need ETE so we can compare them
+    from ete3.coretype.tree import TreeError
 
     try:
         data = trees[0].robinson_foulds(trees[1])
@@ -936,6 +1738,37 @@ def show_unique(phylobuddy):
     return phylobuddy
 
 
+def split_frequencies(trees, burnin=0, thin=1):
+    """
+    Count how often each bipartition appears in a collection of trees, and sum up its branch lengths
+    :param trees: Iterable of dendropy Tree objects (e.g., from _yield_trees(), so they can be streamed)
+    :param burnin: Number of trees to discard from the start of the sample
+    :param thin: Only count every nth tree after the burn-in
+    :return: (dict of {taxon label: bit}, dict of {bitmask: [count, summed edge length]}, number of trees counted)
+    """
+    if burnin < 0 or thin < 1:
+        raise ValueError("Burn-in must be 0 or more and thinning 1 or more.")
+    taxon_bits = {}
+    split_counts = {}
+    num_trees = 0
+    for indx, tree in enumerate(trees):
+        if indx < burnin or (indx - burnin) % thin:
+            continue
+        num_trees += 1
+        splits = _encode_tree_splits(tree, _add_taxon_bits(taxon_bits, tree.taxon_namespace))
+        tree_lengths = OrderedDict()
+        for mask, length in splits[:-1]:  # The root edge comes last, and isn't a split
+            if mask:
+                tree_lengths[mask] = tree_lengths.get(mask, 0.) + length
+        for mask, length in tree_lengths.items():
+            if mask in split_counts:
+                split_counts[mask][0] += 1
+                split_counts[mask][1] += length
+            else:
+                split_counts[mask] = [1, length]
+    return taxon_bits, split_counts, num_trees
+
+
 def split_polytomies(phylobuddy):
     """
     Randomly splits polytomies. This function was drawn almost verbatim from the DendroPy Tree.resolve_polytomies()
@@ -988,10 +1821,11 @@ def unroot(phylobuddy):
     :param phylobuddy: PhyloBuddy object
     :return: The modified PhyloBuddy object
     """
-    for tree in phylobuddy.trees:
+    def _unroot(tree):
         tree.is_rooted = False
         tree.update_bipartitions()
-    return phylobuddy
+
+    return _map_trees(phylobuddy, _unroot)
 
 
 # ################################################# COMMAND LINE UI ################################################## #
@@ -1017,6 +1851,12 @@ def argparse_init():
 
     in_args = parser.parse_args()
 
+    module = sys.modules[__name__]
+    br.start_profiler("PhyloBuddy", in_args, [(module, "_guess_format", "guess_format"),
+                                              (PhyloBuddy, "__init__", "load"),
+                                              (module, "make_copy", "make_copy"),
+                                              (PhyloBuddy, "__str__", "serialize")])
+
     phylobuddy = []
     tree_set = ""
 
@@ -1029,14 +1869,43 @@ def argparse_init():
         _stderr("Error: Output type %s is not recognized/supported\n" % in_args.out_format)
         sys.exit()
 
+    if in_args.batch:  # Each file is read independently by command_line_ui()
+        return in_args, phylobuddy
+
+    if in_args.consensus_tree and (in_args.burnin or in_args.thin):  # Trees are streamed by consensus_tree_stream()
+        return in_args, phylobuddy
+
+    # Per-tree commands stream a single input through TreeStream, so huge tree files are never held in memory
+    if len(in_args.trees) == 1 and not in_args.in_place and not in_args.compact \
+            and [x for x in LAZY_COMMANDS if getattr(in_args, x)]:
+        tree_set = in_args.trees[0]
+        if isinstance(tree_set, TextIOWrapper) and tree_set.buffer.raw.isatty():
+            _stderr("Warning: No input detected. Process will be aborted.")
+            sys.exit()
+        if isinstance(tree_set, TextIOWrapper) or os.path.isfile(str(tree_set)):
+            try:
+                return in_args, PhyloBuddy(tree_set, in_args.in_format, in_args.out_format, lazy=True)
+            except br.GuessError as e:
+                _stderr("GuessError: %s\n" % e, in_args.quiet)
+                sys.exit()
+
     if not in_args.generate_tree:  # If passing in an alignment, don't want to try and build PhyloBuddy obj
+        tree_sets = []
         for tree_set in in_args.trees:
             if isinstance(tree_set, TextIOWrapper) and tree_set.buffer.raw.isatty():
                 _stderr("Warning: No input detected. Process will be aborted.")
                 sys.exit()
-            tree_set = PhyloBuddy(tree_set, in_args.in_format, in_args.out_format)
-            phylobuddy += tree_set.trees
-        phylobuddy = PhyloBuddy(phylobuddy, tree_set.in_format, tree_set.out_format)
+            tree_sets.append(PhyloBuddy(tree_set, in_args.in_format, in_args.out_format, compact=in_args.compact))
+
+        # Compact trees are only kept if every input could be read that way
+        if not [tree_set for tree_set in tree_sets if tree_set.compact_trees is None]:
+            compact_trees = [_tree for tree_set in tree_sets for _tree in tree_set.compact_trees]
+            phylobuddy = PhyloBuddy(phylobuddy, tree_sets[-1].in_format, tree_sets[-1].out_format)
+            phylobuddy.compact_trees = compact_trees
+        else:
+            for tree_set in tree_sets:
+                phylobuddy += tree_set.trees
+            phylobuddy = PhyloBuddy(phylobuddy, tree_sets[-1].in_format, tree_sets[-1].out_format)
 
     return in_args, phylobuddy
 
@@ -1050,6 +1919,9 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
         elif in_args.in_place:
             _in_place(str(_phylobuddy), in_args.trees[0])
 
+        elif isinstance(_phylobuddy.trees, TreeStream):
+            _phylobuddy.write(sys.stdout)
+
         else:
             _stdout("{0}\n".format(str(_phylobuddy).rstrip()))
 
@@ -1082,10 +1954,28 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
                     break
             if re_raise:
                 raise _err
+        if getattr(in_args, "batch_job", False):
+            raise _err  # br.run_batch() reports the error against the file being processed
         _stderr("{0}: {1}\n".format(_err.__class__.__name__, str(_err)), in_args.quiet)
         _exit(_tool)
 
     # ############################################## COMMAND LINE LOGIC ############################################## #
+    # Batch mode
+    if in_args.batch:
+        def _build(file_path):
+            if in_args.generate_tree:  # Alignments are read by the generate_tree block
+                return []
+            return PhyloBuddy(file_path, in_args.in_format, in_args.out_format)
+
+        try:
+            results = br.run_batch(in_args, "trees", command_line_ui, _build, br.pb_flags, in_args.out_dir)
+        except ValueError as e:
+            _raise_error(e, "batch")
+            return
+        br.batch_report(results, in_args.quiet)
+        _exit("batch")
+        return
+
     # Consensus tree
     if in_args.consensus_tree:
         frequency = in_args.consensus_tree[0]
@@ -1094,7 +1984,14 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
             _stderr("Warning: The frequency value should be between 0 and 1. Defaulting to 0.5.\n\n")
             frequency = 0.5
 
-        _print_trees(consensus_tree(phylobuddy, frequency))
+        if in_args.burnin or in_args.thin:
+            try:
+                _print_trees(consensus_tree_stream(in_args.trees, frequency, in_args.burnin or 0, in_args.thin or 1,
+                                                   in_args.in_format))
+            except (ValueError, br.GuessError) as e:
+                _raise_error(e, "consensus_tree")
+        else:
+            _print_trees(consensus_tree(phylobuddy, frequency))
         _exit("consensus_tree")
 
     # Display trees
@@ -1102,6 +1999,8 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
         try:
             display_trees(phylobuddy)
         except SystemError:
+            if getattr(in_args, "batch_job", False):
+                raise
             _stderr("Error: Your system is non-graphical, so display_trees can not work. "
                     "Please use print_trees instead.")
         _exit("display_trees")
@@ -1114,11 +2013,11 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
             output = distance(phylobuddy)
 
         _stderr('Tree 1\tTree 2\tValue\n')
-        keypairs = []
+        keypairs = set()
         for key1 in output:
             for key2 in output[key1]:
                 if (key2, key1) not in keypairs:
-                    keypairs.append((key1, key2))
+                    keypairs.add((key1, key2))
                     _stdout('{0}\t{1}\t{2}\n'.format(key1, key2, output[key1][key2]))
         _exit("distance")
 
@@ -1169,8 +2068,20 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
         params = None if not in_args.generate_tree else in_args.generate_tree[0]
         generated_trees = None
         try:
-            generated_trees = generate_tree(alignbuddy, phylo_program, params, in_args.keep_temp, quiet=in_args.quiet)
-        except (FileExistsError, AttributeError, ProcessLookupError, RuntimeError) as e:
+            # Several alignments are built in parallel, and -od keeps finished trees so the batch can be resumed
+            if (len(alignbuddy.alignments) > 1 or in_args.out_dir) and not in_args.keep_temp:
+                generated_trees, report = generate_tree_batch(alignbuddy, phylo_program, params,
+                                                              resume_dir=in_args.out_dir, quiet=in_args.quiet)
+                for name, status, seconds, detail in report:
+                    if status != "ok":
+                        _stderr("# %s failed: %s\n" % (name, detail), in_args.quiet)
+                if not generated_trees:
+                    _raise_error(RuntimeError("Error: {0} failed to generate a tree.".format(phylo_program)),
+                                 "generate_tree")
+            else:
+                generated_trees = generate_tree(alignbuddy, phylo_program, params, in_args.keep_temp,
+                                                quiet=in_args.quiet)
+        except (FileExistsError, AttributeError, ProcessLookupError, RuntimeError, ValueError) as e:
             _raise_error(e, "generate_tree")
         except FileNotFoundError as e:
             _raise_error(e, "generate_tree", "Error: {0} failed to generate a tree.".format(phylo_program))
@@ -1212,6 +2123,9 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
             else:
                 raise e
 
+        if isinstance(phylobuddy.trees, TreeStream):  # The hash map is only filled in as the trees are written
+            _print_trees(phylobuddy)
+
         hash_table = "##### Hash table #####\n"
         for indx, tree_map in enumerate(phylobuddy.hash_map):
             if len(phylobuddy.hash_map) > 1:
@@ -1221,7 +2135,8 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
             hash_table += "\n"
         hash_table = "%s\n######################\n\n" % hash_table.strip()
         _stderr(hash_table, in_args.quiet)
-        _print_trees(phylobuddy)
+        if not isinstance(phylobuddy.trees, TreeStream):
+            _print_trees(phylobuddy)
         _exit("hash_ids")
 
     # List ids
@@ -1291,6 +2206,8 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
     # Screw formats
     if in_args.screw_formats:
         if in_args.screw_formats not in OUTPUT_FORMATS:
+            if getattr(in_args, "batch_job", False):
+                raise AttributeError("unknown format '%s'" % in_args.screw_formats)
             _stderr("Error: unknown format '%s'\n" % in_args.screw_formats)
         else:
             phylobuddy.out_format = in_args.screw_formats
@@ -1331,19 +2248,29 @@ def command_line_ui(in_args, phylobuddy, skip_exit=False):
         _print_trees(phylobuddy)
         _exit("unroot")
 
-if __name__ == '__main__':
+
+def main():
     initiation = []
     try:
         initiation = argparse_init()  # initiation = [in_agrs, phylobuddy]
-        command_line_ui(*initiation)
+        if br.PROFILER:
+            br.PROFILER.run_tool(command_line_ui, *initiation)
+        else:
+            command_line_ui(*initiation)
     except (KeyboardInterrupt, br.GuessError) as _e:
         print(_e)
     except SystemExit:
         pass
     except Exception as _e:
         function = ""
-        for next_arg in vars(initiation[0]):
+        for next_arg in vars(initiation[0]) if initiation else []:
             if getattr(initiation[0], next_arg) and next_arg in br.pb_flags:
                 function = next_arg
                 break
         br.send_traceback("PhyloBuddy", function, _e)
+    finally:
+        br.stop_profiler()
+
+
+if __name__ == '__main__':
+    main()
@@ -39,9 +39,10 @@ import sys
 import os
 import re
 import string
-import zipfile
+import mmap
+import pickle
+import shlex
 import shutil
-from urllib import request, error
 from copy import deepcopy
 from random import sample, choice, randint, random
 from math import floor, ceil, log
@@ -50,15 +51,17 @@ from shutil import which
 from hashlib import md5
 from io import StringIO, TextIOWrapper
 from collections import OrderedDict
+from array import array
+from itertools import accumulate
+from operator import add
 from xml.sax import SAXParseException
 
 # Third party
 sys.path.insert(0, "./")  # For stand alone executable, where dependencies are packaged with BuddySuite
 from Bio import SeqIO
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from Bio.SeqFeature import SeqFeature, FeatureLocation, CompoundLocation
 from Bio.SeqRecord import SeqRecord
-from Bio.Restriction import *
-from Bio.SeqUtils.ProtParam import ProteinAnalysis
 from Bio.Seq import Seq
 from Bio.Alphabet import IUPAC
 from Bio.Data import CodonTable
@@ -111,13 +114,10 @@ def incremental_rename(query, replace):
     x = (query, replace)
     return x
 
-# - Allow batch calls. E.g., if 6 files are fed in as input, run the SeqBuddy command independently on each
 # - Add support for selecting individual sequences to modify (as a global ability for any tool)
 # - Add FASTQ support... More generally, support letter annotation mods
 # - Get BuddySuite into PyPi
-# - Check on memory requirements before execution
 # - Execution timer, for long running jobs
-# - Sort out a good way to manage 'lazy' imports (might not be that important)
 
 # ###################################################### GLOBALS ##################################################### #
 VERSION = br.Version("SeqBuddy", 1, 1, br.contributors)
@@ -125,10 +125,27 @@ OUTPUT_FORMATS = ["ids", "accessions", "summary", "full-summary", "clustal", "em
                   "fastq-solexa", "fastq-illumina", "genbank", "gb", "imgt", "nexus", "phd", "phylip", "phylip-relaxed",
                   "phylipss", "phylipsr", "raw", "seqxml", "sff", "stockholm", "tab", "qual"]
 
+# Files larger than PARALLEL_PARSE_SIZE bytes, in one of PARALLEL_FORMATS, are parsed on multiple cores
+PARALLEL_FORMATS = ["fasta", "fastq", "fastq-sanger", "fastq-solexa", "fastq-illumina"]
+PARALLEL_PARSE_SIZE = 52428800
+
+# These commands work straight off a SeqIndex when given a single file of at least INDEX_FILE_SIZE bytes, so the
+# records are never all held in memory. Smaller files are just parsed, so no .sbi file is left next to them.
+INDEX_COMMANDS = ["ave_seq_length", "delete_records", "extract_regions", "list_ids", "num_seqs", "pull_records"]
+INDEX_FILE_SIZE = 52428800
+
+# Pre-flight estimates (see estimate_resources()) parse this many characters from the start of the input file
+ESTIMATE_SAMPLE_SIZE = 1048576
+
+# Quality scores are stored as array('B') (array('b') for Solexa), not lists of ints
+# {format: (letter_annotations key, ASCII offset, min score, max score)}
+FASTQ_ENCODINGS = {"fastq": ("phred_quality", 33, 0, 93), "fastq-sanger": ("phred_quality", 33, 0, 93),
+                   "fastq-illumina": ("phred_quality", 64, 0, 62), "fastq-solexa": ("solexa_quality", 64, -5, 62)}
+
 
 # ##################################################### SEQBUDDY ##################################################### #
 class SeqBuddy(object):  # Open a file or read a handle and parse, or convert raw into a Seq object
-    def __init__(self, sb_input, in_format=None, out_format=None, alpha=None):
+    def __init__(self, sb_input, in_format=None, out_format=None, alpha=None, index=False):
         # ####  IN AND OUT FORMATS  #### #
         # Holders for input type. Used for some error handling below
         in_handle = None
@@ -136,6 +153,19 @@ class SeqBuddy(object):  # Open a file or read a handle and parse, or convert ra
         in_file = None
         self.alpha = alpha
         self.hash_map = {}  # This is only used by functions that use hash_id()
+        self._records = None
+        self.index = None  # SeqIndex object, only used if index=True and sb_input is an indexable file
+        self.packed = None  # List of [PackedSeq, id, name, description, extra], only used after pack() is called
+
+        # Indexed files are not parsed up front; records are pulled off the disk as they are needed
+        if index and type(sb_input) == str and os.path.isfile(sb_input):
+            seq_index = SeqIndex(sb_input, in_format)
+            if seq_index.format:
+                self.index = seq_index
+                self.in_format = seq_index.format
+                self.out_format = self.in_format if not out_format else out_format
+                self._set_alpha(seq_index.get_records(seq_index.entries[:50]))
+                return
 
         # SeqBuddy obj
         if type(sb_input) == SeqBuddy:
@@ -147,7 +177,7 @@ class SeqBuddy(object):  # Open a file or read a handle and parse, or convert ra
                 temp = StringIO(sb_input.read())
                 sb_input = temp
             sb_input.seek(0)
-            in_handle = sb_input.read()
+            in_handle = sb_input.read(50)  # Only needed for the GuessError message
             sb_input.seek(0)
 
         # Raw sequences
@@ -220,8 +250,23 @@ class SeqBuddy(object):  # Open a file or read a handle and parse, or convert ra
                 sequences = []
                 for align in aligns:
                     sequences += [rec for rec in align]
+
+            elif self.in_format in PARALLEL_FORMATS and isinstance(sb_input, StringIO) \
+                    and len(sb_input.getvalue()) > PARALLEL_PARSE_SIZE:
+                # Piped input, so spool it to disk where it can be split into chunks
+                tmp_file = MyFuncs.TempFile()
+                tmp_file.write(sb_input.getvalue())
+                sequences = _parse_parallel(tmp_file.path, self.in_format)
+
+            elif self.in_format in PARALLEL_FORMATS and os.path.isfile(getattr(sb_input, "name", "")) \
+                    and os.path.getsize(sb_input.name) > PARALLEL_PARSE_SIZE:
+                sequences = _parse_parallel(sb_input.name, self.in_format)
             else:
-                sequences = list(SeqIO.parse(sb_input, self.in_format))
+                sequences = _parse_records(sb_input, self.in_format)
+
+        elif self.in_format in PARALLEL_FORMATS and os.path.isfile(sb_input) \
+                and os.path.getsize(sb_input) > PARALLEL_PARSE_SIZE:
+            sequences = _parse_parallel(sb_input, self.in_format)
 
         elif os.path.isfile(sb_input):
             with open(sb_input, "r") as sb_input:
@@ -232,10 +277,35 @@ class SeqBuddy(object):  # Open a file or read a handle and parse, or convert ra
                     for align in aligns:
                         sequences += [rec for rec in align]
                 else:
-                    sequences = list(SeqIO.parse(sb_input, self.in_format))
+                    sequences = _parse_records(sb_input, self.in_format)
         else:
             sequences = [SeqRecord(Seq(sb_input))]  # may be unreachable?
 
+        self._set_alpha(sequences)
+
+        for seq in sequences:
+            seq.seq.alphabet = self.alpha
+
+        # The NEXUS parser adds '.copy' to any repeat taxa, strip that off...
+        if self.in_format == "nexus":
+            for rec in sequences:
+                rec.id = re.sub("\.copy[0-9]*$", "", rec.id)
+
+        self.records = sequences
+
+    @property
+    def records(self):
+        if self.index_only():
+            self._records = self.index_records()
+        elif self.packed_only():
+            self._records = self.unpack()
+        return self._records
+
+    @records.setter
+    def records(self, sequences):
+        self._records = sequences
+
+    def _set_alpha(self, sequences):
         if self.alpha is None:
             self.alpha = _guess_alphabet(sequences)
         elif self.alpha in ['protein', 'prot', 'p', 'pep', IUPAC.protein]:
@@ -247,16 +317,74 @@ class SeqBuddy(object):  # Open a file or read a handle and parse, or convert ra
         else:
             _stderr("WARNING: Alphabet not recognized. Correct alphabet will be guessed.\n")
             self.alpha = _guess_alphabet(sequences)
+        return
 
+    def index_only(self):
+        """
+        :return: True if the records are still on disk behind a SeqIndex (i.e., nothing has been parsed yet)
+        """
+        return self._records is None and self.index is not None
+
+    def index_records(self, entries=None):
+        """
+        Parse records out of the indexed file
+        :param entries: List of SeqIndex entries (all records if None)
+        :return: List of SeqRecord objects
+        """
+        sequences = self.index.get_records(entries)
         for seq in sequences:
             seq.seq.alphabet = self.alpha
-
-        # The NEXUS parser adds '.copy' to any repeat taxa, strip that off...
-        if self.in_format == "nexus":
-            for rec in sequences:
-                rec.id = re.sub("\.copy[0-9]*$", "", rec.id)
-
-        self.records = sequences
+        return sequences
+
+    def packed_only(self):
+        """
+        :return: True if the sequences are held as PackedSeq objects (i.e., nothing has been unpacked yet)
+        """
+        return self._records is None and self.packed is not None
+
+    def pack(self):
+        """
+        Move nucleotide sequences into 2-bit PackedSeq storage. They are unpacked the next time self.records is used,
+        although some functions (e.g., complement(), reverse_complement(), num_seqs()) work on the packed sequences.
+        :return: The packed SeqBuddy object
+        """
+        if self.alpha == IUPAC.protein:
+            raise TypeError("Nucleic acid sequence required, not protein.")
+        packed = []
+        for rec in self.records:
+            extra = None
+            if rec.features or rec.annotations or rec.dbxrefs or rec.letter_annotations:
+                # Keep everything but the sequence in a SeqRecord shell
+                letter_annotations = dict(rec.letter_annotations)
+                rec.letter_annotations = {}
+                seq = rec.seq
+                rec.seq = Seq("", alphabet=seq.alphabet)
+                extra = [rec, letter_annotations]
+            else:
+                seq = rec.seq
+            packed.append([PackedSeq(seq), rec.id, rec.name, rec.description, extra])
+        self.packed = packed
+        self._records = None
+        self.index = None
+        return self
+
+    def unpack(self):
+        """
+        Convert PackedSeq storage back into SeqRecords
+        :return: List of SeqRecord objects
+        """
+        sequences = []
+        for packed_seq, rec_id, name, description, extra in self.packed:
+            seq = packed_seq.to_seq(self.alpha)
+            if extra:
+                rec, letter_annotations = extra
+                rec.seq = seq
+                rec.letter_annotations = letter_annotations
+            else:
+                rec = SeqRecord(seq, id=rec_id, name=name, description=description)
+            sequences.append(rec)
+        self.packed = None
+        return sequences
 
     def to_dict(self):
         sb_copy = find_repeats(make_copy(self))
@@ -429,6 +557,8 @@ def _download_blast_binaries(blastn=True, blastp=True, blastdcmd=True, **kwargs)
                     'Linux_blastp64.zip': 'blastp', 'Win32_blastdbcmd.zip': 'blastdbcmd.exe',
                     'Win32_blastn.zip': 'blastn.exe', 'Win32_blastp.zip': 'blastp.exe'}
 
+    import zipfile
+    from urllib import request, error
     os.makedirs("{0}/__tempdir__".format(current_path), exist_ok=True)
     try:
         for blast_bin in bins_to_dl:
@@ -676,6 +806,88 @@ def _guess_format(_input):
         raise br.GuessError("Unsupported _input argument in guess_format(). %s" % _input)
 
 
+def _parse_fastq(handle, in_format="fastq"):
+    """
+    Bio.SeqIO's FASTQ parsers store quality scores as lists of Python ints (~28 bytes per base). This uses the same
+    record splitting (FastqGeneralIterator), but converts each quality string with a single bytes.translate() and
+    stores the scores as array('B') (or array('b') for Solexa scores, which can be negative).
+    :param handle: Open text handle
+    :param in_format: Any of FASTQ_ENCODINGS
+    :return: List of SeqRecord objects
+    """
+    key, offset, min_score, max_score = FASTQ_ENCODINGS[in_format]
+    # Invalid characters are mapped to 127, which is out of range for every encoding
+    translation = bytes([(char - offset) & 0xFF if min_score <= char - offset <= max_score else 127
+                         for char in range(256)])
+    typecode = "b" if min_score < 0 else "B"
+    records = []
+    for title, seq, qual in FastqGeneralIterator(handle):
+        rec_id = title.split()[0] if title.strip() else ""  # A bare '@' header gives an empty id, as in Bio.SeqIO
+        rec = SeqRecord(Seq(seq), id=rec_id, name=rec_id, description=title)
+        scores = qual.encode().translate(translation)
+        if 127 in scores:
+            raise ValueError("Invalid character in quality string")
+        rec.letter_annotations[key] = array(typecode, scores)
+        records.append(rec)
+    return records
+
+
+def _parse_records(handle, in_format):
+    """
+    :param handle: Open text handle
+    :param in_format: Any format supported by Bio.SeqIO
+    :return: List of SeqRecord objects
+    """
+    if in_format in FASTQ_ENCODINGS:
+        return _parse_fastq(handle, in_format)
+    return list(SeqIO.parse(handle, in_format))
+
+
+def _phred_scores(rec):
+    """
+    :param rec: SeqRecord
+    :return: Phred quality scores as array('B'), or None if the record doesn't have any quality scores
+    """
+    if "phred_quality" in rec.letter_annotations:
+        scores = rec.letter_annotations["phred_quality"]
+        return scores if isinstance(scores, array) and scores.typecode == "B" else array("B", scores)
+    if "solexa_quality" in rec.letter_annotations:
+        scores = array("b", rec.letter_annotations["solexa_quality"]).tobytes()
+        return array("B", scores.translate(_SOLEXA_TO_PHRED))
+    return None
+
+
+def _quality_tables():
+    # Phred <--> Solexa conversion tables for bytes.translate(). Solexa scores are signed bytes.
+    solexa_to_phred = bytearray(256)
+    for solexa in range(-128, 128):
+        solexa_to_phred[solexa & 0xFF] = int(round(10 * log(10 ** (max(solexa, -5) / 10.) + 1, 10)))
+    phred_to_solexa = bytearray(256)
+    for phred in range(256):
+        solexa = max(-5., 10 * log(10 ** (phred / 10.) - 1, 10)) if phred else -5.
+        phred_to_solexa[phred] = min(62, int(round(solexa))) & 0xFF
+    return bytes(solexa_to_phred), bytes(phred_to_solexa)
+
+
+_SOLEXA_TO_PHRED, _PHRED_TO_SOLEXA = _quality_tables()
+
+
+def _update_seq(rec, seq, letter_annotations=None):
+    """
+    Swap a new sequence into a SeqRecord. BioPython will not replace the sequence while per-letter annotations
+    (e.g., FASTQ quality scores) are set, so these are cleared and then replaced with letter_annotations.
+    :param rec: SeqRecord
+    :param seq: Seq object
+    :param letter_annotations: dict of new per-letter annotations (same length as seq)
+    :return: SeqRecord
+    """
+    rec.letter_annotations = {}
+    rec.seq = seq
+    if letter_annotations:
+        rec.letter_annotations = letter_annotations
+    return rec
+
+
 def make_copy(seqbuddy):
     """
     Deepcopy a SeqBuddy object. The alphabet objects are not handled properly when deepcopy is called,
@@ -683,6 +895,11 @@ def make_copy(seqbuddy):
     :param seqbuddy: SeqBuddy object
     :return: SeqBuddy object
     """
+    if seqbuddy.index_only() or seqbuddy.packed_only():  # Don't load/unpack every record just to copy them
+        _copy = deepcopy(seqbuddy)
+        _copy.alpha = seqbuddy.alpha
+        return _copy
+
     alphabet_list = [rec.seq.alphabet for rec in seqbuddy.records]
     _copy = deepcopy(seqbuddy)
     _copy.alpha = seqbuddy.alpha
@@ -691,6 +908,550 @@ def make_copy(seqbuddy):
     return _copy
 
 
+def _chunk_file(file_path, in_format, num_chunks):
+    """
+    Find byte offsets that split a FASTA/FASTQ file into runs of whole records
+    :param file_path: Sequence file
+    :param in_format: 'fasta' or one of the fastq variants (four line records only)
+    :param num_chunks: Target number of chunks
+    :return: List of [start, end] byte offsets, or None if the file can't be split safely
+    """
+    size = os.path.getsize(file_path)
+    fastq = in_format != "fasta"
+    starts = [0]
+    with open(file_path, "rb") as ifile:
+        if fastq:  # Only four line FASTQ can be split unambiguously ('@' and '+' can both start a quality line)
+            lines = [ifile.readline() for _ in range(5)]
+            if not lines[0].startswith(b"@") or not lines[2].startswith(b"+") \
+                    or len(lines[1].strip()) != len(lines[3].strip()) or lines[4][:1] not in [b"@", b""]:
+                return None
+
+        for indx in range(1, num_chunks):
+            target = max(size * indx // num_chunks, starts[-1] + 1)
+            if not fastq:
+                pos = target - 1
+                while True:
+                    ifile.seek(pos)
+                    block = ifile.read(1048576)
+                    found = block.find(b"\n>")
+                    if found != -1 or len(block) < 2:
+                        break
+                    pos += len(block) - 1  # Overlap by one byte in case the '\n>' straddles two blocks
+                if found == -1:
+                    break
+                starts.append(pos + found + 1)
+                continue
+
+            ifile.seek(target - 1)
+            ifile.readline()  # Skip to the start of the next line
+            offsets, lines = [], []
+            for _ in range(8):
+                offsets.append(ifile.tell())
+                lines.append(ifile.readline())
+            for i in range(4):
+                if lines[i].startswith(b"@") and lines[i + 2].startswith(b"+") \
+                        and len(lines[i + 1].strip()) == len(lines[i + 3].strip()):
+                    starts.append(offsets[i])
+                    break
+    return [[start, end] for start, end in zip(starts, starts[1:] + [size])]
+
+
+def _parse_parallel(file_path, in_format, max_processes=0):
+    """
+    Split a large FASTA/FASTQ file at record boundaries and parse the chunks on separate cores. The records come back
+    in file order, so the result is the same as list(SeqIO.parse()).
+    :param file_path: Sequence file
+    :param in_format: Any of PARALLEL_FORMATS
+    :param max_processes: Number of worker processes (0 means use MyFuncs.usable_cpu_count())
+    :return: List of SeqRecords
+    """
+    def mc_parse(chunk, args):
+        _file_path, _in_format, out_dir = args
+        indx, start, end = chunk
+        with open(_file_path, "rb") as _ifile:
+            _ifile.seek(start)
+            contents = _ifile.read(end - start).decode("utf-8")
+        records = _parse_records(StringIO(contents), _in_format)
+        with open("%s/%s.pkl.tmp" % (out_dir, indx), "wb") as _ofile:
+            pickle.dump(records, _ofile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename("%s/%s.pkl.tmp" % (out_dir, indx), "%s/%s.pkl" % (out_dir, indx))
+        return
+
+    max_processes = MyFuncs.usable_cpu_count() if not max_processes else max_processes
+    chunks = _chunk_file(file_path, in_format, max_processes) if max_processes > 1 else None
+    if not chunks or len(chunks) == 1:
+        with open(file_path, "r", encoding="utf-8") as ifile:
+            return _parse_records(ifile, in_format)
+
+    tmp_dir = MyFuncs.TempDir()
+    chunks = [[indx] + chunk for indx, chunk in enumerate(chunks)]
+    MyFuncs.run_multicore_function(chunks, mc_parse, [file_path, in_format, tmp_dir.path],
+                                   max_processes=max_processes, quiet=True)
+    sequences = []
+    for indx in range(len(chunks)):
+        if not os.path.isfile("%s/%s.pkl" % (tmp_dir.path, indx)):
+            # A worker failed, so re-parse in this process to raise the error properly
+            with open(file_path, "r", encoding="utf-8") as ifile:
+                return _parse_records(ifile, in_format)
+        with open("%s/%s.pkl" % (tmp_dir.path, indx), "rb") as ifile:
+            sequences += pickle.load(ifile)
+    return sequences
+
+
+def _sample_records(sample, in_format):
+    # Trim a partial file down to its last complete record. Returns an empty string if the format can't be trimmed.
+    if in_format == "fasta":
+        return sample[:sample.rfind("\n>") + 1] if "\n>" in sample else ""
+    elif in_format in ["genbank", "gb", "embl"]:
+        return sample[:sample.rfind("\n//") + 4] if "\n//" in sample else ""
+    elif in_format in FASTQ_ENCODINGS:
+        lines = sample.split("\n")[:-1]
+        return "".join(["%s\n" % line for line in lines[:len(lines) - (len(lines) % 4)]])
+    return ""
+
+
+def estimate_resources(file_path, command, in_format=None, tool="SeqBuddy"):
+    """
+    Predict the peak memory and run time of a command line call from a sample of its input file. The first
+    ESTIMATE_SAMPLE_SIZE characters are parsed, the record, residue, and feature counts are scaled up to the size of the
+    whole file, and the result is run through the cost model for the command (see br.COST_MODELS).
+    :param file_path: Input file
+    :param command: Name of the command line flag (e.g., 'translate6frames')
+    :param in_format: Format of the file (guessed if not given)
+    :param tool: 'SeqBuddy' or 'AlignBuddy', selects the cost model
+    :return: OrderedDict with file, command, records, residues, features, memory_mb, and seconds
+    """
+    in_format = in_format if in_format else _guess_format(file_path)
+    if not in_format:
+        raise br.GuessError("Could not determine format from input file '%s'.\n"
+                            "Try explicitly setting with -f flag." % file_path)
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "r") as ifile:
+        sample = ifile.read(ESTIMATE_SAMPLE_SIZE)
+        if ifile.read(1):
+            sample = _sample_records(sample, in_format)
+
+    records, residues, features = 0, 0, 0
+    sample_size = len(sample.encode())
+    if sample_size:
+        try:
+            sample = SeqBuddy(StringIO(sample), in_format).records
+            records = len(sample)
+            residues = sum([len(rec.seq) for rec in sample])
+            features = sum([len(rec.features) for rec in sample])
+        except (br.GuessError, ValueError, TypeError):
+            records = 0
+    if records:
+        scale = file_size / sample_size
+        records, residues, features = [int(x * scale) for x in [records, residues, features]]
+    else:  # The sample couldn't be parsed, so fall back on one residue per byte
+        residues = file_size
+
+    models = br.cost_models()[tool]
+    indexed = tool == "SeqBuddy" and command in INDEX_COMMANDS and file_size >= INDEX_FILE_SIZE
+    load = models["index"] if indexed else models["load"]
+    cost = models.get(command, models["default"])
+    units = residues + 200 * records + 500 * features
+    memory = models["startup"][0] + units * (load[0] + cost[0]) / 1048576
+    seconds = models["startup"][1] + units * (load[1] + cost[1])
+    return OrderedDict([("file", file_path), ("command", command), ("records", records), ("residues", residues),
+                        ("features", features), ("memory_mb", round(memory, 1)), ("seconds", round(seconds, 1))])
+
+
+class SeqIndex(object):
+    """
+    Side-car index (similar to samtools faidx .fai files) that allows random access to the records in large
+    FASTA/FASTQ/GenBank/EMBL files. The index is written next to the sequence file as '<file>.sbi' the first time it is
+    needed, and re-used for as long as the size and modification time of the sequence file are unchanged.
+    Each entry is a list: [id, name, description, offset, length, seq_offset, seq_bytes, seq_len, line_bases, line_bytes]
+    line_bases/line_bytes are only set if every sequence line (except the last) is the same length, in which case
+    subsequences can be fetched without reading the whole record.
+    """
+    index_formats = {"fasta": "fasta", "fastq": "fastq", "fastq-sanger": "fastq", "gb": "genbank",
+                     "genbank": "genbank", "embl": "embl"}
+    header = "#SeqBuddy index v1"
+
+    def __init__(self, file_path, in_format=None):
+        self.file_path = os.path.abspath(file_path)
+        self.index_path = "%s.sbi" % self.file_path
+        stats = os.stat(self.file_path)
+        self.file_stamp = [str(stats.st_size), str(stats.st_mtime_ns)]
+        self.format = None
+        self.entries = []
+        self._map = None
+
+        if self._read_index(in_format):
+            return
+
+        if not in_format:
+            with open(self.file_path, "r", encoding="utf-8", errors="replace") as ifile:
+                head = ifile.read(1048576)
+            in_format = _guess_format(StringIO(head)) if head else None
+
+        if in_format not in self.index_formats:
+            return  # Caller should fall back on parsing the whole file
+
+        self.format = in_format
+        if self.index_formats[in_format] in ["fasta", "fastq"]:
+            self._build_flat()
+        else:
+            self._build_flatfile_db()
+        self._write_index()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __deepcopy__(self, memo):
+        return self  # Read-only, so copies of a SeqBuddy object can share it
+
+    def _read_index(self, in_format):
+        if not os.path.isfile(self.index_path):
+            return False
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as ifile:
+                header = ifile.readline().rstrip("\n").split("\t")
+                if header[0] != self.header or header[2:4] != self.file_stamp:
+                    return False
+                if in_format and in_format != header[1]:
+                    return False
+                entries = []
+                for line in ifile:
+                    line = line.rstrip("\n").split("\t", 9)
+                    entries.append(line[7:10] + [int(x) for x in line[:7]])
+        except (OSError, ValueError, IndexError):
+            return False
+        self.format = header[1]
+        self.entries = entries
+        return True
+
+    def _write_index(self):
+        try:
+            with open(self.index_path, "w", encoding="utf-8") as ofile:
+                ofile.write("%s\t%s\t%s\n" % (self.header, self.format, "\t".join(self.file_stamp)))
+                for entry in self.entries:
+                    ofile.write("%s\t%s\t%s\t%s\n" % ("\t".join([str(x) for x in entry[3:]]),
+                                                      entry[0], entry[1], entry[2]))
+        except OSError:  # Read-only location, just keep the index in memory
+            pass
+        return
+
+    def _mmap(self):
+        # The file is mapped read-only on first use and the mapping is kept for the life of the index
+        if self._map is None:
+            with open(self.file_path, "rb") as ifile:
+                self._map = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    @staticmethod
+    def _geometry(mm, start, end):
+        """
+        Measure a block of sequence lines without decoding it
+        :return: [seq_bytes, seq_len, line_bases, line_bytes]
+        """
+        while end > start and mm[end - 1] in b" \t\r\n":  # Trailing white space and blank lines
+            end -= 1
+        block = mm[start:end]
+        if not block:
+            return [0, 0, 0, 0]
+        newlines = block.count(b"\n")
+        white_space = block.count(b"\r") + block.count(b" ") + block.count(b"\t")
+        seq_len = len(block) - newlines - white_space
+
+        line_end = block.find(b"\n")
+        line_bytes = line_end + 1 if line_end != -1 else len(block) + 1
+        line_bases = len(block[:line_bytes - 1].rstrip(b"\r"))
+        crlf = line_bytes - line_bases == 2
+        # Offsets can only be calculated if every line (except the last) is the same length and there is no white
+        # space inside of the sequence
+        if white_space != (newlines if crlf else 0) \
+                or block[line_bytes - 1::line_bytes].count(b"\n") != newlines \
+                or (crlf and block[line_bytes - 2::line_bytes].count(b"\r") != newlines) \
+                or not 0 < len(block) - newlines * line_bytes <= line_bases:
+            line_bases, line_bytes = 0, 0
+        return [len(block), seq_len, line_bases, line_bytes]
+
+    def _build_flat(self):
+        # FASTA and FASTQ records are delimited with bytes.find() over a memory map of the file, so nothing is parsed
+        # into SeqRecords and the sequences are never decoded
+        if self.file_stamp[0] == "0":
+            self.entries = []
+            return
+        mm = self._mmap()
+        size = len(mm)
+        entries = []
+        if self.index_formats[self.format] == "fasta":
+            start = 0 if mm[:1] == b">" else mm.find(b"\n>") + 1
+            if start == 0 and mm[:1] != b">":
+                start = size
+            while start < size:
+                title_end = mm.find(b"\n", start)
+                title_end = size if title_end == -1 else title_end
+                next_rec = mm.find(b"\n>", title_end)
+                end = size if next_rec == -1 else next_rec + 1
+                seq_offset = min(title_end + 1, size)
+                title = mm[start + 1:title_end].decode("utf-8").rstrip()
+                seq_id = title.split(None, 1)[0] if title else ""
+                entries.append([seq_id, seq_id, title, start, end - start, seq_offset] +
+                               self._geometry(mm, seq_offset, end))
+                start = end
+
+        else:
+            start = 0
+            while start < size:
+                title_end = mm.find(b"\n", start)
+                title_end = size if title_end == -1 else title_end
+                if mm[start:start + 1] != b"@":  # Junk between records
+                    start = title_end + 1
+                    continue
+                plus = mm.find(b"\n+", title_end)
+                if plus == -1:  # Truncated record
+                    break
+                seq_offset = title_end + 1
+                geometry = self._geometry(mm, seq_offset, plus + 1)
+
+                # Quality scores can wrap over multiple lines, and may start with '@' or '+', so count them off
+                end = mm.find(b"\n", plus + 1)
+                end = size if end == -1 else end + 1
+                qual_len = 0
+                while qual_len < geometry[1] and end < size:
+                    line_end = mm.find(b"\n", end)
+                    line_end = size if line_end == -1 else line_end + 1
+                    qual_len += len(mm[end:line_end].strip())
+                    end = line_end
+                if qual_len < geometry[1]:  # Truncated record
+                    break
+
+                title = mm[start + 1:title_end].decode("utf-8").rstrip()
+                seq_id = title.split(None, 1)[0] if title else ""
+                entries.append([seq_id, seq_id, title, start, end - start, seq_offset] + geometry)
+                start = end
+        self.entries = entries
+        return
+
+    def _build_flatfile_db(self):
+        # GenBank and EMBL headers are too irregular to scan safely, so each record is parsed once to build the index
+        entries = []
+        start = None
+        offset = 0
+        chunk = []
+        with open(self.file_path, "rb") as ifile:
+            for line in ifile:
+                if start is None:
+                    if not line.strip():
+                        offset += len(line)
+                        continue
+                    start = offset
+                chunk.append(line)
+                offset += len(line)
+                if line.startswith(b"//"):
+                    rec = SeqIO.read(StringIO(b"".join(chunk).decode("utf-8")), self.format)
+                    entries.append([rec.id, rec.name, rec.description, start, offset - start, 0, 0, len(rec.seq), 0, 0])
+                    start = None
+                    chunk = []
+        self.entries = entries
+        return
+
+    def get_seq(self, entry):
+        """
+        Decode the sequence of a FASTA/FASTQ record
+        :param entry: Index entry
+        :return: str
+        """
+        if not entry[6]:
+            return ""
+        return self._mmap()[entry[5]:entry[5] + entry[6]].translate(None, b" \t\r\n").decode("utf-8")
+
+    def get_records(self, entries=None):
+        """
+        Parse specific records out of the file
+        :param entries: List of index entries (all records if None)
+        :return: List of SeqRecord objects
+        """
+        if self.index_formats[self.format] == "fasta":  # Nothing to parse but the sequence, so skip SeqIO
+            entries = self.entries if entries is None else entries
+            return [SeqRecord(Seq(self.get_seq(entry)), id=entry[0], name=entry[1], description=entry[2])
+                    for entry in entries]
+
+        if entries is None:
+            with open(self.file_path, "r", encoding="utf-8") as ifile:
+                return _parse_records(ifile, self.format)
+
+        records = []
+        with open(self.file_path, "rb") as ifile:
+            for entry in entries:
+                ifile.seek(entry[3])
+                records += _parse_records(StringIO(ifile.read(entry[4]).decode("utf-8")), self.format)
+        return records
+
+    def fetch(self, entry, start, end):
+        """
+        Pull a subsequence out of a FASTA/FASTQ record, reading only the lines that span it
+        :param entry: Index entry
+        :param start: 0-based start position
+        :param end: 0-based end position (exclusive)
+        :return: str
+        """
+        start, end = max(0, start), min(entry[7], end)
+        if start >= end:
+            return ""
+        line_bases, line_bytes = entry[8], entry[9]
+        if line_bases:
+            first = entry[5] + (start // line_bases) * line_bytes + start % line_bases
+            last = entry[5] + ((end - 1) // line_bases) * line_bytes + (end - 1) % line_bases + 1
+            return self._mmap()[first:last].translate(None, b" \t\r\n").decode("utf-8")
+        return self.get_seq(entry)[start:end]
+
+
+class PackedSeq(object):
+    """
+    Compact storage for a nucleotide sequence: 2 bits per base (4 bases per byte) for ACGT (or ACGU), with anything
+    else (ambiguity codes, gaps, etc.) held in a sparse list of runs, and lowercase masking held as a list of
+    [start, end) runs. Packing and unpacking are done with big-int bit twiddling, so there are no per-base Python loops.
+    """
+    __slots__ = ["length", "packed", "exceptions", "lowercase", "rna"]  # Millions of these may be held at once
+
+    iupac_complements = {"A": "T", "C": "G", "G": "C", "T": "A", "U": "A", "R": "Y", "Y": "R", "S": "S", "W": "W",
+                         "K": "M", "M": "K", "B": "V", "V": "B", "D": "H", "H": "D", "N": "N", "X": "X"}
+    _to_codes = bytes.maketrans(b"ACGTU", b"\x00\x01\x02\x03\x03")
+    _from_codes = {False: bytes.maketrans(b"\x00\x01\x02\x03", b"ACGT"),
+                   True: bytes.maketrans(b"\x00\x01\x02\x03", b"ACGU")}
+    _complement = bytes([byte ^ 0xFF for byte in range(256)])
+    _rev_complement = bytes([sum([(((byte ^ 0xFF) >> (2 * i)) & 3) << (6 - 2 * i) for i in range(4)])
+                             for byte in range(256)])
+    _gc_per_byte = bytes([sum([1 for i in range(4) if (byte >> (2 * i)) & 3 in [1, 2]]) for byte in range(256)])
+
+    def __init__(self, seq=""):
+        """
+        :param seq: Nucleotide sequence (str or Seq)
+        """
+        seq = str(seq)
+        upper = seq.upper()
+        self.length = len(seq)
+        self.rna = "U" in upper and "T" not in upper
+        self.lowercase = [(match.start(), match.end()) for match in re.finditer("[a-z]+", seq)] \
+            if upper != seq else []
+        self.exceptions = [(match.start(), match.end(), match.group(1))
+                           for match in re.finditer("([^ACG%s])\\1*" % ("U" if self.rna else "T"), upper)]
+        codes = (re.sub("[^ACGTU]", "A", upper) if self.exceptions else upper).encode()
+        self.packed = self._pack(codes.translate(self._to_codes))
+
+    @staticmethod
+    def _lane_mask(lane, pattern, num_bytes):
+        return int.from_bytes(pattern * (num_bytes // lane), "big")
+
+    def _pack(self, codes):
+        # One code (0-3) per byte in, four codes per byte out
+        if not codes:
+            return b""
+        codes += b"\x00" * (-len(codes) % 4)
+        size = len(codes)
+        val = int.from_bytes(codes, "big")
+        val = (val | (val >> 6)) & self._lane_mask(2, b"\x00\x0f", size)
+        val = (val | (val >> 12)) & self._lane_mask(4, b"\x00\x00\x00\xff", size)
+        return val.to_bytes(size, "big")[3::4]
+
+    def _codes(self):
+        # Inverse of _pack(), returns one code per byte
+        if not self.packed:
+            return b""
+        size = len(self.packed) * 4
+        lanes = bytearray(size)
+        lanes[3::4] = self.packed
+        val = int.from_bytes(lanes, "big")
+        val = (val | (val << 12)) & self._lane_mask(4, b"\x00\x0f\x00\x0f", size)
+        val = (val | (val << 6)) & self._lane_mask(4, b"\x03\x03\x03\x03", size)
+        return val.to_bytes(size, "big")[:self.length]
+
+    def _bases(self):
+        # Upper case bytes, without the exceptions filled in
+        return self._codes().translate(self._from_codes[self.rna])
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.unpack()
+
+    def unpack(self):
+        """
+        :return: The original sequence as a str
+        """
+        seq = self._bases()
+        if self.exceptions or self.lowercase:
+            seq = bytearray(seq)
+            for start, end, char in self.exceptions:
+                seq[start:end] = char.encode() * (end - start)
+            for start, end in self.lowercase:
+                seq[start:end] = seq[start:end].lower()
+        return seq.decode()
+
+    def to_seq(self, alphabet=None):
+        """
+        :param alphabet: Bio.Alphabet object
+        :return: Seq object
+        """
+        return Seq(self.unpack()) if alphabet is None else Seq(self.unpack(), alphabet=alphabet)
+
+    def _new(self, packed, exceptions, lowercase):
+        new_seq = PackedSeq()
+        new_seq.length, new_seq.rna = self.length, self.rna
+        new_seq.packed, new_seq.exceptions, new_seq.lowercase = packed, exceptions, lowercase
+        return new_seq
+
+    def complement(self):
+        """
+        :return: New PackedSeq
+        """
+        exceptions = [(start, end, self.iupac_complements.get(char, char)) for start, end, char in self.exceptions]
+        return self._new(self.packed.translate(self._complement), exceptions, list(self.lowercase))
+
+    def reverse_complement(self):
+        """
+        :return: New PackedSeq
+        """
+        packed = self.packed[::-1].translate(self._rev_complement)
+        padding = -self.length % 4
+        if padding:  # The padding bases are now at the front, so shift everything left
+            size = len(packed)
+            val = (int.from_bytes(packed, "big") << (2 * padding)) & ((1 << (8 * size)) - 1)
+            packed = val.to_bytes(size, "big")
+        exceptions = [(self.length - end, self.length - start, self.iupac_complements.get(char, char))
+                      for start, end, char in self.exceptions[::-1]]
+        lowercase = [(self.length - end, self.length - start) for start, end in self.lowercase[::-1]]
+        return self._new(packed, exceptions, lowercase)
+
+    def gc_content(self):
+        """
+        Percent G, C, and S (G or C) residues. Padding and exception positions are packed as A or T, so they never
+        contribute to the count.
+        :return: float
+        """
+        if not self.length:
+            return 0.
+        gc_counts = self.packed.translate(self._gc_per_byte)
+        count = sum([gc_counts.count(num) * num for num in range(1, 5)])
+        count += sum([end - start for start, end, char in self.exceptions if char == "S"])
+        return count * 100. / self.length
+
+    def kmer_counts(self, k):
+        """
+        Count all overlapping k-mers, skipping any that span an exception (e.g., N). Masking is ignored.
+        :param k: k-mer size
+        :return: dict {k-mer: count}
+        """
+        if k < 1:
+            raise ValueError("k must be a positive integer, not %s" % k)
+        seq = self._bases().decode()
+        counts = {}
+        segment_start = 0
+        for start, end in [(start, end) for start, end, char in self.exceptions] + [(self.length, self.length)]:
+            for indx in range(segment_start, start - k + 1):
+                kmer = seq[indx:indx + k]
+                counts[kmer] = counts.get(kmer, 0) + 1
+            segment_start = end
+        return counts
+
+
 def _stderr(message, quiet=False):
     """
     Send text to stderr
@@ -838,6 +1599,11 @@ def ave_seq_length(seqbuddy, clean=False):
     :param clean: Specifies if non-sequence characters should be counted as well.
     :return: average sequence length (float)
     """
+    if seqbuddy.index_only() and not clean:  # Lengths are already in the index
+        return float(sum([entry[7] for entry in seqbuddy.index.entries])) / len(seqbuddy.index)
+    if seqbuddy.packed_only() and not clean:
+        return float(sum([len(packed[0]) for packed in seqbuddy.packed])) / len(seqbuddy.packed)
+
     if clean:  # Strip out all gaps and stuff before counting
         clean_seq(seqbuddy)
 
@@ -1253,8 +2019,7 @@ def blast(subject, query, **kwargs):
     new_seqs = SeqBuddy("%s/seqs.fa" % tmp_dir.path)
     new_seqs.out_format = subject.out_format
     if query_sb:
-        for _hash, seq_id in query_sb.hash_map.items():
-            rename(new_seqs, _hash, seq_id)
+        br.rename_records_from_map(new_seqs.records, query_sb.hash_map)
     return new_seqs
 
 
@@ -1299,8 +2064,12 @@ def complement(seqbuddy):
     """
     if seqbuddy.alpha == IUPAC.protein:
         raise TypeError("Nucleic acid sequence required, not protein.")
+    if seqbuddy.packed_only():
+        for packed in seqbuddy.packed:
+            packed[0] = packed[0].complement()
+        return seqbuddy
     for rec in seqbuddy.records:
-        rec.seq = rec.seq.complement()
+        _update_seq(rec, rec.seq.complement(), dict(rec.letter_annotations))
     return seqbuddy
 
 
@@ -1336,6 +2105,32 @@ def concat_seqs(seqbuddy, clean=False):
     return seqbuddy
 
 
+def convert_quality(seqbuddy, scheme):
+    """
+    Convert FASTQ quality scores between the Sanger (Phred+33), Illumina 1.3+ (Phred+64), and Solexa (Solexa+64)
+    encodings. Scores are clipped to the range each encoding can hold, and the output format is updated to match.
+    :param seqbuddy: SeqBuddy object
+    :param scheme: {"sanger", "illumina", "solexa"}
+    :return: The modified SeqBuddy object
+    """
+    if scheme not in ["sanger", "illumina", "solexa"]:
+        raise ValueError("Quality scheme must be 'sanger', 'illumina', or 'solexa', not '%s'." % scheme)
+    clip = bytes([min(score, 93 if scheme == "sanger" else 62) for score in range(256)])
+    for rec in seqbuddy.records:
+        scores = _phred_scores(rec)
+        if scores is None:
+            raise TypeError("Quality scores required, but record '%s' does not have any." % rec.id)
+        letter_annotations = OrderedDict([(key, value) for key, value in rec.letter_annotations.items()
+                                          if key not in ["phred_quality", "solexa_quality"]])
+        if scheme == "solexa":
+            letter_annotations["solexa_quality"] = array("b", scores.tobytes().translate(_PHRED_TO_SOLEXA))
+        else:
+            letter_annotations["phred_quality"] = array("B", scores.tobytes().translate(clip))
+        rec.letter_annotations = letter_annotations
+    seqbuddy.out_format = "fastq-%s" % scheme
+    return seqbuddy
+
+
 def count_codons(seqbuddy):
     """
     Generate frequency statistics for codon composition
@@ -1623,6 +2418,24 @@ def delete_large(seqbuddy, max_value):
     return seqbuddy
 
 
+def delete_low_quality(seqbuddy, threshold):
+    """
+    Deletes FASTQ records with a mean Phred quality score below a threshold
+    :param seqbuddy: SeqBuddy object
+    :param threshold: Minimum mean quality score
+    :return: The modified SeqBuddy object
+    """
+    retained_records = []
+    for rec in seqbuddy.records:
+        scores = _phred_scores(rec)
+        if scores is None:
+            raise TypeError("Quality scores required, but record '%s' does not have any." % rec.id)
+        if scores and sum(scores) >= threshold * len(scores):
+            retained_records.append(rec)
+    seqbuddy.records = retained_records
+    return seqbuddy
+
+
 def delete_metadata(seqbuddy):
     """
     Removes all metadata from records
@@ -1650,6 +2463,17 @@ def delete_records(seqbuddy, patterns):
     if type(patterns) != list:
         raise ValueError("'patterns' must be a list or a string.")
 
+    if seqbuddy.index_only():  # Only read the retained records off the disk
+        deleted = set()
+        for pattern in patterns:
+            pattern = re.compile(".*" if pattern == "*" else pattern)
+            for entry in seqbuddy.index.entries:
+                if pattern.search(entry[0]) or pattern.search(entry[1]):
+                    deleted.add(entry[0])
+        seqbuddy.records = seqbuddy.index_records([entry for entry in seqbuddy.index.entries
+                                                   if entry[0] not in deleted])
+        return seqbuddy
+
     retained_records = []
     for pattern in patterns:
         pattern = ".*" if pattern == "*" else pattern
@@ -1762,8 +2586,7 @@ def extract_regions(seqbuddy, positions):
             num = max_len
         return num
 
-    def create_residue_list(_rec, _positions):
-        rec_len = len(_rec.seq)
+    def create_residue_list(rec_len, _positions):
         singlets = []
         for _position in _positions:
             # Singlets
@@ -1814,8 +2637,26 @@ def extract_regions(seqbuddy, positions):
         return singlets
 
     new_records = []
+    if seqbuddy.index_only() and SeqIndex.index_formats[seqbuddy.index.format] == "fasta":
+        # No features or quality scores to remap, so only the lines spanning the requested residues need to be read
+        for entry in seqbuddy.index.entries:
+            new_rec_positions = create_residue_list(entry[7], positions)
+            new_seq = ""
+            if new_rec_positions:
+                offset = new_rec_positions[0]
+                seq = seqbuddy.index.fetch(entry, offset, new_rec_positions[-1] + 1)
+                new_seq = "".join([seq[indx - offset] for indx in new_rec_positions])
+            new_seq = Seq(new_seq, alphabet=seqbuddy.alpha)
+            new_records.append(SeqRecord(new_seq, entry[0], entry[1], entry[2]))
+        return SeqBuddy(new_records, out_format=seqbuddy.out_format)
+
     for rec in seqbuddy.records:
-        new_rec_positions = create_residue_list(rec, positions)
+        new_rec_positions = create_residue_list(len(rec.seq), positions)
+        letter_annotations = {}
+        for key, value in rec.letter_annotations.items():  # E.g., quality scores
+            subset = [value[indx] for indx in new_rec_positions]
+            letter_annotations[key] = array(value.typecode, subset) if isinstance(value, array) else \
+                "".join(subset) if isinstance(value, str) else subset
         new_seq = ""
         if rec.features:  # This is super slow for large records...
             remapper = FeatureReMapper(rec)
@@ -1826,14 +2667,14 @@ def extract_regions(seqbuddy, positions):
                 else:
                     remapper.extend(False)
             new_seq = Seq(new_seq, alphabet=rec.seq.alphabet)
-            new_seq = SeqRecord(new_seq, rec.id, rec.name, rec.description)
+            new_seq = SeqRecord(new_seq, rec.id, rec.name, rec.description, letter_annotations=letter_annotations)
             new_seq = remapper.remap_features(new_seq)
         else:
             seq = str(rec.seq)
             for indx in new_rec_positions:
                 new_seq += seq[indx]
             new_seq = Seq(new_seq, alphabet=rec.seq.alphabet)
-            new_seq = SeqRecord(new_seq, rec.id, rec.name, rec.description)
+            new_seq = SeqRecord(new_seq, rec.id, rec.name, rec.description, letter_annotations=letter_annotations)
 
         new_records.append(new_seq)
 
@@ -2040,6 +2881,7 @@ def find_restriction_sites(seqbuddy, enzyme_group=(), min_cuts=1, max_cuts=None)
     """
     if seqbuddy.alpha == IUPAC.protein:
         raise TypeError("Unable to identify restriction sites in protein sequences.")
+    from Bio.Restriction import RestrictionBatch, CommOnly, AllEnzymes, Analysis
     if max_cuts and min_cuts > max_cuts:
         raise ValueError("min_cuts parameter has been set higher than max_cuts.")
     max_cuts = 1000000000 if not max_cuts else max_cuts
@@ -2108,6 +2950,7 @@ def hash_ids(seqbuddy, hash_length=10):
     :return: The modified SeqBuddy object, with a new attribute `hash_map` added
     """
     hash_list = []
+    used_hashes = set()
     seq_ids = []
 
     try:
@@ -2127,10 +2970,11 @@ def hash_ids(seqbuddy, hash_length=10):
         seq_ids.append(seqbuddy.records[i].id)
         while True:
             new_hash = "".join([choice(string.ascii_letters + string.digits) for _ in range(hash_length)])
-            if new_hash in hash_list:
+            if new_hash in used_hashes:
                 continue
             else:
                 hash_list.append(new_hash)
+                used_hashes.add(new_hash)
                 break
         if re.match(seqbuddy.records[i].id, seqbuddy.records[i].description):
             seqbuddy.records[i].description = seqbuddy.records[i].description[len(seqbuddy.records[i].id) + 1:]
@@ -2185,6 +3029,7 @@ def isoelectric_point(seqbuddy):
     """
     if seqbuddy.alpha is not IUPAC.protein:
         raise TypeError("Protein sequence required, not nucleic acid.")
+    from Bio.SeqUtils.ProtParam import ProteinAnalysis
     isoelectric_points = OrderedDict()
     for rec in seqbuddy.records:
         iso_point = ProteinAnalysis(str(rec.seq))
@@ -2574,6 +3419,10 @@ def num_seqs(seqbuddy):
     :param seqbuddy: SeqBuddy object
     :return: The int number of sequences
     """
+    if seqbuddy.index_only():
+        return len(seqbuddy.index)
+    if seqbuddy.packed_only():
+        return len(seqbuddy.packed)
     return len(seqbuddy.records)
 
 
@@ -2710,13 +3559,15 @@ def pull_record_ends(seqbuddy, amount):
     seq_ends = []
     for rec in seqbuddy.records:
         if amount >= 0:
-            rec.seq = Seq(str(rec.seq)[:amount], alphabet=rec.seq.alphabet)
+            letter_annotations = {key: value[:amount] for key, value in rec.letter_annotations.items()}
+            _update_seq(rec, Seq(str(rec.seq)[:amount], alphabet=rec.seq.alphabet), letter_annotations)
             rec.features = br.shift_features(rec.features, 0, len(str(rec.seq)))
 
         else:
             shift = -1 * (len(str(rec.seq)) + amount) if abs(amount) <= len(str(rec.seq)) else 0
             rec.features = br.shift_features(rec.features, shift, len(str(rec.seq)))
-            rec.seq = rec.seq[amount:]
+            letter_annotations = {key: value[amount:] for key, value in rec.letter_annotations.items()}
+            _update_seq(rec, rec.seq[amount:], letter_annotations)
 
         seq_ends.append(rec)
 
@@ -2738,6 +3589,15 @@ def pull_recs(seqbuddy, regex, description=False):
         regex[indx] = ".*" if pattern == "*" else pattern
 
     regex = "|".join(regex)
+    if seqbuddy.index_only():  # Only read the matching records off the disk
+        regex = re.compile(regex)
+        matched_entries = []
+        for entry in seqbuddy.index.entries:
+            if regex.search(entry[0]) or regex.search(entry[1]) or (description and regex.search(entry[2])):
+                matched_entries.append(entry)
+        seqbuddy.records = seqbuddy.index_records(matched_entries)
+        return seqbuddy
+
     matched_records = []
     for rec in seqbuddy.records:
         if re.search(regex, rec.id) or re.search(regex, rec.name) \
@@ -2779,6 +3639,39 @@ def purge(seqbuddy, threshold):
     return seqbuddy
 
 
+def quality_summary(seqbuddy):
+    """
+    Per-position summary of FASTQ quality scores across all records
+    :param seqbuddy: SeqBuddy object
+    :return: OrderedDict {position (1 indexed): [mean, min, max, number of records]}
+    """
+    sums, mins, maxes, lengths = [], [], [], {}
+    for rec in seqbuddy.records:
+        scores = _phred_scores(rec)
+        if scores is None:
+            raise TypeError("Quality scores required, but record '%s' does not have any." % rec.id)
+        overlap = min(len(sums), len(scores))
+        sums[:overlap] = map(add, sums[:overlap], scores[:overlap])
+        mins[:overlap] = map(min, mins[:overlap], scores[:overlap])
+        maxes[:overlap] = map(max, maxes[:overlap], scores[:overlap])
+        sums += scores[overlap:]
+        mins += scores[overlap:]
+        maxes += scores[overlap:]
+        lengths.setdefault(len(scores), 0)
+        lengths[len(scores)] += 1
+
+    # The number of records covering each position
+    counts = [0] * (len(sums) + 1)
+    for length, num in lengths.items():
+        counts[length] += num
+    counts = list(accumulate(counts[::-1]))[::-1][1:]
+
+    summary = OrderedDict()
+    for indx, num in enumerate(counts):
+        summary[indx + 1] = [sums[indx] / num, mins[indx], maxes[indx], num]
+    return summary
+
+
 def rename(seqbuddy, query, replace="", num=0, store_old_id=False):
     """
     Rename sequence IDs
@@ -2790,9 +3683,10 @@ def rename(seqbuddy, query, replace="", num=0, store_old_id=False):
     :return: The modified SeqBuddy object
     """
     replace = re.sub("\s+", "_", replace)  # Do not allow any whitespace in IDs
+    replacer = br.Replacer(query, replace, num)  # Compile once, then apply to every record
     for rec in seqbuddy.records:
-        new_name = br.replacements(rec.id, query, replace, num)
-        if re.match(rec.id, rec.description):
+        new_name = replacer.sub(rec.id)
+        if rec.description.startswith(rec.id):
             rec.description = rec.description[len(rec.id) + 1:]
         if store_old_id:
             rec.description = "%s %s" % (rec.id, rec.description)
@@ -2827,9 +3721,19 @@ def reverse_complement(seqbuddy):
     """
     if seqbuddy.alpha == IUPAC.protein:
         raise TypeError("SeqBuddy object is protein. Nucleic acid sequences required.")
+    if seqbuddy.packed_only():
+        for packed in seqbuddy.packed:
+            packed[0] = packed[0].reverse_complement()
+            if packed[4]:
+                rec = packed[4][0]
+                rec.features = [_feature_rc(feature, len(packed[0])) for feature in rec.features]
+                for key, value in packed[4][1].items():  # Per-letter annotations (e.g., quality scores)
+                    packed[4][1][key] = value[::-1]
+        return seqbuddy
     for rec in seqbuddy.records:
         try:
-            rec.seq = rec.seq.reverse_complement()
+            letter_annotations = {key: value[::-1] for key, value in rec.letter_annotations.items()}
+            _update_seq(rec, rec.seq.reverse_complement(), letter_annotations)
         except ValueError as e:
             if "Proteins do not have complements!" in str(e):
                 raise TypeError("Record '%s' is protein. Nucleic acid sequences required." % rec.id)
@@ -3013,6 +3917,38 @@ def translate_cds(seqbuddy, quiet=False, alignment=False):
     return seqbuddy
 
 
+def trim_quality(seqbuddy, threshold=20, window=4):
+    """
+    Sliding window quality trimming of FASTQ records. Scanning 5' to 3', the first window whose mean Phred score
+    drops below the threshold marks the cut. Bases at the start of that window are kept as long as each one still
+    meets the threshold on its own (as in Trimmomatic's SLIDINGWINDOW).
+    :param seqbuddy: SeqBuddy object
+    :param threshold: Minimum mean quality score within the window
+    :param window: Window size
+    :return: The modified SeqBuddy object
+    """
+    if window < 1:
+        raise ValueError("Window size must be a positive integer, not %s." % window)
+    for rec in seqbuddy.records:
+        scores = _phred_scores(rec)
+        if scores is None:
+            raise TypeError("Quality scores required, but record '%s' does not have any." % rec.id)
+        rec_window = min(window, len(scores))
+        prefix_sums = [0] + list(accumulate(scores))
+        min_sum = threshold * rec_window
+        cut = next((indx for indx in range(len(scores) - rec_window + 1)
+                    if prefix_sums[indx + rec_window] - prefix_sums[indx] < min_sum), None)
+        if cut is None or not rec_window:
+            continue
+        window_end = cut + rec_window
+        while cut < window_end and scores[cut] >= threshold:
+            cut += 1
+        letter_annotations = {key: value[:cut] for key, value in rec.letter_annotations.items()}
+        _update_seq(rec, rec.seq[:cut], letter_annotations)
+        rec.features = br.shift_features(rec.features, 0, cut)
+    return seqbuddy
+
+
 def uppercase(seqbuddy):
     """
     Converts all sequence characters to uppercase.
@@ -3024,6 +3960,116 @@ def uppercase(seqbuddy):
     return seqbuddy
 
 
+# #################################################### PIPELINES ##################################################### #
+class Pipeline(object):
+    """
+    Apply several SeqBuddy tools, one after the other, to the same SeqBuddy object. The sequences are only parsed and
+    written once, instead of once per tool when SeqBuddy calls are piped together on the command line.
+    Steps can be given as a string spec, separated by semicolons, where each step is a tool name (a function in this
+    module, or a command line flag in long or short form) followed by its arguments:
+        Pipeline("clean_seq; uppercase; translate; delete_small 50").run(seqbuddy)
+    or added from Python:
+        Pipeline().add_step(clean_seq).add_step("uppercase").add_step(delete_small, 50).run(seqbuddy)
+    """
+    # Command line flags that are named differently from the functions they call
+    aliases = {"find_CpG": "find_cpg", "hash_seq_ids": "hash_ids", "insert_seq": "insert_sequence",
+               "pull_random_record": "pull_random_recs", "pull_records": "pull_recs", "rename_ids": "rename",
+               "replace_subseq": "replace_subsequence", "reverse_transcribe": "rna2dna", "transcribe": "dna2rna",
+               "translate": "translate_cds"}
+
+    def __init__(self, spec=None):
+        """
+        :param spec: String of semicolon separated steps (e.g., "uppercase; delete_small 50")
+        """
+        self.steps = []  # [[name, function, args, kwargs], ...]
+        if spec:
+            for step in spec.split(";"):
+                step = shlex.split(step)
+                if step:
+                    self.add_step(step[0], *step[1:])
+
+    def __str__(self):
+        return "; ".join([" ".join([name] + [shlex.quote(str(arg)) for arg in args])
+                          for name, func, args, kwargs in self.steps])
+
+    def __len__(self):
+        return len(self.steps)
+
+    @staticmethod
+    def _screw_formats(seqbuddy, out_format):
+        if out_format.lower() not in OUTPUT_FORMATS:
+            raise ValueError("Output type '%s' is not recognized/supported" % out_format)
+        seqbuddy.out_format = out_format.lower()
+        return seqbuddy
+
+    def _resolve(self, tool):
+        flag_names = {values["flag"]: name for name, values in br.sb_flags.items()}
+        name = flag_names.get(tool.lstrip("-"), tool.lstrip("-"))
+        if name == "screw_formats":
+            return name, self._screw_formats
+        func = globals().get(self.aliases.get(name, name))
+        if not callable(func) or name.startswith("_") or type(func) == type \
+                or getattr(func, "__module__", None) != __name__:
+            raise AttributeError("Unknown SeqBuddy tool '%s'." % tool)
+        return name, func
+
+    @staticmethod
+    def _convert_args(name, func, args):
+        # Strings from a spec are converted to the type of the matching parameter's default value, or to the type of
+        # the command line flag.
+        import inspect
+        flag_type = br.sb_flags.get(name, {}).get("type")
+        params = list(inspect.signature(func).parameters.values())[1:]
+        converted = []
+        for indx, arg in enumerate(args):
+            if not isinstance(arg, str):
+                converted.append(arg)
+                continue
+            param = params[indx] if indx < len(params) else params[-1] if params else None
+            default = None if not param or param.default is inspect.Parameter.empty else param.default
+            try:
+                if type(default) == bool:
+                    arg = arg.lower() not in ["false", "f", "no", "n", "0", ""]
+                elif type(default) in [int, float]:
+                    arg = type(default)(arg)
+                elif flag_type and default is None:
+                    arg = flag_type(arg)
+            except ValueError:
+                raise ValueError("Invalid argument '%s' for '%s'." % (arg, name))
+            converted.append(arg)
+        return converted
+
+    def add_step(self, tool, *args, **kwargs):
+        """
+        :param tool: A function from this module, or its name/command line flag
+        :param args: Positional arguments passed to the tool (after the SeqBuddy object)
+        :param kwargs: Keyword arguments passed to the tool
+        :return: The Pipeline object, so calls can be chained
+        """
+        if callable(tool):
+            name, func = tool.__name__, tool
+        else:
+            name, func = self._resolve(tool)
+        self.steps.append([name, func, self._convert_args(name, func, args), kwargs])
+        return self
+
+    def run(self, seqbuddy):
+        """
+        :param seqbuddy: SeqBuddy object
+        :return: The final SeqBuddy object, or whatever the last step returns if it is not a SeqBuddy tool
+        (e.g., num_seqs)
+        """
+        result = seqbuddy
+        for indx, (name, func, args, kwargs) in enumerate(self.steps):
+            result = func(seqbuddy, *args, **kwargs)
+            if isinstance(result, SeqBuddy):
+                seqbuddy = result
+            elif indx != len(self.steps) - 1:
+                raise TypeError("'%s' does not return sequences, so it can only be the last step in a pipeline."
+                                % name)
+        return result
+
+
 # ################################################# COMMAND LINE UI ################################################## #
 def argparse_init():
     # Catching params to prevent weird collisions with 3rd party arguments
@@ -3069,6 +4115,15 @@ def argparse_init():
 
     in_args = parser.parse_args()
 
+    module = sys.modules[__name__]
+    br.start_profiler("SeqBuddy", in_args, [(module, "_guess_format", "guess_format"),
+                                            (SeqBuddy, "__init__", "load"),
+                                            (module, "_parse_records", "parse"),
+                                            (module, "_parse_parallel", "parse"),
+                                            (module, "_guess_alphabet", "guess_alphabet"),
+                                            (module, "make_copy", "make_copy"),
+                                            (SeqBuddy, "__str__", "serialize")])
+
     seqbuddy = []
     seq_set = ""
 
@@ -3076,9 +4131,33 @@ def argparse_init():
         _stderr("Error: Output type %s is not recognized/supported\n" % in_args.out_format)
         sys.exit()
 
+    if in_args.estimate or os.environ.get("BUDDY_MEMORY_BUDGET"):
+        try:
+            br.preflight(in_args, "sequence", br.sb_flags,
+                         lambda file_path, command: estimate_resources(file_path, command, in_args.in_format))
+        except br.GuessError as e:
+            _stderr("GuessError: %s\n" % e, in_args.quiet)
+            sys.exit()
+        if in_args.estimate:
+            sys.exit()
+
+    if in_args.batch:  # Each file is read independently by command_line_ui()
+        return in_args, seqbuddy
+
     if in_args.guess_alphabet or in_args.guess_format:
         return in_args, SeqBuddy
 
+    # These tools can work straight off of a SeqIndex, so large files don't need to be loaded into memory
+    if len(in_args.sequence) == 1 and type(in_args.sequence[0]) == str and os.path.isfile(in_args.sequence[0]) and \
+            os.path.getsize(in_args.sequence[0]) >= INDEX_FILE_SIZE and \
+            [x for x in INDEX_COMMANDS if getattr(in_args, x)]:
+        try:
+            seqbuddy = SeqBuddy(in_args.sequence[0], in_args.in_format, in_args.out_format, in_args.alpha, index=True)
+        except br.GuessError as e:
+            _stderr("GuessError: %s\n" % e, in_args.quiet)
+            sys.exit()
+        return in_args, seqbuddy
+
     try:
         for seq_set in in_args.sequence:
             if isinstance(seq_set, TextIOWrapper) and seq_set.buffer.raw.isatty():
@@ -3129,6 +4208,8 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False):
                     break
             if re_raise:
                 raise _err
+        if getattr(in_args, "batch_job", False):
+            raise _err  # br.run_batch() reports the error against the file being processed
         _stderr("{0}: {1}\n".format(_err.__class__.__name__, str(_err)), in_args.quiet)
         _exit(tool)
 
@@ -3141,6 +4222,22 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False):
         sys.exit()
 
     # ############################################## COMMAND LINE LOGIC ############################################## #
+    # Batch mode
+    if in_args.batch:
+        def _build(file_path):
+            if in_args.guess_alphabet or in_args.guess_format:
+                return SeqBuddy
+            return SeqBuddy(file_path, in_args.in_format, in_args.out_format, in_args.alpha)
+
+        try:
+            results = br.run_batch(in_args, "sequence", command_line_ui, _build, br.sb_flags, in_args.out_dir)
+        except ValueError as e:
+            _raise_error(e, "batch")
+            return
+        br.batch_report(results, in_args.quiet)
+        _exit("batch")
+        return
+
     # Add feature
     if in_args.annotate:
         # _type, location, strand=None, qualifiers=None, pattern=None
@@ -3300,6 +4397,14 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False):
         _print_recs(seqbuddy)
         _exit("concat_seqs")
 
+    # Convert quality score encoding
+    if in_args.convert_quality:
+        try:
+            _print_recs(convert_quality(seqbuddy, in_args.convert_quality))
+        except TypeError as e:
+            _raise_error(e, "convert_quality", "Quality scores required")
+        _exit("convert_quality")
+
     # Codon counter
     if in_args.count_codons:
         try:
@@ -3349,6 +4454,14 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False):
         _print_recs(delete_large(seqbuddy, in_args.delete_large))
         _exit("delete_large")
 
+    # Delete low quality
+    if in_args.delete_low_quality:
+        try:
+            _print_recs(delete_low_quality(seqbuddy, in_args.delete_low_quality))
+        except TypeError as e:
+            _raise_error(e, "delete_low_quality", "Quality scores required")
+        _exit("delete_low_quality")
+
     # Delete metadata
     if in_args.delete_metadata:
         _print_recs(delete_metadata(seqbuddy))
@@ -3846,11 +4959,11 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False):
     # List identifiers
     if in_args.list_ids:
         columns = 1 if not in_args.list_ids[0] else abs(in_args.list_ids[0])
-        output = ""
-        for indx, rec in enumerate(seqbuddy.records):
-            output += "%s\t" % rec.id
-            if (indx + 1) % columns == 0:
-                output = "%s\n" % output.strip()
+        if seqbuddy.index_only():
+            ids = [entry[0] for entry in seqbuddy.index.entries]
+        else:
+            ids = [rec.id for rec in seqbuddy.records]
+        output = "\n".join(["\t".join(ids[indx:indx + columns]) for indx in range(0, len(ids), columns)])
         _stdout("%s\n" % output.strip())
         _exit("list_ids")
 
@@ -3988,6 +5101,21 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False):
         _print_recs(order_ids_randomly(seqbuddy))
         _exit("order_ids_randomly")
 
+    # Pipeline of several tools
+    if in_args.pipeline:
+        result = None
+        try:
+            result = Pipeline(in_args.pipeline).run(seqbuddy)
+        except (AttributeError, TypeError, ValueError) as e:
+            _raise_error(e, "pipeline")
+        if isinstance(result, SeqBuddy):
+            if in_args.out_format:
+                result.out_format = in_args.out_format
+            _print_recs(result)
+        else:
+            _stdout("%s\n" % str(result).rstrip())
+        _exit("pipeline")
+
     # Pull random records
     if in_args.pull_random_record:
         count = 1 if not in_args.pull_random_record[0] else in_args.pull_random_record[0]
@@ -4026,6 +5154,18 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False):
         _print_recs(seqbuddy)
         _exit("purge")
 
+    # Quality summary
+    if in_args.quality_summary:
+        try:
+            summary = quality_summary(seqbuddy)
+        except TypeError as e:
+            _raise_error(e, "quality_summary", "Quality scores required")
+        output = ["Position\tMean\tMin\tMax\tRecords"]
+        for position, (mean, min_score, max_score, num) in summary.items():
+            output.append("%s\t%s\t%s\t%s\t%s" % (position, round(mean, 2), min_score, max_score, num))
+        _stdout("%s\n" % "\n".join(output))
+        _exit("quality_summary")
+
     # Renaming
     if in_args.rename_ids:
         args = in_args.rename_ids[0]
@@ -4141,25 +5281,45 @@ def command_line_ui(in_args, seqbuddy, skip_exit=False):
         _print_recs(seqbuddy)
         _exit("translate6frames")
 
+    # Quality trim
+    if in_args.trim_quality:
+        args = in_args.trim_quality[0]
+        threshold = 20 if not args else args[0]
+        window = 4 if len(args) < 2 else args[1]
+        try:
+            _print_recs(trim_quality(seqbuddy, threshold, window))
+        except (TypeError, ValueError) as e:
+            _raise_error(e, "trim_quality", ["Quality scores required", "Window size must be"])
+        _exit("trim_quality")
+
     # Uppercase
     if in_args.uppercase:
         _print_recs(uppercase(seqbuddy))
         _exit("uppercase")
 
 
-if __name__ == '__main__':
+def main():
     initiation = []
     try:
         initiation = argparse_init()  # initiation = [in_agrs, seqbuddy]
-        command_line_ui(*initiation)
+        if br.PROFILER:
+            br.PROFILER.run_tool(command_line_ui, *initiation)
+        else:
+            command_line_ui(*initiation)
     except (KeyboardInterrupt, br.GuessError) as _e:
         print(_e)
     except SystemExit:
         pass
     except Exception as _e:
         function = ""
-        for next_arg in vars(initiation[0]):
+        for next_arg in vars(initiation[0]) if initiation else []:
             if getattr(initiation[0], next_arg) and next_arg in br.sb_flags:
                 function = next_arg
                 break
         br.send_traceback("SeqBuddy", function, _e)
+    finally:
+        br.stop_profiler()
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,7 @@ Description: Collection of PyTest unit tests for the AlignBuddy.py program
 import pytest
 from hashlib import md5
 import os
+import re
 import sys
 import argparse
 import io
@@ -37,6 +38,7 @@ from unittest import mock
 from Bio.Alphabet import IUPAC
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
+from Bio.SeqFeature import SeqFeature, FeatureLocation
 from Bio.Align import MultipleSeqAlignment
 
 sys.path.insert(0, "./")
@@ -500,6 +502,69 @@ def test_stdout(capsys):
 
 
 # ################################################ MAIN API FUNCTIONS ################################################ #
+# ##########################################  '-ata', '--add_to_alignment' ########################################### #
+def test_add_to_alignment():
+    tester = alb_resources.get_one("o d g")
+    reference = tester.records()
+    length = tester.lengths()[0]
+    new_recs = Sb.SeqBuddy([SeqRecord(Seq(re.sub("-", "", str(rec.seq))), id=rec.id, features=rec.features)
+                            for rec in deepcopy(reference[-3:])])
+    tester.alignments[0] = MultipleSeqAlignment(deepcopy(reference[:-3]), alphabet=tester.alpha)
+    ref_seqs = [str(rec.seq) for rec in tester.records()]
+
+    Alb.add_to_alignment(tester, new_recs, "builtin")
+    assert [rec.id for rec in tester.records()] == [rec.id for rec in reference]
+    assert [str(rec.seq) for rec in tester.records()[:-3]] == ref_seqs
+    assert tester.lengths() == [length]
+    for rec in tester.records()[-3:]:
+        assert len(rec.seq) == length
+
+    with pytest.raises(AttributeError):
+        Alb.add_to_alignment(tester, new_recs, "foo")
+
+    with pytest.raises(ValueError):
+        Alb.add_to_alignment(alb_resources.get_one("m p c"), new_recs, "builtin")
+
+
+def test_add_to_alignment_insertion(capsys):
+    reference = ">ref1\nATGCTAGCTAGCATC\n>ref2\nATGCTAGCTAGCATC\n>ref3\nATGCTAGCTAGCATC\n"
+    new_rec = SeqRecord(Seq("ATGCTAGCTAGCATCGGTTAACCGG", alphabet=IUPAC.ambiguous_dna), id="new1",
+                        features=[SeqFeature(FeatureLocation(0, 15), type="CDS"),
+                                  SeqFeature(FeatureLocation(15, 25), type="exon")])
+
+    # The 10 inserted residues don't fit the 15 existing columns, so they are dropped along with the exon
+    tester = Alb.AlignBuddy(reference, in_format="fasta")
+    Alb.add_to_alignment(tester, Sb.SeqBuddy([deepcopy(new_rec)]), "builtin")
+    assert tester.lengths() == [15]
+    assert str(tester.records()[-1].seq) == "ATGCTAGCTAGCATC"
+    assert [(feat.type, feat.location.start, feat.location.end) for feat in tester.records()[-1].features] == \
+        [("CDS", 0, 15)]
+    out, err = capsys.readouterr()
+    assert "10 residues in new1 do not fit the existing columns and were dropped, along with 1 feature(s)" in err
+
+    # Without keep_length, gap columns are added to the reference instead
+    tester = Alb.AlignBuddy(reference, in_format="fasta")
+    Alb.add_to_alignment(tester, Sb.SeqBuddy([deepcopy(new_rec)]), "builtin", keep_length=False)
+    assert tester.lengths() == [25]
+    assert [str(rec.seq) for rec in tester.records()] == ["ATGCTAGCTAGCATC----------"] * 3 + [str(new_rec.seq)]
+    assert [(feat.type, feat.location.start, feat.location.end) for feat in tester.records()[-1].features] == \
+        [("CDS", 0, 15), ("exon", 15, 25)]
+    out, err = capsys.readouterr()
+    assert err == ""
+
+
+@pytest.mark.generate_alignments
+def test_add_to_alignment_mafft():
+    tester = alb_resources.get_one("o d f")
+    reference = tester.records()
+    new_recs = Sb.SeqBuddy([SeqRecord(Seq(re.sub("-", "", str(rec.seq))), id=rec.id)
+                            for rec in deepcopy(reference[-3:])])
+    tester.alignments[0] = MultipleSeqAlignment(deepcopy(reference[:-3]), alphabet=tester.alpha)
+    Alb.add_to_alignment(tester, new_recs, "mafft", quiet=True)
+    assert [rec.id for rec in tester.records()] == [rec.id for rec in reference]
+    assert tester.lengths() == [len(reference[0].seq)]
+
+
 # ##########################################  '-al', '--alignment_lengths' ########################################### #
 def test_alignment_lengths():
     lengths = Alb.alignment_lengths(alb_resources.get_one("m p c"))
@@ -971,6 +1036,25 @@ def test_generate_alignments_edges2(tool, params):
     Alb.generate_msa(tester, tool, params, quiet=True)
 
 
+# ######################  '-gag', '--generate_alignment_groups' ###################### #
+@pytest.mark.generate_alignments
+def test_generate_msa_groups():
+    tester = Sb.SeqBuddy(resource("Mnemiopsis_cds.fa"))
+    groups = [Sb.pull_recs(Sb.make_copy(tester), "α[1234]"), Sb.make_copy(tester), Sb.make_copy(tester)]
+    groups[0].identifier, groups[1].identifier, groups[2].identifier = "alpha1-4", "all", "empty"
+    groups[2].records = []
+    alignbuddy, report = Alb.generate_msa_groups(groups, "mafft", max_processes=2, out_dir="%s/gag" % TEMP_DIR.path,
+                                                 quiet=True)
+    assert [x[:2] for x in report] == [("alpha1-4", "ok"), ("all", "ok"), ("empty", "failed")]
+    assert len(alignbuddy.alignments) == 2
+    assert align_to_hash(Alb.AlignBuddy([alignbuddy.alignments[1]], out_format="fasta")) == \
+        align_to_hash(Alb.generate_msa(Sb.make_copy(tester), "mafft", quiet=True))
+    assert os.path.isfile("%s/gag/all.fa" % TEMP_DIR.path)
+
+    with pytest.raises(AttributeError):
+        Alb.generate_msa_groups(groups, "foo")
+
+
 # ######################  '-hi', '--hash_ids' ###################### #
 def test_hash_seq_ids():
     tester = alb_resources.get_one("o p g")
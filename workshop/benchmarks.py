@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This program is free software in the public domain as stipulated by the Copyright Law
+of the United States of America, chapter 1, subsection 105. You may modify it and/or redistribute it
+without restriction.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+name: benchmarks.py
+author: Stephen R. Bond
+email: steve.bond@nih.gov
+institute: Computational and Statistical Genomics Branch, Division of Intramural Research,
+           National Human Genome Research Institute, National Institutes of Health
+           Bethesda, MD
+repository: https://github.com/biologyguy/BuddySuite
+© license: None, this work is public domain
+
+Description: Performance benchmarks for BuddySuite. Input data is generated from a fixed seed, so timings from
+             different runs (and different versions of the code) are comparable.
+             Usage: python3 benchmarks.py phylip [--taxa 10000] [--sites 100000]
+                    python3 benchmarks.py packed [--seqs 100000] [--length 1000]
+                    python3 benchmarks.py startup [--repeats 10]
+                    python3 benchmarks.py suite [--scale small|medium|large]
+                    python3 benchmarks.py calibrate [--scale medium] [--save_costs]
+             Add --save_baseline to store the results in benchmark_baselines.json. Later runs with the same settings
+             are compared against the stored values, and anything more than --tolerance slower is flagged.
+"""
+
+import sys
+import os
+import random
+import json
+import tracemalloc
+from time import perf_counter
+from subprocess import Popen, PIPE, DEVNULL
+
+sys.path.insert(0, "./")
+import buddy_resources as br
+import SeqBuddy as Sb
+import MyFuncs
+
+# A complete command line call on a small file should not take longer than this (seconds)
+STARTUP_BUDGET = 0.3
+
+BASELINE_FILE = "%s/benchmark_baselines.json" % os.path.dirname(os.path.abspath(__file__))
+
+# Data set sizes for the suite
+SCALES = {"small": {"seqs": 100, "seq_len": 1000, "gb_seqs": 50, "codons": 300, "features": 20, "reads": 2000,
+                    "read_len": 150, "align_seqs": 50, "align_cols": 1000, "trees": 10, "tips": 50,
+                    "db_recs": 1000, "bootstraps": 5, "repeats": 5},
+          "medium": {"seqs": 1000, "seq_len": 1000, "gb_seqs": 500, "codons": 300, "features": 20, "reads": 20000,
+                     "read_len": 150, "align_seqs": 200, "align_cols": 5000, "trees": 30, "tips": 200,
+                     "db_recs": 10000, "bootstraps": 10, "repeats": 3},
+          "large": {"seqs": 10000, "seq_len": 1000, "gb_seqs": 5000, "codons": 300, "features": 20, "reads": 200000,
+                    "read_len": 150, "align_seqs": 1000, "align_cols": 10000, "trees": 100, "tips": 500,
+                    "db_recs": 100000, "bootstraps": 10, "repeats": 1}}
+
+# ################################################# DATA GENERATORS ################################################## #
+def write_phylip_sequential(file_path, num_taxa, num_sites, relaxed=True, seed=12345):
+    """
+    Write a random DNA alignment in sequential phylip format, one line at a time so huge files can be generated
+    :param file_path: Where to write the file
+    :param num_taxa: Number of sequences
+    :param num_sites: Number of columns
+    :param relaxed: phylipsr (True) or phylipss (False)
+    :param seed: Random seed
+    :return: file_path
+    """
+    rand_gen = random.Random(seed)
+    with open(file_path, "w") as ofile:
+        ofile.write(" %s %s\n" % (num_taxa, num_sites))
+        for indx in range(num_taxa):
+            seq_id = "Taxon_%s" % indx if relaxed else ("T%s" % indx).ljust(10)
+            seq = "".join([rand_gen.choice("ACGT-") for _ in range(min(num_sites, 1000))])
+            seq = (seq * (int(num_sites / 1000) + 1))[:num_sites]  # Re-use a 1kb block to keep generation fast
+            ofile.write("%s%s%s\n" % (seq_id, "  " if relaxed else "", seq))
+    return file_path
+
+
+def write_fasta(file_path, num_seqs, seq_len, seed=12345, protein=False):
+    """
+    Write random sequences in fasta format, with ~1% Ns/Xs and a lowercase (masked) region in every tenth sequence
+    :param file_path: Where to write the file
+    :param num_seqs: Number of sequences
+    :param seq_len: Length of each sequence
+    :param seed: Random seed
+    :param protein: Write protein instead of DNA
+    :return: file_path
+    """
+    rand_gen = random.Random(seed)
+    alphabet = "ACDEFGHIKLMNPQRSTVWY" * 5 + "X" if protein else "ACGT" * 25 + "N"
+    block = "".join([rand_gen.choice(alphabet) for _ in range(max(seq_len, 1000) * 2)])
+    with open(file_path, "w") as ofile:
+        for indx in range(num_seqs):
+            start = rand_gen.randint(0, len(block) - seq_len)
+            seq = block[start:start + seq_len]
+            if not indx % 10:
+                seq = "%s%s%s" % (seq[:10], seq[10:60].lower(), seq[60:])
+            ofile.write(">Seq_%s\n%s\n" % (indx, "\n".join([seq[i:i + 60] for i in range(0, seq_len, 60)])))
+    return file_path
+
+
+def write_genbank(file_path, num_seqs, num_codons, num_features, seed=12345):
+    """
+    Write random coding sequences (start codon, no internal stops, stop codon) in genbank format, each densely
+    annotated with overlapping features
+    :param file_path: Where to write the file
+    :param num_seqs: Number of sequences
+    :param num_codons: Number of codons in each sequence, not including the start and stop codons
+    :param num_features: Number of features on each sequence
+    :param seed: Random seed
+    :return: file_path
+    """
+    from Bio import SeqIO
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    from Bio.SeqFeature import SeqFeature, FeatureLocation
+    from Bio.Alphabet import IUPAC
+    rand_gen = random.Random(seed)
+    codons = [a + b + c for a in "ACGT" for b in "ACGT" for c in "ACGT" if a + b + c not in ["TAA", "TAG", "TGA"]]
+    seq_len = (num_codons + 2) * 3
+    records = []
+    for indx in range(num_seqs):
+        seq = "ATG%sTAA" % "".join([rand_gen.choice(codons) for _ in range(num_codons)])
+        rec = SeqRecord(Seq(seq, alphabet=IUPAC.ambiguous_dna), id="Seq_%s" % indx, name="Seq_%s" % indx,
+                        description="Synthetic coding sequence %s" % indx)
+        for feat_indx in range(num_features):
+            start = rand_gen.randint(0, seq_len - 2)
+            end = rand_gen.randint(start + 1, seq_len)
+            rec.features.append(SeqFeature(FeatureLocation(start, end, strand=rand_gen.choice([1, -1])),
+                                           type=rand_gen.choice(["misc_feature", "exon", "repeat_region"]),
+                                           qualifiers={"note": "feature_%s" % feat_indx}))
+        records.append(rec)
+    with open(file_path, "w") as ofile:
+        SeqIO.write(records, ofile, "genbank")
+    return file_path
+
+
+def write_fastq(file_path, num_reads, read_len, seed=12345):
+    """
+    Write random DNA reads in fastq (Sanger) format, with quality scores that drop off towards the 3' end
+    :param file_path: Where to write the file
+    :param num_reads: Number of reads
+    :param read_len: Length of each read
+    :param seed: Random seed
+    :return: file_path
+    """
+    rand_gen = random.Random(seed)
+    block = "".join([rand_gen.choice("ACGT" * 50 + "N") for _ in range(max(read_len, 1000) * 2)])
+    quals = "".join([chr(33 + max(2, 40 - int(40 * indx / read_len) - rand_gen.randint(0, 10)))
+                     for indx in range(read_len)])
+    with open(file_path, "w") as ofile:
+        for indx in range(num_reads):
+            start = rand_gen.randint(0, len(block) - read_len)
+            shift = rand_gen.randint(0, 5)
+            ofile.write("@Read_%s\n%s\n+\n%s\n" % (indx, block[start:start + read_len], quals[shift:] + quals[:shift]))
+    return file_path
+
+
+def write_alignment(file_path, num_seqs, num_cols, seed=12345):
+    """
+    Write a random DNA alignment in fasta format. Every sequence is a mutated copy of one root sequence, with
+    scattered gap runs and a few very gappy columns, so trimming and consensus calls have something to do.
+    :param file_path: Where to write the file
+    :param num_seqs: Number of sequences
+    :param num_cols: Number of columns
+    :param seed: Random seed
+    :return: file_path
+    """
+    rand_gen = random.Random(seed)
+    root = [rand_gen.choice("ACGT") for _ in range(num_cols)]
+    gappy_cols = rand_gen.sample(range(num_cols), int(num_cols / 50))
+    with open(file_path, "w") as ofile:
+        for indx in range(num_seqs):
+            seq = list(root)
+            for pos in rand_gen.sample(range(num_cols), int(num_cols / 10)):  # 10% substitutions
+                seq[pos] = rand_gen.choice("ACGT")
+            for _ in range(int(num_cols / 200)):  # Gap runs
+                start = rand_gen.randint(0, num_cols - 1)
+                end = min(start + rand_gen.randint(1, 10), num_cols)
+                seq[start:end] = "-" * (end - start)
+            for pos in gappy_cols:
+                if rand_gen.random() < 0.8:
+                    seq[pos] = "-"
+            seq = "".join(seq)
+            ofile.write(">Seq_%s\n%s\n" % (indx, "\n".join([seq[i:i + 60] for i in range(0, num_cols, 60)])))
+    return file_path
+
+
+def write_trees(file_path, num_trees, num_tips, seed=12345):
+    """
+    Write random trees with branch lengths in newick format, one per line, all sharing the same set of tips
+    :param file_path: Where to write the file
+    :param num_trees: Number of trees
+    :param num_tips: Number of tips in each tree
+    :param seed: Random seed
+    :return: file_path
+    """
+    rand_gen = random.Random(seed)
+    with open(file_path, "w") as ofile:
+        for _ in range(num_trees):
+            nodes = ["Tip_%s" % indx for indx in range(num_tips)]
+            while len(nodes) > 2:
+                node1 = nodes.pop(rand_gen.randrange(len(nodes)))
+                node2 = nodes.pop(rand_gen.randrange(len(nodes)))
+                nodes.append("(%s:%.4f,%s:%.4f)" % (node1, rand_gen.random(), node2, rand_gen.random()))
+            ofile.write("(%s:%.4f,%s:%.4f);\n" % (nodes[0], rand_gen.random(), nodes[1], rand_gen.random()))
+    return file_path
+
+
+# #################################################### BENCHMARKS #################################################### #
+def _time(func, *args, **kwargs):
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    return result, perf_counter() - start
+
+
+def _best_of(repeats, func, setup=None):
+    # Shortest of several runs. setup() is not timed, and returns the arguments for func (e.g., a fresh copy)
+    best = None
+    for _ in range(repeats):
+        args = setup() if setup else ()
+        start = perf_counter()
+        func(*args)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_phylip(num_taxa=10000, num_sites=100000):
+    """
+    Time br.phylip_sequential_read() and br.phylip_sequential_out() on a num_taxa x num_sites alignment
+    :return: dict of {stage: seconds}
+    """
+    tmp_dir = MyFuncs.TempDir()
+    file_path = write_phylip_sequential("%s/bench.physr" % tmp_dir.path, num_taxa, num_sites)
+    with open(file_path, "r") as ifile:
+        contents = ifile.read()
+
+    aligns, read_time = _time(br.phylip_sequential_read, contents)
+    del contents
+
+    class _Holder(object):
+        alignments = aligns
+
+    with open(os.devnull, "w") as ofile:
+        _, write_time = _time(br.phylip_sequential_out, _Holder(), handle=ofile)
+    return {"read (s)": read_time, "write (s)": write_time}
+
+
+def _memory(func, *args, **kwargs):
+    # Memory still held by whatever func() returns
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size / 1048576.
+
+
+def _peak_memory(func, *args, **kwargs):
+    # Most memory allocated at any one time while func() runs
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak
+
+
+def bench_packed(num_seqs=100000, seq_len=1000):
+    """
+    Compare the memory held by SeqRecord storage and by 2-bit PackedSeq storage, and time the reverse complement
+    :return: dict of {stage: value}
+    """
+    tmp_dir = MyFuncs.TempDir()
+    file_path = write_fasta("%s/bench.fa" % tmp_dir.path, num_seqs, seq_len)
+    results = {"file (MB)": os.path.getsize(file_path) / 1048576.}
+
+    seqbuddy, results["records (MB)"] = _memory(Sb.SeqBuddy, file_path, "fasta", alpha="dna")
+    _, results["records rc (s)"] = _time(Sb.reverse_complement, seqbuddy)
+    del seqbuddy
+
+    seqbuddy = Sb.SeqBuddy(file_path, "fasta", alpha="dna")
+    seqbuddy, results["pack (s)"] = _time(seqbuddy.pack)
+    _, results["packed (MB)"] = _memory(Sb.make_copy, seqbuddy)
+    _, results["packed rc (s)"] = _time(Sb.reverse_complement, seqbuddy)
+    _, results["unpack (s)"] = _time(seqbuddy.unpack)
+    return results
+
+
+def _import_times(module, num_imports=5):
+    # Parse the stderr of `python -X importtime`, and return the slowest packages imported directly by module
+    _, err = Popen([sys.executable, "-X", "importtime", "-c", "import %s" % module], stderr=PIPE,
+                   cwd=os.path.dirname(os.path.abspath(__file__))).communicate()
+    times = []
+    for line in err.decode().split("\n"):
+        line = line.split("|")
+        if len(line) != 3 or not line[1].strip().isdigit():
+            continue
+        depth = len(line[2]) - len(line[2].lstrip())
+        times.append((depth, line[2].strip(), int(line[1]) / 1000000.))
+    # Children are listed, one level deeper, directly above the module that imported them
+    indx = [x[1] for x in times].index(module)
+    children = []
+    for depth, name, seconds in times[indx - 1::-1]:
+        if depth <= times[indx][0]:
+            break
+        if depth == times[indx][0] + 2:
+            children.append((name, seconds))
+    return sorted(children, key=lambda x: x[1], reverse=True)[:num_imports]
+
+
+def bench_startup(repeats=10):
+    """
+    Time complete command line calls on tiny inputs, which are dominated by interpreter start up and module imports,
+    and list the slowest imports reported by `python -X importtime`.
+    :return: dict of {stage: seconds}
+    """
+    tmp_dir = MyFuncs.TempDir()
+    seq_file = write_fasta("%s/bench.fa" % tmp_dir.path, 10, 100)
+    tree_file = "%s/bench.nwk" % tmp_dir.path
+    with open(tree_file, "w") as ofile:
+        ofile.write("(A,(B,(C,D)));\n")
+
+    work_dir = os.path.dirname(os.path.abspath(__file__))
+    commands = [("python", [sys.executable, "-c", "pass"]),
+                ("SeqBuddy -ns", [sys.executable, "SeqBuddy.py", seq_file, "-ns"]),
+                ("AlignBuddy -al", [sys.executable, "AlignBuddy.py", seq_file, "-al"]),
+                ("PhyloBuddy -nt", [sys.executable, "PhyloBuddy.py", tree_file, "-nt"])]
+    results = {}
+    for name, command in commands:
+        timings = []
+        for _ in range(repeats):
+            start = perf_counter()
+            Popen(command, stdout=DEVNULL, stderr=DEVNULL, cwd=work_dir).wait()
+            timings.append(perf_counter() - start)
+        results["%s (s)" % name] = sorted(timings)[int(len(timings) / 2)]  # Median
+
+    for module in ["SeqBuddy", "AlignBuddy", "PhyloBuddy"]:
+        for package, seconds in _import_times(module):
+            results["import %s > %s (s)" % (module, package)] = seconds
+
+    results["budget (s)"] = STARTUP_BUDGET
+    for name in ["SeqBuddy -ns", "AlignBuddy -al", "PhyloBuddy -nt"]:
+        if results["%s (s)" % name] > STARTUP_BUDGET:
+            sys.stderr.write("Warning: %s took %.3f seconds, over the %s second start up budget\n"
+                             % (name, results["%s (s)" % name], STARTUP_BUDGET))
+    return results
+
+
+def bench_suite(scale="small"):
+    """
+    Time parsing, writing, and the most commonly used (or historically slowest) tools of all four Buddies
+    :param scale: "small", "medium", or "large" (see SCALES)
+    :return: dict of {stage: seconds}
+    """
+    import AlignBuddy as Alb
+    import PhyloBuddy as Pb
+    import DatabaseBuddy as Db
+    from collections import OrderedDict
+    sizes = SCALES[scale]
+    repeats = sizes["repeats"]
+    tmp_dir = MyFuncs.TempDir()
+    results = {}
+
+    # SeqBuddy
+    dna_file = write_fasta("%s/dna.fa" % tmp_dir.path, sizes["seqs"], sizes["seq_len"])
+    prot_file = write_fasta("%s/prot.fa" % tmp_dir.path, sizes["seqs"], int(sizes["seq_len"] / 3), protein=True)
+    gb_file = write_genbank("%s/cds.gb" % tmp_dir.path, sizes["gb_seqs"], sizes["codons"], sizes["features"])
+    fastq_file = write_fastq("%s/reads.fq" % tmp_dir.path, sizes["reads"], sizes["read_len"])
+    for name, file_path, in_format in [("dna fasta", dna_file, "fasta"), ("protein fasta", prot_file, "fasta"),
+                                       ("genbank", gb_file, "genbank"), ("fastq", fastq_file, "fastq")]:
+        results["sb parse %s (s)" % name] = _best_of(repeats, Sb.SeqBuddy, lambda: (file_path, in_format))
+        seqbuddy = Sb.SeqBuddy(file_path, in_format)
+        results["sb write %s (s)" % name] = _best_of(repeats, str, lambda: (seqbuddy,))
+
+    dna = Sb.SeqBuddy(dna_file, "fasta")
+    cds = Sb.SeqBuddy(gb_file, "genbank")
+    results["sb clean_seq (s)"] = _best_of(repeats, Sb.clean_seq, lambda: (Sb.make_copy(dna),))
+    results["sb translate_cds (s)"] = _best_of(repeats, Sb.translate_cds, lambda: (Sb.make_copy(cds), True))
+    results["sb find_repeats (s)"] = _best_of(repeats, Sb.find_repeats, lambda: (Sb.make_copy(dna),))
+
+    # AlignBuddy
+    align_file = write_alignment("%s/align.fa" % tmp_dir.path, sizes["align_seqs"], sizes["align_cols"])
+    results["alb parse (s)"] = _best_of(repeats, Alb.AlignBuddy, lambda: (align_file, "fasta"))
+    alignbuddy = Alb.AlignBuddy(align_file, "fasta")
+    results["alb write (s)"] = _best_of(repeats, str, lambda: (alignbuddy,))
+    results["alb trimal gappyout (s)"] = _best_of(repeats, Alb.trimal,
+                                                  lambda: (Alb.make_copy(alignbuddy), "gappyout"))
+    results["alb consensus_sequence (s)"] = _best_of(repeats, Alb.consensus_sequence,
+                                                     lambda: (Alb.make_copy(alignbuddy),))
+    results["alb bootstrap (s)"] = _best_of(repeats, Alb.bootstrap,
+                                            lambda: (Alb.make_copy(alignbuddy), sizes["bootstraps"]))
+
+    # PhyloBuddy
+    tree_file = write_trees("%s/trees.nwk" % tmp_dir.path, sizes["trees"], sizes["tips"])
+    results["pb parse (s)"] = _best_of(repeats, Pb.PhyloBuddy, lambda: (tree_file, "newick"))
+    phylobuddy = Pb.PhyloBuddy(tree_file, "newick")
+    results["pb distance (s)"] = _best_of(repeats, Pb.distance, lambda: (Pb.make_copy(phylobuddy),))
+
+    # DatabaseBuddy
+    rand_gen = random.Random(12345)
+    organisms = ["Homo sapiens", "Mus musculus", "Danio rerio", "Mnemiopsis leidyi", "Drosophila melanogaster"]
+
+    def dbbuddy():
+        _dbbuddy = Db.DbBuddy()
+        for indx in range(sizes["db_recs"]):
+            summary = OrderedDict([("organism", rand_gen.choice(organisms)), ("length", rand_gen.randint(50, 5000)),
+                                   ("comments", "Synthetic record %s" % indx)])
+            _dbbuddy.records["XP_%09d" % indx] = Db.Record("XP_%09d" % indx, summary=summary, _database="ncbi_prot")
+        return _dbbuddy,
+
+    results["db filter keep (s)"] = _best_of(repeats, lambda _dbbuddy: _dbbuddy.filter_records("(organism)Homo",
+                                                                                             "keep"), dbbuddy)
+    results["db filter length (s)"] = _best_of(repeats, lambda _dbbuddy: _dbbuddy.filter_records("(length>1000)",
+                                                                                                "remove"), dbbuddy)
+    return results
+
+
+def bench_calibrate(scale="medium"):
+    """
+    Measure the cost models used for the SeqBuddy and AlignBuddy pre-flight estimates (see br.COST_MODELS). Each
+    command is run on a fresh copy of the loaded input, and its peak memory and run time are divided by the number of
+    input units (residues + 200 * records + 500 * features).
+    :param scale: "small", "medium", or "large" (see SCALES)
+    :return: dict of {"<tool> <command> (bytes/unit)" or "<tool> <command> (seconds/unit)": value}
+    """
+    import AlignBuddy as Alb
+    sizes = SCALES[scale]
+    tmp_dir = MyFuncs.TempDir()
+    gb_file = write_genbank("%s/cds.gb" % tmp_dir.path, sizes["gb_seqs"], sizes["codons"], sizes["features"])
+    align_file = write_alignment("%s/align.fa" % tmp_dir.path, sizes["align_seqs"], sizes["align_cols"])
+
+    def units(records):
+        return sum([len(rec.seq) + 200 + 500 * len(rec.features) for rec in records])
+
+    seqbuddy = Sb.SeqBuddy(gb_file, "genbank")
+    protein = Sb.translate_cds(Sb.make_copy(seqbuddy), quiet=True)
+    alignbuddy = Alb.AlignBuddy(align_file, "fasta")
+    # {tool: (load function, input file, loaded input, make_copy, {command: (function, input)})}
+    commands = {"SeqBuddy": (Sb.SeqBuddy, gb_file, seqbuddy, Sb.make_copy,
+                             {"default": (Sb.make_copy, seqbuddy),
+                              "back_translate": (Sb.back_translate, protein),
+                              "clean_seq": (Sb.clean_seq, seqbuddy),
+                              "delete_repeats": (Sb.delete_repeats, seqbuddy),
+                              "find_repeats": (Sb.find_repeats, seqbuddy),
+                              "hash_seq_ids": (Sb.hash_ids, seqbuddy),
+                              "merge": (lambda _seqbuddy: Sb.merge(_seqbuddy, Sb.make_copy(_seqbuddy)), seqbuddy),
+                              "reverse_complement": (Sb.reverse_complement, seqbuddy),
+                              "translate": (lambda _seqbuddy: Sb.translate_cds(_seqbuddy, quiet=True), seqbuddy),
+                              "translate6frames": (Sb.translate6frames, seqbuddy)}),
+                "AlignBuddy": (Alb.AlignBuddy, align_file, alignbuddy, Alb.make_copy,
+                               {"default": (Alb.make_copy, alignbuddy),
+                                "bootstrap": (Alb.bootstrap, alignbuddy),
+                                "consensus": (Alb.consensus_sequence, alignbuddy),
+                                "trimal": (lambda _alignbuddy: Alb.trimal(_alignbuddy, "gappyout"), alignbuddy)})}
+
+    results = {}
+    for tool, (load, file_path, loaded, copy_func, tool_commands) in commands.items():
+        records = loaded.records if tool == "SeqBuddy" else loaded.records()
+        num_units = units(records)
+        _, peak = _peak_memory(load, file_path)
+        results["%s load (bytes/unit)" % tool] = peak / num_units
+        results["%s load (seconds/unit)" % tool] = _best_of(sizes["repeats"], load, lambda: (file_path,)) / num_units
+        for command, (func, _input) in tool_commands.items():
+            _, peak = _peak_memory(func, copy_func(_input))
+            results["%s %s (bytes/unit)" % (tool, command)] = peak / num_units
+            seconds = _best_of(sizes["repeats"], func, lambda: (copy_func(_input),))
+            results["%s %s (seconds/unit)" % (tool, command)] = seconds / num_units
+    return results
+
+
+def save_cost_models(results, cost_model_file=br.COST_MODEL_FILE):
+    """
+    Write the output of bench_calibrate() where br.cost_models() will pick it up
+    :param results: dict returned by bench_calibrate()
+    :param cost_model_file: Location of the cost models json file
+    :return: dict of {tool: {command: [bytes per unit, seconds per unit]}}
+    """
+    models = {}
+    for stage, value in results.items():
+        tool, command, unit = stage.split(" ")
+        models.setdefault(tool, {}).setdefault(command, [0., 0.])
+        models[tool][command][0 if unit == "(bytes/unit)" else 1] = value
+    with open(cost_model_file, "w") as ofile:
+        json.dump(models, ofile, indent=2, sort_keys=True)
+    return models
+
+
+BENCHMARKS = {"phylip": lambda in_args: bench_phylip(in_args.taxa, in_args.sites),
+              "packed": lambda in_args: bench_packed(in_args.seqs, in_args.length),
+              "startup": lambda in_args: bench_startup(in_args.repeats),
+              "suite": lambda in_args: bench_suite(in_args.scale),
+              "calibrate": lambda in_args: bench_calibrate(in_args.scale)}
+
+# The arguments that change what each benchmark measures, used to match results to stored baselines
+BENCHMARK_ARGS = {"phylip": ["taxa", "sites"], "packed": ["seqs", "length"], "startup": ["repeats"],
+                  "suite": ["scale"], "calibrate": ["scale"]}
+
+
+def compare_to_baseline(key, results, tolerance=0.2, baseline_file=BASELINE_FILE):
+    """
+    Compare results against the stored baseline for the same benchmark and settings
+    :param key: Benchmark name and settings, e.g., "suite scale=small"
+    :param results: dict of {stage: value} (larger values are worse)
+    :param tolerance: Fraction a value may grow beyond its baseline before it is flagged
+    :param baseline_file: Location of the baselines json file
+    :return: dict of {stage: (baseline, flag)}, where flag is "ok", "REGRESSION", or "new"
+    """
+    baselines = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file, "r") as ifile:
+            baselines = json.load(ifile).get(key, {})
+    comparison = {}
+    for stage, value in results.items():
+        if stage not in baselines:
+            comparison[stage] = (None, "new")
+        else:
+            comparison[stage] = (baselines[stage], "REGRESSION" if value > baselines[stage] * (1 + tolerance) else "ok")
+    return comparison
+
+
+def save_baseline(key, results, baseline_file=BASELINE_FILE):
+    """
+    Store results as the baseline for a benchmark and its settings
+    :param key: Benchmark name and settings, e.g., "suite scale=small"
+    :param results: dict of {stage: value}
+    :param baseline_file: Location of the baselines json file
+    :return: None
+    """
+    baselines = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file, "r") as ifile:
+            baselines = json.load(ifile)
+    baselines[key] = results
+    with open(baseline_file, "w") as ofile:
+        json.dump(baselines, ofile, indent=2, sort_keys=True)
+    return
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(prog="benchmarks.py", description="BuddySuite performance benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--taxa", type=int, default=10000)
+    parser.add_argument("--sites", type=int, default=100000)
+    parser.add_argument("--seqs", type=int, default=100000)
+    parser.add_argument("--length", type=int, default=1000)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--save_baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fraction slower than the baseline before a result is flagged")
+    parser.add_argument("--save_costs", action="store_true",
+                        help="With 'calibrate', store the results as the cost models for --estimate")
+    in_args = parser.parse_args()
+
+    results = BENCHMARKS[in_args.benchmark](in_args)
+    key = " ".join([in_args.benchmark] + ["%s=%s" % (arg, getattr(in_args, arg))
+                                          for arg in BENCHMARK_ARGS[in_args.benchmark]])
+    comparison = compare_to_baseline(key, results, in_args.tolerance)
+    for stage, value in results.items():
+        baseline, flag = comparison[stage]
+        print("%s\t%s\t%.3f\t%s\t%s" % (in_args.benchmark, stage, value,
+                                          "-" if baseline is None else "%.3f" % baseline, flag))
+
+    if in_args.save_costs and in_args.benchmark == "calibrate":
+        save_cost_models(results)
+        sys.stderr.write("Cost models saved to %s\n" % br.COST_MODEL_FILE)
+
+    if in_args.save_baseline:
+        save_baseline(key, results)
+        sys.stderr.write("Baseline for '%s' saved to %s\n" % (key, BASELINE_FILE))
+    elif [x for x in comparison.values() if x[1] == "REGRESSION"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
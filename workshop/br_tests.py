@@ -27,6 +27,100 @@ import pytest
 from subprocess import Popen, PIPE
 
 import buddy_resources as Br
+import MyFuncs
+import json
+import os
+
+
+def test_usage(monkeypatch):
+    tmp_dir = MyFuncs.TempDir()
+    monkeypatch.setattr(Br, "config_values", lambda: {"install_path": tmp_dir.path, "diagnostics": False,
+                                                      "user_hash": "hashless"})
+    started = []
+    monkeypatch.setattr(Br, "Popen", lambda *args, **kwargs: started.append(args))
+
+    for _ in range(3):
+        usage = Br.Usage()
+        usage.increment("SeqBuddy", "1.2", "num_seqs")
+        usage.save()
+    usage.increment("SeqBuddy", "1.2", "uppercase")
+    usage.save()
+    with open("%s/usage.json.log" % tmp_dir.path, "r") as ifile:
+        assert ifile.read() == "SeqBuddy\t1.2\tnum_seqs\n" * 3 + "SeqBuddy\t1.2\tuppercase\n"
+
+    # usage.json doesn't exist yet, so the first save() hands the lock to a background compaction
+    assert len(started) == 1
+    assert os.path.isfile("%s/usage.json.lock" % tmp_dir.path)
+    assert not Br.Usage().compact()
+
+    assert Br.Usage().compact(locked=True)
+    assert sorted(os.listdir(tmp_dir.path)) == ["usage.json"]
+    with open("%s/usage.json" % tmp_dir.path, "r") as ifile:
+        stats = json.load(ifile)
+    assert stats["SeqBuddy"] == {"1.2": {"num_seqs": 3, "uppercase": 1}}
+    assert stats["user_hash"] == "hashless"
+
+
+def test_profiler(monkeypatch, capsys):
+    class Args(object):
+        profile = None
+
+    monkeypatch.delenv("BUDDY_TRACE", raising=False)
+    assert not Br.start_profiler("SeqBuddy", Args, [(MyFuncs, "pretty_time", "serialize")])
+    assert not Br.PROFILER
+
+    tmp_file = MyFuncs.TempFile()
+    monkeypatch.setenv("BUDDY_TRACE", tmp_file.path)
+    pretty_time = MyFuncs.pretty_time
+    profiler = Br.start_profiler("SeqBuddy", Args, [(MyFuncs, "pretty_time", "serialize")])
+    assert Br.PROFILER == profiler
+    assert MyFuncs.pretty_time != pretty_time
+    assert profiler.run_tool(lambda: MyFuncs.pretty_time(90)) == pretty_time(90)
+    Br.stop_profiler()
+    assert MyFuncs.pretty_time == pretty_time and not Br.PROFILER
+
+    events = [json.loads(line) for line in capsys.readouterr()[1].strip().split("\n")]
+    assert [event["stage"] for event in events] == ["serialize", "tool", "pstats", "summary"]
+    assert events[0]["func"] == "pretty_time" and events[0]["depth"] == 1
+    assert events[1]["seconds"] >= events[0]["seconds"]
+    assert events[3]["stages"]["serialize"]["calls"] == 1
+    assert os.path.getsize(tmp_file.path)
+
+
+def test_memory_budget(monkeypatch, capsys):
+    monkeypatch.delenv("BUDDY_MEMORY_BUDGET", raising=False)
+    assert Br.memory_budget() is None
+    monkeypatch.setenv("BUDDY_MEMORY_BUDGET", "512")
+    assert Br.memory_budget() == 512.
+    assert capsys.readouterr()[1] == ""
+
+    # Anything that isn't a positive number is ignored, with a warning
+    for budget in ["abc", "-5", "nan"]:
+        monkeypatch.setenv("BUDDY_MEMORY_BUDGET", budget)
+        assert Br.memory_budget() is None
+        assert "BUDDY_MEMORY_BUDGET should be a number of MB, not '%s'" % budget in capsys.readouterr()[1]
+
+
+def test_remap_gapped_features(monkeypatch):
+    def records():
+        old_recs = [Br.SeqRecord(Br.Seq("ATGCATGCAT"), id="seq%s" % indx,
+                                 features=[Br.SeqFeature(Br.FeatureLocation(2, 8), type="exon")]) for indx in range(4)]
+        old_recs[3].features = []
+        new_recs = [Br.SeqRecord(Br.Seq("A--TGCA-TGCAT"), id="seq%s" % indx) for indx in range(4)]
+        return old_recs, new_recs
+
+    old, new = records()
+    Br.remap_gapped_features(old, new)
+    assert [str(rec.features[0].location) for rec in new[:3]] == ["[4:11]"] * 3
+    assert new[3].features == []
+
+    # Same result when the records are spread over several processes
+    monkeypatch.setattr(Br, "REMAP_PARALLEL_SIZE", 1)
+    old, new = records()
+    Br.remap_gapped_features(old, new, max_processes=2)
+    assert [str(rec.features[0].location) for rec in new[:3]] == ["[4:11]"] * 3
+    assert new[3].features == []
+    assert old[0].features[0] is new[0].features[0]
 
 # None of this has not been properly vetted yet
 '''
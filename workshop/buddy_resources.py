@@ -34,12 +34,21 @@ from collections import OrderedDict
 import os
 from configparser import ConfigParser
 import json
+import pickle
 import traceback
 import re
+from io import StringIO
+from glob import glob
+from copy import copy
+from time import time
+from subprocess import Popen, DEVNULL
 
 sys.path.insert(0, "./")
-from MyFuncs import TempFile
-from Bio import AlignIO
+from MyFuncs import TempFile, TempDir, Timer, run_multicore_function, usable_cpu_count
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.Align import MultipleSeqAlignment
+from Bio.Alphabet import single_letter_alphabet
 from Bio.SeqFeature import SeqFeature, FeatureLocation, CompoundLocation
 
 
@@ -92,45 +101,146 @@ class CustomHelpFormatter(argparse.RawDescriptionHelpFormatter):
 
 
 class Usage(object):
+    """
+    Usage statistics are appended to a log, one line per event, so parallel jobs never read, parse, or rewrite a shared
+    file on exit. Every so often the log is folded into usage.json (and reports are sent) by a detached background
+    process, which is the only thing that ever touches usage.json.
+    """
+    compact_size = 16384  # Bytes of log that trigger a compaction
+    compact_age = 86400  # Seconds since usage.json was last written that trigger a compaction
+    lock_timeout = 600  # Seconds before a compaction lock is considered stale
+
     def __init__(self):
         self.config = config_values()
         if self.config["install_path"]:
             self.usage_file_path = "%s/usage.json" % self.config["install_path"]
         else:
             self.usage_file_path = "/tmp/usage.json"
-
-        if not os.path.isfile(self.usage_file_path):
-            with open(self.usage_file_path, "w") as ofile:
-                ofile.write("{}")
-        try:
-            with open(self.usage_file_path) as ifile:
-                self.stats = json.load(ifile)
-                if not self.stats:  # Empty file needs to be populated with a little info
+        self.log_path = "%s.log" % self.usage_file_path
+        self.events = []
+        self._stats = None
+
+    @property
+    def stats(self):
+        # Only read usage.json when it is actually needed (i.e., during compaction)
+        if self._stats is None:
+            try:
+                with open(self.usage_file_path) as ifile:
+                    self._stats = json.load(ifile)
+                if not self._stats:  # Empty file needs to be populated with a little info
                     self.clear_stats()
 
-        except ValueError:  # If the json file can't be read for whatever reason, start from scratch
-            print("Error reading usage json file. Starting from scratch.")
-            self.clear_stats()
+            except FileNotFoundError:
+                self.clear_stats()
+
+            except ValueError:  # If the json file can't be read for whatever reason, start from scratch
+                print("Error reading usage json file. Starting from scratch.")
+                self.clear_stats()
+        return self._stats
+
+    @stats.setter
+    def stats(self, value):
+        self._stats = value
 
     def clear_stats(self):
         self.stats = {"user_hash": self.config["user_hash"]}
 
     def increment(self, buddy, version, tool):
-        self.stats.setdefault(buddy, {})
-        self.stats[buddy].setdefault(version, {})
-        self.stats[buddy][version].setdefault(tool, 0)
-        self.stats[buddy][version][tool] += 1
+        self.events.append("%s\t%s\t%s\n" % (buddy, version, tool))
         return
 
     def save(self, send_report=True):
-        if self.config["diagnostics"] == "True" and send_report:
+        """
+        Append the new events to the log with a single write, and start a background compaction if one is due
+        :param send_report: Allow the compaction to send a usage report if one is due
+        :return: None
+        """
+        try:
+            if self.events:
+                fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+                try:
+                    os.write(fd, "".join(self.events).encode())
+                finally:
+                    os.close(fd)
+                self.events = []
+            if (os.path.getsize(self.log_path) >= self.compact_size or not os.path.isfile(self.usage_file_path) or
+                    time() - os.path.getmtime(self.usage_file_path) >= self.compact_age) and self._lock():
+                # The lock is handed over to the background process, so only one compaction is ever started
+                command = "import sys; sys.path.insert(0, %r); import buddy_resources; " \
+                          "buddy_resources.Usage().compact(%s, locked=True)" \
+                          % (os.path.dirname(os.path.abspath(__file__)), send_report)
+                try:
+                    Popen([sys.executable, "-c", command], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                          start_new_session=True)
+                except OSError:
+                    os.remove("%s.lock" % self.usage_file_path)
+        except OSError:  # Usage statistics are never worth crashing (or slowing down) a job over
+            pass
+        return
+
+    def _lock(self):
+        lock_path = "%s.lock" % self.usage_file_path
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time() - os.path.getmtime(lock_path) < self.lock_timeout:
+                    return False
+                os.remove(lock_path)  # Left behind by a compaction that died
+            except FileNotFoundError:  # Another process got here first
+                return False
+            return self._lock()
+
+    def compact(self, send_report=True, locked=False):
+        """
+        Fold the event log into usage.json, and send a report if diagnostics are on and the last one was a week ago.
+        Only one compaction runs at a time; if another process holds the lock, return immediately.
+        :param send_report: Allow a usage report to be sent
+        :param locked: The caller already holds the compaction lock
+        :return: True if the compaction ran
+        """
+        if not locked and not self._lock():
+            return False
+
+        try:
+            # Rename the log out of the way, so new events go to a fresh file. A log left behind by a compaction
+            # that died is picked up first.
+            work_path = "%s.compacting" % self.log_path
+            if not os.path.isfile(work_path) and os.path.isfile(self.log_path):
+                os.rename(self.log_path, work_path)
+            if os.path.isfile(work_path):
+                with open(work_path, "r") as ifile:
+                    for line in ifile:
+                        line = line.rstrip("\n").split("\t")
+                        if len(line) != 3:  # Partially written line
+                            continue
+                        buddy, version, tool = line
+                        self.stats.setdefault(buddy, {})
+                        self.stats[buddy].setdefault(version, {})
+                        self.stats[buddy][version].setdefault(tool, 0)
+                        self.stats[buddy][version][tool] += 1
+
             self.stats.setdefault("last_upload", datetime.date.today().isoformat())
-            if (datetime.datetime.today() - datetime.datetime.strptime(self.stats["last_upload"],
-                                                                       '%Y-%m-%d')).days >= 7:
+            if self.config["diagnostics"] == "True" and send_report and \
+                    (datetime.datetime.today() - datetime.datetime.strptime(self.stats["last_upload"],
+                                                                            '%Y-%m-%d')).days >= 7:
                 self.send_report()
-                return
-        with open(self.usage_file_path, "w") as ofile:
+            else:
+                self._write_stats()
+
+            if os.path.isfile(work_path):
+                os.remove(work_path)
+        finally:
+            os.remove("%s.lock" % self.usage_file_path)
+        return True
+
+    def _write_stats(self):
+        # Write to a temporary file and move it into place, so usage.json is never seen half written
+        tmp_path = "%s.%s" % (self.usage_file_path, os.getpid())
+        with open(tmp_path, "w") as ofile:
             json.dump(self.stats, ofile)
+        os.replace(tmp_path, self.usage_file_path)
         return
 
     def send_report(self):
@@ -144,11 +254,129 @@ class Usage(object):
             self.clear_stats()
             self.stats["last_upload"] = str(datetime.date.today())
         except all_errors as e:
-            if "timed out" in str(e):
-                return
-            print("FTP Error: %s" % e)
+            if "timed out" not in str(e):
+                print("FTP Error: %s" % e)
+
+        self._write_stats()
+        return
+
+
+class Profiler(object):
+    """
+    Per-stage timing for the command line tools, switched on with -prf/--profile or the BUDDY_TRACE environment
+    variable (see start_profiler()). Functions are only wrapped once a Profiler is running, so there is no cost at all
+    when profiling is off. Every call to a wrapped function writes one json event to stderr when it returns, e.g.,
+        {"tool": "SeqBuddy", "stage": "parse", "func": "_parse_records", "depth": 1, "seconds": 0.52,
+         "self_seconds": 0.52, "peak_rss_kb": 81234, "pid": 1234}
+    'seconds' includes any stages nested inside the call, 'self_seconds' does not, and 'peak_rss_kb' is the high water
+    mark of the process so far. A 'summary' event with per-stage totals is written by close().
+    """
+    def __init__(self, tool, pstats_file=None):
+        """
+        :param tool: Name of the Buddy tool, included in every event
+        :param pstats_file: If set, the tool stage is run under cProfile and the stats are dumped to this path
+        """
+        self.tool = tool
+        self.pstats_file = pstats_file
+        self.timer = Timer()
+        self.wrapped = []  # [(owner, attribute name, original function), ...]
+        self.totals = OrderedDict()  # {stage: [calls, seconds, self_seconds]}
+        self._child_seconds = []  # Stack of time spent in nested stages, one entry for each running stage
+
+    def instrument(self, owner, attr, stage):
+        """
+        Replace a function or method with a timed wrapper
+        :param owner: Module or class that holds the function
+        :param attr: Name of the function
+        :param stage: Stage name reported in the events
+        :return: None
+        """
+        func = getattr(owner, attr)
+
+        def timed(*args, **kwargs):
+            return self.call(stage, func, *args, **kwargs)
+
+        timed.__name__ = func.__name__
+        timed.__doc__ = func.__doc__
+        setattr(owner, attr, timed)
+        self.wrapped.append((owner, attr, func))
+        return
 
-        self.save(send_report=False)
+    def call(self, stage, func, *args, **kwargs):
+        """
+        Run func and report how long it took
+        :param stage: Stage name reported in the event
+        :param func: Function to run
+        :return: Whatever func returns
+        """
+        timer = Timer()
+        self._child_seconds.append(0.)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = timer.elapsed()
+            self_seconds = seconds - self._child_seconds.pop()
+            if self._child_seconds:
+                self._child_seconds[-1] += seconds
+            totals = self.totals.setdefault(stage, [0, 0., 0.])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += self_seconds
+            self.event(stage=stage, func=func.__name__, depth=len(self._child_seconds),
+                       seconds=round(seconds, 6), self_seconds=round(self_seconds, 6))
+
+    def run_tool(self, func, *args, **kwargs):
+        """
+        Run the tool stage (i.e., command_line_ui), under cProfile if a pstats file was requested
+        :param func: Function to run
+        :return: Whatever func returns
+        """
+        if not self.pstats_file:
+            return self.call("tool", func, *args, **kwargs)
+
+        import cProfile
+        profile = cProfile.Profile()
+
+        def tool(*_args, **_kwargs):
+            return profile.runcall(func, *_args, **_kwargs)
+
+        tool.__name__ = func.__name__
+        try:
+            return self.call("tool", tool, *args, **kwargs)
+        finally:
+            profile.dump_stats(self.pstats_file)
+            self.event(stage="pstats", path=self.pstats_file)
+
+    def event(self, **kwargs):
+        _event = OrderedDict([("tool", self.tool)])
+        _event.update(kwargs)
+        _event["peak_rss_kb"] = self.peak_rss()
+        _event["pid"] = os.getpid()
+        sys.stderr.write("%s\n" % json.dumps(_event))
+        sys.stderr.flush()
+        return
+
+    @staticmethod
+    def peak_rss():
+        try:
+            import resource
+        except ImportError:  # Windows
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return int(peak / 1024) if sys.platform == "darwin" else peak  # OS X reports bytes, Linux reports kilobytes
+
+    def close(self):
+        """
+        Put the original functions back and write the summary event
+        :return: None
+        """
+        for owner, attr, func in reversed(self.wrapped):
+            setattr(owner, attr, func)
+        self.wrapped = []
+        stages = OrderedDict([(stage, OrderedDict([("calls", calls), ("seconds", round(seconds, 6)),
+                                                   ("self_seconds", round(self_seconds, 6))]))
+                              for stage, (calls, seconds, self_seconds) in self.totals.items()])
+        self.event(stage="summary", seconds=round(self.timer.elapsed(), 6), stages=stages)
         return
 
 
@@ -196,6 +424,232 @@ Contributors:
 
 
 # #################################################### FUNCTIONS ##################################################### #
+def batch_files(paths):
+    """
+    Expand the positional arguments of a batch run into a list of files. Glob patterns are expanded by BuddySuite
+    (quote them to get around shell argument limits) and directories contribute every file they contain.
+    :param paths: List of file paths, directories, and/or glob patterns
+    :return: List of file paths, in the order given (glob and directory matches are sorted)
+    """
+    files = []
+    for path in paths:
+        if not isinstance(path, str):
+            raise ValueError("Batch mode requires file paths as input, not piped data.")
+        if os.path.isfile(path):
+            files.append(path)
+        elif os.path.isdir(path):
+            dir_files = [os.path.join(path, x) for x in os.listdir(path)]
+            files += sorted([x for x in dir_files if os.path.isfile(x)])
+        else:
+            matches = sorted([x for x in glob(path) if os.path.isfile(x)])
+            if not matches:
+                raise ValueError("No files found matching '%s'." % path)
+            files += matches
+    if not files:
+        raise ValueError("No input files found.")
+    return files
+
+
+def run_batch(in_args, positional, command_line_ui, build_buddy, buddy_flags, out_dir=None, max_processes=0):
+    """
+    Run a command independently on each input file, spread across a pool of worker processes. The workers are
+    forked from the current process, so the interpreter and Biopython are only loaded once for the whole batch.
+    Whatever the command would print to stdout is written next to each input file (<name>.<tool><ext>), or into
+    out_dir under the original file name. A file fails if building its buddy object or running the command raises an
+    error (command_line_ui() re-raises errors for batch jobs, instead of only printing them).
+    :param in_args: argparse Namespace of the batch call
+    :param positional: Name of the positional argument holding the input files (e.g., "sequence")
+    :param command_line_ui: The command_line_ui() function of the buddy being run
+    :param build_buddy: Function that takes a file path and returns the object passed into command_line_ui()
+    :param buddy_flags: Flag dictionary of the buddy (e.g., sb_flags), used to name output files
+    :param out_dir: Write output files into this directory instead of next to the inputs
+    :param max_processes: Number of worker processes (0 uses all available cores)
+    :return: List of (file_path, status, seconds, detail) tuples, where detail is the output path or error message
+    """
+    files = batch_files(getattr(in_args, positional))
+    tool = [x for x in sorted(buddy_flags) if getattr(in_args, x, None)]
+    if not tool:
+        raise ValueError("Batch mode requires a command to run on each file.")
+    tool = tool[0]
+
+    # Output paths are settled up front, so no file can be written over by another job (or replace an input)
+    if out_dir:
+        out_paths = [os.path.join(out_dir, os.path.basename(file_path)) for file_path in files]
+    else:
+        out_paths = ["%s.%s%s" % (os.path.splitext(file_path)[0], tool, os.path.splitext(file_path)[1])
+                     for file_path in files]
+    in_paths = set([os.path.realpath(file_path) for file_path in files])
+    seen = set()
+    for out_path in out_paths:
+        real_path = os.path.realpath(out_path)
+        if real_path in in_paths:
+            raise ValueError("Batch output '%s' would overwrite an input file." % out_path)
+        if real_path in seen:
+            raise ValueError("More than one input file would be written to '%s'." % out_path)
+        seen.add(real_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    jobs = list(zip(files, out_paths))
+    max_processes = usable_cpu_count() if not max_processes else max_processes
+    chunk_size = max(1, int(len(jobs) / (max_processes * 4)) + 1)
+    chunks = [(indx, jobs[indx:indx + chunk_size]) for indx in range(0, len(jobs), chunk_size)]
+    tmp_dir = TempDir()
+
+    def batch_job(chunk):
+        indx, chunk_jobs = chunk
+        real_stdout, real_stderr = sys.stdout, sys.stderr
+        for file_path, out_path in chunk_jobs:
+            start = time()
+            status, detail = "ok", ""
+            job_args = copy(in_args)
+            job_args.batch = False
+            job_args.batch_job = True
+            setattr(job_args, positional, [file_path])
+            sys.stdout, sys.stderr = StringIO(), StringIO()
+            try:
+                command_line_ui(job_args, build_buddy(file_path), skip_exit=True)
+            except SystemExit as err:
+                if err.code not in [None, 0]:
+                    status, detail = "failed", "SystemExit: %s" % err.code
+            except Exception as err:
+                status, detail = "failed", "%s: %s" % (err.__class__.__name__, err)
+            finally:
+                output = sys.stdout.getvalue()
+                sys.stdout, sys.stderr = real_stdout, real_stderr
+
+            if status == "ok" and output:
+                detail = out_path
+                with open(out_path, "w") as ofile:
+                    ofile.write(output)
+            # Report after every file, so a crash only loses the file that caused it
+            with open(os.path.join(tmp_dir.path, str(indx)), "a") as ofile:
+                ofile.write("%s\t%s\t%s\t%s\n" % (file_path, status, time() - start, re.sub("[\t\n]", " ", detail)))
+
+    run_multicore_function(chunks, batch_job, max_processes=max_processes, quiet=in_args.quiet, out_type=sys.stderr)
+
+    results = {}
+    for indx, chunk_jobs in chunks:
+        report_path = os.path.join(tmp_dir.path, str(indx))
+        if os.path.isfile(report_path):
+            with open(report_path, "r") as ifile:
+                for line in ifile.read().strip().split("\n"):
+                    file_path, status, seconds, detail = line.split("\t")
+                    results[file_path] = (file_path, status, float(seconds), detail)
+    # Anything not reported was lost when a worker process died
+    return [results.get(file_path, (file_path, "failed", 0., "Worker process exited unexpectedly"))
+            for file_path in files]
+
+
+def batch_report(results, quiet=False):
+    """
+    Print the results of run_batch(), one tab delimited line per file on stdout and a summary on stderr
+    :param results: List of (file_path, status, seconds, detail) tuples
+    :param quiet: Suppress the summary
+    :return: Number of files that failed
+    """
+    for file_path, status, seconds, detail in results:
+        sys.stdout.write("%s\t%s\t%s\t%s\n" % (file_path, status, round(seconds, 3), detail))
+    failed = len([x for x in results if x[1] != "ok"])
+    if not quiet:
+        sys.stderr.write("# %s files processed, %s failed (%s seconds of work)\n" %
+                         (len(results), failed, round(sum([x[2] for x in results]), 3)))
+    return failed
+
+
+def start_profiler(tool, in_args, stages):
+    """
+    Start a Profiler if -prf/--profile was passed or BUDDY_TRACE is set in the environment. Either one can be '1' (just
+    the timing events) or a file path (also dump cProfile stats of the tool stage to that file).
+    :param tool: Name of the Buddy tool
+    :param in_args: argparse namespace
+    :param stages: List of (owner, attribute name, stage) tuples to instrument
+    :return: The Profiler, or None if profiling is off
+    """
+    global PROFILER
+    setting = getattr(in_args, "profile", None) or os.environ.get("BUDDY_TRACE")
+    if not setting or setting == "0":
+        return None
+
+    stop_profiler()
+    PROFILER = Profiler(tool, None if setting in [True, "1"] else os.path.abspath(setting))
+    for owner, attr, stage in stages:
+        PROFILER.instrument(owner, attr, stage)
+    return PROFILER
+
+
+def stop_profiler():
+    global PROFILER
+    if PROFILER:
+        PROFILER.close()
+        PROFILER = None
+    return
+
+
+def cost_models():
+    """
+    The per-command cost models used to estimate memory and run time (see COST_MODELS), updated with any values
+    calibrated by `benchmarks.py calibrate --save_costs`
+    :return: dict of {tool: {command: [bytes per unit, seconds per unit]}}
+    """
+    models = {tool: dict(commands) for tool, commands in COST_MODELS.items()}
+    if os.path.isfile(COST_MODEL_FILE):
+        with open(COST_MODEL_FILE, "r") as ifile:
+            for tool, commands in json.load(ifile).items():
+                models.setdefault(tool, {}).update(commands)
+    return models
+
+
+def preflight(in_args, positional, buddy_flags, estimate):
+    """
+    Estimate the peak memory and run time of a command line call before any input is loaded. With -est/--estimate
+    the estimates are written to stdout as a table. If the BUDDY_MEMORY_BUDGET environment variable is set (in MB),
+    a warning is written to stderr whenever the memory estimate is over it.
+    :param in_args: argparse Namespace
+    :param positional: Name of the positional argument holding the input files (e.g., "sequence")
+    :param buddy_flags: Flag dictionary of the buddy (e.g., sb_flags), used to find the command being run
+    :param estimate: Function that takes a file path and a command name, and returns an estimate dict
+    :return: List of estimate dicts, one for each input file
+    """
+    command = [x for x in sorted(buddy_flags) if getattr(in_args, x, None)]
+    command = command[0] if command else "default"
+    files = [x for x in getattr(in_args, positional) if isinstance(x, str) and os.path.isfile(x)]
+    estimates = [estimate(file_path, command) for file_path in files]
+
+    if getattr(in_args, "estimate", False):
+        columns = ["file", "command", "records", "residues", "features", "memory_mb", "seconds"]
+        sys.stdout.write("%s\n" % "\t".join(columns))
+        for _estimate in estimates:
+            sys.stdout.write("%s\n" % "\t".join([str(_estimate[column]) for column in columns]))
+        sys.stdout.flush()
+
+    budget = memory_budget()
+    memory = sum([_estimate["memory_mb"] for _estimate in estimates])
+    if budget is not None and memory > budget:
+        sys.stderr.write("Warning: %s is estimated to need ~%s MB of memory, which is over the BUDDY_MEMORY_BUDGET of "
+                         "%s MB.\n" % (command, int(memory), os.environ["BUDDY_MEMORY_BUDGET"]))
+    return estimates
+
+
+def memory_budget():
+    """
+    Read the BUDDY_MEMORY_BUDGET environment variable. A value that isn't a positive number is ignored with a warning.
+    :return: The budget in MB as a float, or None
+    """
+    budget = os.environ.get("BUDDY_MEMORY_BUDGET")
+    if not budget:
+        return None
+    try:
+        budget = float(budget)
+        if not 0 < budget < float("inf"):
+            raise ValueError
+    except ValueError:
+        sys.stderr.write("Warning: BUDDY_MEMORY_BUDGET should be a number of MB, not '%s'. It will be ignored.\n"
+                         % os.environ["BUDDY_MEMORY_BUDGET"])
+        return None
+    return budget
+
+
 def config_values():
     config_file = "%s/.buddysuite/config.ini" % os.path.expanduser('~')
     if os.path.isfile(config_file):
@@ -296,103 +750,244 @@ def parse_format(_format):
     return _format
 
 
-def phylip_sequential_out(_input, relaxed=True, _type="alignbuddy"):
-    output = ""
+def phylip_sequential_out(_input, relaxed=True, _type="alignbuddy", handle=None):
+    """
+    Write alignments in sequential phylip format
+    :param _input: AlignBuddy or SeqBuddy object
+    :param relaxed: Allow IDs longer than 10 characters (phylipsr) or truncate them (phylipss)
+    :param _type: Specify whether _input is an "alignbuddy" or "seqbuddy" object
+    :param handle: Writable file-like object. If provided, output is streamed into it instead of being returned.
+    :return: Phylip formatted string, or the handle if one was provided
+    """
+    out_handle = StringIO() if handle is None else handle
     if _type == "alignbuddy":
         alignments = _input.alignments
     else:
         alignments = [_input.records]
 
     for alignment in alignments:
-        ids = []
-        id_check = []
+        # Everything is validated before anything is written, so a malformed alignment never leaves a partial file
+        id_check = set()
         aln_len = 0
         for rec in alignment:
             if rec.id in id_check:
                 raise PhylipError("Malformed Phylip --> Repeat id '%s'" % rec.id)
-            id_check.append(rec.id)
+            id_check.add(rec.id)
             if not aln_len:
-                aln_len = len(str(rec.seq))
+                aln_len = len(rec.seq)
 
         max_id_len = 0
         for rec in alignment:
-            if len(str(rec.seq)) != aln_len:
+            if len(rec.seq) != aln_len:
                 raise PhylipError("Malformed Phylip --> The length of record '%s' is incorrect" % rec.id)
             max_id_len = len(rec.id) if len(rec.id) > max_id_len else max_id_len
 
-        output += " %s %s" % (len(alignment), aln_len)
+        seq_ids = []
+        id_check = set()
         for rec in alignment:
             if relaxed:
-                seq_id = re.sub('[ \t]+', '_', rec.id)
-                output += "\n%s%s" % (seq_id.ljust(max_id_len + 2), rec.seq)
+                seq_id = re.sub('[ \t]+', '_', rec.id).ljust(max_id_len + 2)
             else:
                 seq_id = rec.id[:10].ljust(10)
-                output += "\n%s%s" % (seq_id, rec.seq)
 
-            if seq_id in ids:
+            if seq_id in id_check:
                 raise PhylipError("Malformed Phylip --> Repeat id '%s' after strict truncation. "
                                   "Try a relaxed Phylip format (phylipr or phylipsr)." % seq_id)
-            ids.append(seq_id)
+            id_check.add(seq_id)
+            seq_ids.append(seq_id)
 
-        output += "\n\n"
-    return output
+        out_handle.write(" %s %s" % (len(alignment), aln_len))
+        for seq_id, rec in zip(seq_ids, alignment):
+            out_handle.write("\n%s%s" % (seq_id, str(rec.seq)))
+        out_handle.write("\n\n")
+    return out_handle.getvalue() if handle is None else handle
 
 
 def phylip_sequential_read(sequence, relaxed=True):
+    """
+    Parse sequential phylip format in a single pass, building the alignments directly from token offsets
+    :param sequence: Phylip formatted string
+    :param relaxed: IDs are separated from sequence by whitespace (phylipsr), or fixed at 10 characters (phylipss)
+    :return: List of MultipleSeqAlignment objects
+    """
     sequence = "\n %s" % sequence.strip()
-    sequence = re.sub("\n+", "\n", sequence)
+    while "\n\n" in sequence:  # str.replace is much faster than re.sub("\n+", ...) on very large inputs
+        sequence = sequence.replace("\n\n", "\n")
     alignments = re.split("\n *([0-9]+) ([0-9]+)\n", sequence)[1:]
-    align_dict = OrderedDict()
-    for indx in range(int(len(alignments) / 3)):
-        align_dict[(int(alignments[indx * 3]), int(alignments[indx * 3 + 1]), indx)] = alignments[indx * 3 + 2]
+    token_regex = re.compile("([^ ]*) *")  # A run of non-space characters, plus any spaces that follow it
 
-    temp_file = TempFile()
     aligns = []
-    for _key, seqs in align_dict.items():
+    for indx in range(int(len(alignments) / 3)):
+        num_recs, num_cols = int(alignments[indx * 3]), int(alignments[indx * 3 + 1])
+        seqs = alignments[indx * 3 + 2].replace("\n", " ").replace("\t", " ").strip()
+        seqs_len = len(seqs)
         records = []
-        seqs = re.sub("[\n\t]", " ", seqs).strip()
-        while seqs != "":
+        pos = 0
+        while pos < seqs_len:
             if not relaxed:
-                _id = seqs[:10]
-                seqs = seqs[10:]
+                _id = seqs[pos:pos + 10]
+                pos += 10
             else:
-                _id = re.match("([^ ]+) +", seqs).group(1)
-                seqs = re.sub("[^ ]+ +", "", seqs, count=1)
-            rec = ""
-            while len(rec) < _key[1]:
-                breakdown = re.match("([^ ]+)", seqs)
-                if not breakdown:
+                token = token_regex.match(seqs, pos)
+                if token.end() == seqs_len:  # ID with no sequence after it
                     raise PhylipError("Malformed Phylip --> Less sequence found than expected")
-                rec += breakdown.group(0)
-                if re.match("[^ ]+$", seqs):
-                    seqs = ""
-                seqs = re.sub("[^ ]+ +", "", seqs, count=1)
+                _id = token.group(1)
+                pos = token.end()
+
+            rec = []
+            rec_len = 0
+            while rec_len < num_cols:
+                token = token_regex.match(seqs, pos)
+                if pos >= seqs_len or not token.group(1):
+                    raise PhylipError("Malformed Phylip --> Less sequence found than expected")
+                rec.append(token.group(1))
+                rec_len += token.end(1) - pos
+                pos = token.end()
 
-            records.append((_id, rec))
+            records.append((_id, "".join(rec), rec_len))
 
-        if len(records) != _key[0]:
-            raise PhylipError("Malformed Phylip --> %s sequences expected, %s found." % (_key[0], len(records)))
+        if len(records) != num_recs:
+            raise PhylipError("Malformed Phylip --> %s sequences expected, %s found." % (num_recs, len(records)))
 
-        key_list = []
-        output = ""
-        for seq_id, seq in records:
-            if _key[1] != len(seq):
+        key_list = set()
+        seq_records = []
+        for seq_id, seq, seq_len in records:
+            if num_cols != seq_len:
                 raise PhylipError("Malformed Phylip --> Sequence %s has %s columns, %s expected." %
-                                  (seq_id, len(seq), _key[1]))
+                                  (seq_id, seq_len, num_cols))
             if seq_id in key_list:
                 if relaxed:
                     raise PhylipError("Malformed Phylip --> Repeat ID %s." % seq_id)
                 else:
                     raise PhylipError("Malformed Phylip --> Repeat id '%s' after strict truncation. "
                                       "Try a relaxed Phylip format (phylipr or phylipsr)." % seq_id)
-            key_list.append(seq_id)
-            output += ">%s\n%s\n" % (seq_id, seq)
-        temp_file.write(output, "w")
-        aligns.append(AlignIO.read(temp_file.get_handle("r"), "fasta"))
-        temp_file.close()
+            key_list.add(seq_id)
+            # Mirror what a round trip through a fasta file would produce (the first word is the ID)
+            description = seq_id.rstrip()
+            rec_id = description.split(None, 1)[0] if description else ""
+            seq_records.append(SeqRecord(Seq(seq, single_letter_alphabet), id=rec_id, name=rec_id,
+                                         description=description))
+        aligns.append(MultipleSeqAlignment(seq_records))
     return aligns
 
 
+def map_regex(mapping):
+    """
+    Compile a single alternation that will match any of the keys in a substitution map. Longer keys are tried first,
+    so a key that happens to be a prefix of another key can not shadow it.
+    :param mapping: dict-like object of {query: replacement} pairs
+    :return: Compiled regex object, or None if the map is empty
+    """
+    if not mapping:
+        return None
+    keys = sorted([str(key) for key in mapping], key=len, reverse=True)
+    return re.compile("|".join([re.escape(key) for key in keys]))
+
+
+def rename_from_map(input_str, mapping, regex=None):
+    """
+    Substitute every key found in a string with its value from `mapping`, in a single pass. This is how hashed IDs are
+    restored after running third party programs, so exact matches are resolved with a dict lookup before falling
+    back on the compiled alternation.
+    :param input_str: The string to be modified
+    :param mapping: dict-like object of {query: replacement} pairs
+    :param regex: Pre-compiled output of map_regex(mapping), to avoid re-compiling in loops
+    :return: The modified string
+    """
+    if not mapping:
+        return input_str
+    if input_str in mapping:
+        return str(mapping[input_str])
+    regex = map_regex(mapping) if regex is None else regex
+    return regex.sub(lambda match: str(mapping[match.group(0)]), input_str)
+
+
+def rename_records_from_map(records, mapping):
+    """
+    Bulk rename SeqRecord IDs (e.g., hash_ids() -> hash_map) without scanning every record once per key.
+    :param records: List of SeqRecord objects
+    :param mapping: dict-like object of {current id: new id} pairs
+    :return: The list of modified records
+    """
+    regex = None
+    for rec in records:
+        if rec.id in mapping:
+            new_id = str(mapping[rec.id])
+        else:
+            regex = map_regex(mapping) if regex is None else regex
+            new_id = rename_from_map(rec.id, mapping, regex)
+        if rec.description.startswith(rec.id):
+            rec.description = rec.description[len(rec.id) + 1:]
+        rec.id = new_id
+        rec.name = new_id
+    return records
+
+
+class Replacer(object):
+    """
+    Compiled form of replacements(). The query is compiled and the replacement string validated once, so the same
+    substitution can be applied to any number of strings (e.g., every ID in a large file) without re-parsing.
+    :param query: Regular expression
+    :param replace: Replacement string (may contain back references to parenthesized groups in the query)
+    :param num: Maximum number of substitutions. Positive values work left-to-right, negative values right-to-left,
+                and 0 replaces everything.
+    """
+    regex_chars = set(".^$*+?{}[]\\|()")
+
+    def __init__(self, query, replace="", num=0):
+        check_parentheses = re.findall("\([^()]*\)", query)
+        check_replacement = re.findall(r"\\[0-9]+", replace)
+        check_replacement = sorted([int(match[1:]) for match in check_replacement])
+        if check_replacement and check_replacement[-1] > len(check_parentheses):
+            raise AttributeError("There are more replacement match values specified than query parenthesized groups")
+
+        self.query = query
+        self.replace = replace
+        self.num = num
+        # Plain strings can skip the regex engine entirely
+        self.literal = query != "" and not set(query) & self.regex_chars and "\\" not in replace
+        self.regex = None if self.literal else re.compile(query)
+
+    def sub(self, input_str):
+        input_str = str(input_str)
+        if self.num < 0:
+            return self._sub_right(input_str)
+        if self.literal:
+            return input_str.replace(self.query, self.replace, self.num if self.num else -1)
+        return self.regex.sub(self.replace, input_str, self.num)
+
+    def _sub_right(self, input_str):
+        # Each replacement is made at the right-most position the query can match, and the next one is searched for
+        # to the left of that position only.
+        new_str = ""
+        end = len(input_str)
+        for _ in range(abs(self.num)):
+            if end == 0:
+                break
+            if self.literal:
+                start = input_str.rfind(self.query, 0, end)
+                if start == -1:
+                    break
+                new_str = self.replace + input_str[start + len(self.query):end] + new_str
+            else:
+                match = None
+                for match in self.regex.finditer(input_str, 0, end):
+                    pass
+                if match is None:
+                    break
+                # Nothing can begin after the end of the last non-overlapping match, but an overlapping one might
+                for start in range(match.end(), match.start() - 1, -1):
+                    right_match = self.regex.match(input_str, start, end)
+                    if right_match:
+                        match = right_match
+                        break
+                start = match.start()
+                replace = match.expand(self.replace) if "\\" in self.replace else self.replace
+                new_str = replace + input_str[match.end():end] + new_str
+            end = start
+        return input_str[:end] + new_str
+
+
 def replacements(input_str, query, replace="", num=0):
     """
     This will allow fancy positional regular expression replacements from left-to-right, as well as normal right-to-left
@@ -402,41 +997,7 @@ def replacements(input_str, query, replace="", num=0):
     :param num:
     :return:
     """
-    check_parentheses = re.findall("\([^()]*\)", query)
-    check_replacement = re.findall(r"\\[0-9]+", replace)
-    check_replacement = sorted([int(match[1:]) for match in check_replacement])
-    if check_replacement and check_replacement[-1] > len(check_parentheses):
-        raise AttributeError("There are more replacement match values specified than query parenthesized groups")
-
-    if num < 0:
-        if check_replacement:
-            for indx in sorted(range(check_replacement[-1]), reverse=True):
-                indx += 1
-                replace = re.sub(r"\\%s" % indx, r"\\%s" % (indx + 1), replace)
-            right_replace = "\\%s" % (len(check_replacement) + 2)
-        else:
-            right_replace = "\\2"
-        leftmost = str(input_str)
-        new_str = str(input_str)
-        rightmost = ""
-        hash_to_split_on = "UPNFSZ7FQ6RBhfFzwt0Cku4Yr1n2VvwVUG7x97G7"
-        for _ in range(abs(num)):
-            if leftmost == "":
-                break
-            new_str = re.sub(r"(.*)%s(.*)" % query,
-                             r"\1%s%s%s" % (hash_to_split_on, replace, right_replace), leftmost, 1)
-            new_str = new_str.split(hash_to_split_on)
-            if len(new_str) == 2:
-                leftmost = new_str[0]
-                rightmost = new_str[1] + rightmost
-                new_str = leftmost + rightmost
-            else:
-                new_str = leftmost + rightmost
-                break
-    else:
-        new_str = re.sub(query, replace, input_str, num)
-
-    return new_str
+    return Replacer(query, replace, num).sub(input_str)
 
 
 def send_traceback(tool, function, e):
@@ -621,26 +1182,67 @@ def _old2new(feat, old_rec, new_rec):
     return feat
 
 
-def remap_gapped_features(old_records, new_records):
+def _remap_record_features(old_rec, new_rec):
+    # Start by forcing feature start-end positions onto actual residues, in cases were they fall on gaps
+    features = []
+    for feat in old_rec.features:
+        features.append(ungap_feature_ends(feat, old_rec))
+    old_rec.features = features
+    features = []
+    for feat in old_rec.features:
+        feat = _old2new(feat, old_rec, new_rec)
+        if feat:
+            features.append(feat)
+    new_rec.features = features
+    return
+
+
+def remap_gapped_features(old_records, new_records, max_processes=0):
     """
     If adding, subtracting, or moving around in a sequence, the features need to be shifted to accomodate.
-    This only works if all of the original non-gap residues are present in the new record
+    This only works if all of the original non-gap residues are present in the new record.
+    Records without features are skipped, and if at least REMAP_PARALLEL_SIZE records have features they are remapped
+    on multiple cores.
     :param old_records: Starting sequence (can be gapped as well)
     :param new_records: New sequence with different gap pattern
+    :param max_processes: Number of processes used for large jobs (0 uses all available cores)
     :return:
     """
-    # Start by forcing feature start-end positions onto actual residues, in cases were they fall on gaps
+    pairs = []
     for old_rec, new_rec in zip(old_records, new_records):
+        if old_rec.features:
+            pairs.append((old_rec, new_rec))
+        else:
+            new_rec.features = []
+
+    if len(pairs) < REMAP_PARALLEL_SIZE or max_processes == 1:
+        for old_rec, new_rec in pairs:
+            _remap_record_features(old_rec, new_rec)
+        return new_records
+
+    max_processes = usable_cpu_count() if not max_processes else max_processes
+    chunk_size = int(len(pairs) / max_processes) + 1
+    chunks = [(indx, pairs[indx:indx + chunk_size]) for indx in range(0, len(pairs), chunk_size)]
+    tmp_dir = TempDir()
+
+    def remap_chunk(chunk):
+        indx, chunk_pairs = chunk
         features = []
-        for feat in old_rec.features:
-            features.append(ungap_feature_ends(feat, old_rec))
-        old_rec.features = features
-        features = []
-        for feat in old_rec.features:
-            feat = _old2new(feat, old_rec, new_rec)
-            if feat:
-                features.append(feat)
-        new_rec.features = features
+        for _old_rec, _new_rec in chunk_pairs:
+            _remap_record_features(_old_rec, _new_rec)
+            features.append((_old_rec.features, _new_rec.features))
+        with open(os.path.join(tmp_dir.path, str(indx)), "wb") as ofile:
+            pickle.dump(features, ofile)  # Pickled together, so old and new records still share feature objects
+
+    run_multicore_function(chunks, remap_chunk, max_processes=max_processes, quiet=True)
+    for indx, chunk_pairs in chunks:
+        if not os.path.isfile(os.path.join(tmp_dir.path, str(indx))):
+            raise RuntimeError("A worker process failed while remapping features.")
+        with open(os.path.join(tmp_dir.path, str(indx)), "rb") as ifile:
+            features = pickle.load(ifile)
+        for (old_rec, new_rec), (old_features, new_features) in zip(chunk_pairs, features):
+            old_rec.features = old_features
+            new_rec.features = new_features
     return new_records
 
 
@@ -650,6 +1252,26 @@ contributors = [Contributor("Stephen", "Bond", commits=720, github="https://gith
                 Contributor("Karl", "Keat", commits=299, github="https://github.com/KarlKeat"),
                 Contributor("Jeremy", "Labarge", commits=25, github="https://github.com/biojerm")]
 
+PROFILER = None  # The running Profiler, if any (see start_profiler())
+
+# remap_gapped_features() switches to multiple cores when at least this many records have features
+REMAP_PARALLEL_SIZE = 1000
+
+# Cost models for the pre-flight estimates. Each command is [bytes, seconds] per unit of input, where
+# units = residues + 200 * records + 500 * features (see SeqBuddy.estimate_resources()). 'startup' is a flat
+# [MB, seconds] for the interpreter and imports, and 'load' (or 'index', for the SeqBuddy commands that work straight
+# off a SeqIndex) is added to every command. Unlisted commands use 'default'. Values in COST_MODEL_FILE, written by
+# `benchmarks.py calibrate --save_costs`, take precedence over these.
+COST_MODEL_FILE = "%s/cost_models.json" % os.path.dirname(os.path.abspath(__file__))
+COST_MODELS = {"SeqBuddy": {"startup": [60., 0.5], "load": [4., 4.e-07], "index": [0.1, 5.e-08],
+                            "default": [4., 2.e-07], "back_translate": [12., 4.e-06], "clean_seq": [4., 5.e-07],
+                            "delete_repeats": [6., 6.e-07], "find_repeats": [6., 5.e-07], "hash_seq_ids": [4., 1.e-07],
+                            "group_by_prefix": [8., 3.e-07], "merge": [8., 6.e-07], "reverse_complement": [5., 3.e-07],
+                            "translate": [6., 2.e-06], "translate6frames": [40., 1.2e-05]},
+               "AlignBuddy": {"startup": [60., 0.5], "load": [4., 5.e-07], "default": [4., 2.e-07],
+                              "bootstrap": [8., 1.e-06], "consensus": [2., 1.e-06], "generate_alignment": [6., 2.e-05],
+                              "translate": [6., 2.e-06], "trimal": [8., 2.e-06]}}
+
 # NOTE: If this is added to, be sure to update the unit test!
 format_to_extension = {'fasta': 'fa', 'fa': 'fa', 'genbank': 'gb', 'gb': 'gb', 'newick': 'nwk', 'nwk': 'nwk',
                        'nexus': 'nex', 'nex': 'nex', 'phylip': 'phy', 'phy': 'phy', 'phylip-relaxed': 'phyr',
@@ -710,6 +1332,10 @@ sb_flags = {"annotate": {"flag": "ano",
                             "help": "Concatenate a bunch of sequences into a single solid string. Pass in "
                                     "the word 'clean' to remove stops, gaps, etc., from the sequences "
                                     "before concatenating"},
+            "convert_quality": {"flag": "cq",
+                                "action": "store",
+                                "choices": ["sanger", "illumina", "solexa"],
+                                "help": "Convert FASTQ quality scores to a different encoding (sets the output format)"},
             "count_codons": {"flag": "cc",
                              "action": "append",
                              "nargs": "?",
@@ -735,6 +1361,11 @@ sb_flags = {"annotate": {"flag": "ano",
                              "metavar": "<threshold (int)>",
                              "type": int,
                              "help": "Delete sequences with length above threshold"},
+            "delete_low_quality": {"flag": "dlq",
+                                   "action": "store",
+                                   "metavar": "<threshold (int)>",
+                                   "type": int,
+                                   "help": "Delete FASTQ records with mean Phred quality below threshold"},
             "delete_metadata": {"flag": "dm",
                                 "action": "store_true",
                                 "help": "Remove meta-data from file (only id is retained)"},
@@ -875,6 +1506,11 @@ sb_flags = {"annotate": {"flag": "ano",
             "order_ids_randomly": {"flag": "oir",
                                    "action": "store_true",
                                    "help": "Randomly reorder the position of each record"},
+            "pipeline": {"flag": "pl",
+                         "action": "store",
+                         "metavar": "<'tool [args]; tool [args]; ...'>",
+                         "help": "Run several tools in order, reading and writing the sequences only once. "
+                                 "E.g., -pl 'clean_seq; uppercase; translate; delete_small 50'"},
             "pull_random_record": {"flag": "prr",
                                    "action": "append",
                                    "nargs": "?",
@@ -897,6 +1533,9 @@ sb_flags = {"annotate": {"flag": "ano",
                       "metavar": "<Max BLAST score (int)>",
                       "type": int,
                       "help": "Delete sequences with high similarity"},
+            "quality_summary": {"flag": "qs",
+                                "action": "store_true",
+                                "help": "Per-position mean/min/max Phred quality of FASTQ records"},
             "rename_ids": {"flag": "ri",
                            "action": "append",
                            "metavar": "args",
@@ -937,6 +1576,13 @@ sb_flags = {"annotate": {"flag": "ano",
             "translate6frames": {"flag": "tr6",
                                  "action": "store_true",
                                  "help": "Translate nucleotide sequences into all six reading frames"},
+            "trim_quality": {"flag": "tq",
+                             "action": "append",
+                             "nargs": "*",
+                             "type": int,
+                             "metavar": "int",
+                             "help": "Sliding window quality trim of FASTQ records. "
+                                     "Args: [threshold (default 20)] [window size (default 4)]"},
             "uppercase": {"flag": "uc",
                           "action": "store_true",
                           "help": "Convert all sequences to uppercase"}}
@@ -945,12 +1591,23 @@ sb_flags = {"annotate": {"flag": "ano",
 sb_modifiers = {"alpha": {"flag": "a",
                           "action": "store",
                           "help": "If you want the file read with a specific alphabet"},
+                "batch": {"flag": "bt",
+                          "action": "store_true",
+                          "help": "Run the command on each input file separately and in parallel. Accepts paths, "
+                                  "directories, or quoted glob patterns. Output goes to <name>.<command><ext>"},
+                "estimate": {"flag": "est",
+                             "action": "store_true",
+                             "help": "Estimate the peak memory and run time of the command, without running it"},
                 "in_format": {"flag": "f",
                               "action": "store",
                               "help": "If SeqBuddy can't guess the file format, just specify it directly"},
                 "in_place": {"flag": "i",
                              "action": "store_true",
                              "help": "Rewrite the input file in-place. Be careful!"},
+                "out_dir": {"flag": "od",
+                            "action": "store",
+                            "metavar": "<path>",
+                            "help": "Used with -bt, write the output files into this directory instead"},
                 "out_format": {"flag": "o",
                                "metavar": "",
                                "action": "store",
@@ -960,6 +1617,14 @@ sb_modifiers = {"alpha": {"flag": "a",
                            "metavar": "",
                            "nargs": "+",
                            "help": "Free form arguments for some functions"},
+                "profile": {"flag": "prf",
+                            "action": "store",
+                            "nargs": "?",
+                            "const": True,
+                            "metavar": "pstats file",
+                            "help": "Write json timing and peak memory events for each stage to stderr, and "
+                                    "optionally dump cProfile stats of the tool call to a file. "
+                                    "Also set with BUDDY_TRACE=1 or BUDDY_TRACE=<pstats file>"},
                 "quiet": {"flag": "q",
                           "action": "store_true",
                           "help": "Suppress stderr messages"},
@@ -968,7 +1633,13 @@ sb_modifiers = {"alpha": {"flag": "a",
                          "help": "Run the function and return any stderr/stdout other than sequences"}}
 
 # #################################################### ALIGNBUDDY #################################################### #
-alb_flags = {"alignment_lengths": {"flag": "al",
+alb_flags = {"add_to_alignment": {"flag": "ata",
+                                  "action": "append",
+                                  "nargs": "+",
+                                  "metavar": "args",
+                                  "help": "Add unaligned sequences to the alignment without realigning it. "
+                                          "args: <sequence file> [mafft|clustalo|builtin] [optional params]"},
+             "alignment_lengths": {"flag": "al",
                                    "action": "store_true",
                                    "help": "Returns a list of alignment lengths"},
              "bootstrap": {"flag": "bts",
@@ -1013,6 +1684,13 @@ alb_flags = {"alignment_lengths": {"flag": "al",
                                     "metavar": "args",
                                     "help": "Create a new alignment from unaligned sequences. "
                                             "args: [alignment program] [optional params]"},
+             "generate_alignment_groups": {"flag": "gag",
+                                           "action": "append",
+                                           "nargs": "*",
+                                           "metavar": "args",
+                                           "help": "Align each input file (or every file in an input directory) "
+                                                   "separately and in parallel. Results are combined, or written to "
+                                                   "-od. args: [alignment program] [optional params]"},
              "hash_ids": {"flag": "hi",
                           "action": "append",
                           "nargs": "?",
@@ -1081,7 +1759,14 @@ alb_flags = {"alignment_lengths": {"flag": "al",
                            "help": "Convert all sequences to uppercase"},
              }
 
-alb_modifiers = {"in_format": {"flag": "f",
+alb_modifiers = {"batch": {"flag": "bt",
+                           "action": "store_true",
+                           "help": "Run the command on each input file separately and in parallel. Accepts paths, "
+                                   "directories, or quoted glob patterns. Output goes to <name>.<command><ext>"},
+                 "estimate": {"flag": "est",
+                              "action": "store_true",
+                              "help": "Estimate the peak memory and run time of the command, without running it"},
+                 "in_format": {"flag": "f",
                                "action": "store",
                                "help": "If AlignBuddy can't guess the file format, just specify it directly"},
                  "in_place": {"flag": "i",
@@ -1090,9 +1775,21 @@ alb_modifiers = {"in_format": {"flag": "f",
                  "keep_temp": {"flag": "k",
                                "action": "store",
                                "help": "Save temporary files created by generate_tree in current working directory"},
+                 "out_dir": {"flag": "od",
+                             "action": "store",
+                             "metavar": "<path>",
+                             "help": "Used with -bt or -gag, write the output files into this directory instead"},
                  "out_format": {"flag": "o",
                                 "action": "store",
                                 "help": "If you want a specific format output"},
+                 "profile": {"flag": "prf",
+                             "action": "store",
+                             "nargs": "?",
+                             "const": True,
+                             "metavar": "pstats file",
+                             "help": "Write json timing and peak memory events for each stage to stderr, and "
+                                     "optionally dump cProfile stats of the tool call to a file. "
+                                     "Also set with BUDDY_TRACE=1 or BUDDY_TRACE=<pstats file>"},
                  "quiet": {"flag": "q",
                            "action": "store_true",
                            "help": "Suppress stderr messages"},
@@ -1171,7 +1868,21 @@ pb_flags = {"consensus_tree": {"flag": "ct",
                                "help": "Remove any roots"}
             }
 
-pb_modifiers = {"in_format": {"flag": "f",
+pb_modifiers = {"batch": {"flag": "bt",
+                          "action": "store_true",
+                          "help": "Run the command on each input file separately and in parallel. Accepts paths, "
+                                  "directories, or quoted glob patterns. Output goes to <name>.<command><ext>"},
+                "burnin": {"flag": "bi",
+                           "action": "store",
+                           "type": int,
+                           "metavar": "<int>",
+                           "help": "Used with -ct, skip this many trees from the start of the sample. Trees are "
+                                   "streamed instead of being loaded all at once"},
+                "compact": {"flag": "cmp",
+                            "action": "store_true",
+                            "help": "Read Newick trees into a compact array based form. Much faster for very large "
+                                    "trees with -nt, -li, -ri, -hi, and -pt"},
+                "in_format": {"flag": "f",
                               "action": "store",
                               "metavar": "<format>",
                               "help": "If PhyloBuddy can't guess the file format, try specifying it directly"},
@@ -1183,16 +1894,35 @@ pb_modifiers = {"in_format": {"flag": "f",
                               "action": "store",
                               "metavar": "path",
                               "help": "Save temporary files, if any; default to current working directory"},
+                "out_dir": {"flag": "od",
+                            "action": "store",
+                            "metavar": "<path>",
+                            "help": "Used with -bt, write the output files into this directory instead. With -gt, "
+                                    "finished trees are kept here so an interrupted run can be resumed"},
                 "out_format": {"flag": "o",
                                "metavar": "<format>",
                                "action": "store",
                                "help": "Choose a specific output format"},
+                "profile": {"flag": "prf",
+                            "action": "store",
+                            "nargs": "?",
+                            "const": True,
+                            "metavar": "pstats file",
+                            "help": "Write json timing and peak memory events for each stage to stderr, and "
+                                    "optionally dump cProfile stats of the tool call to a file. "
+                                    "Also set with BUDDY_TRACE=1 or BUDDY_TRACE=<pstats file>"},
                 "quiet": {"flag": "q",
                           "action": "store_true",
                           "help": "Suppress stderr messages"},
                 "test": {"flag": "t",
                          "action": "store_true",
-                         "help": "Run the function and return any stderr/stdout other than trees"}}
+                         "help": "Run the function and return any stderr/stdout other than trees"},
+                "thin": {"flag": "thn",
+                         "action": "store",
+                         "type": int,
+                         "metavar": "<int>",
+                         "help": "Used with -ct, only use every nth tree. Trees are streamed instead of being loaded "
+                                 "all at once"}}
 
 # ################################################## DATABASEBUDDY ################################################### #
 db_flags = {"guess_database": {"flag": "gd",
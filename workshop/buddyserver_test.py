@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This program is free software in the public domain as stipulated by the Copyright Law
+of the United States of America, chapter 1, subsection 105. You may modify it and/or redistribute it
+without restriction.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+name: buddyserver_test.py
+author: Stephen R. Bond
+email: steve.bond@nih.gov
+institute: Computational and Statistical Genomics Branch, Division of Intramural Research,
+           National Human Genome Research Institute, National Institutes of Health
+           Bethesda, MD
+repository: https://github.com/biologyguy/BuddySuite
+© license: None, this work is public domain
+
+Description: Collection of PyTest unit tests for the BuddyServer.py module
+"""
+
+import pytest
+import os
+import re
+import sys
+from time import sleep
+from subprocess import Popen, PIPE
+
+sys.path.insert(0, "./")
+import BuddyServer
+import SeqBuddy as Sb
+import MyFuncs
+
+TEMP_DIR = MyFuncs.TempDir()
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SEQ_FILE = "%s/unit_test_resources/Mnemiopsis_cds.fa" % ROOT_DIR
+
+
+def test_run_local(capsys):
+    # No server listening, so the call runs in this process
+    socket_path = "%s/no_server.sock" % TEMP_DIR.path
+    assert not BuddyServer.ping(socket_path)
+    assert BuddyServer.run("sb", [SEQ_FILE, "-uc"], socket_path) == 0
+    out, err = capsys.readouterr()
+    assert out == "%s\n" % str(Sb.uppercase(Sb.SeqBuddy(SEQ_FILE))).rstrip()
+
+    with pytest.raises(ValueError):
+        BuddyServer.run("FooBuddy", [SEQ_FILE, "-uc"], socket_path)
+
+
+def test_serve():
+    socket_path = "%s/server.sock" % TEMP_DIR.path
+    server = Popen([sys.executable, "BuddyServer.py", "serve", "-s", socket_path], cwd=ROOT_DIR, stderr=PIPE)
+    try:
+        for _ in range(100):
+            if BuddyServer.ping(socket_path):
+                break
+            sleep(0.1)
+        assert BuddyServer.ping(socket_path)
+
+        client = Popen([sys.executable, "BuddyServer.py", "SeqBuddy", "-uc"], cwd=ROOT_DIR, stdin=PIPE, stdout=PIPE,
+                       env=dict(os.environ, BUDDYSUITE_SOCKET=socket_path))
+        with open(SEQ_FILE, "r") as ifile:
+            out = client.communicate(ifile.read().encode())[0].decode()
+        assert out == "%s\n" % str(Sb.uppercase(Sb.SeqBuddy(SEQ_FILE))).rstrip()
+        assert BuddyServer.ping(socket_path)
+
+        assert BuddyServer.stop(socket_path)
+        server.wait(timeout=10)
+        assert not os.path.exists(socket_path)
+
+        # The request was handed to a server worker, not run in the client
+        log = server.stderr.read().decode()
+        assert "BuddySuite server listening on %s" % socket_path in log
+        assert re.search("Worker [0-9]+: SeqBuddy -uc\n", log)
+    finally:
+        if server.poll() is None:
+            server.kill()
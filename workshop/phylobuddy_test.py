@@ -31,6 +31,7 @@ from copy import deepcopy
 from collections import OrderedDict
 from unittest import mock
 import ete3
+from dendropy.calculate import treecompare
 
 sys.path.insert(0, "./")
 import buddy_resources as br
@@ -277,6 +278,49 @@ def test_phylobuddy_edges():
     tester.trees = []
     assert str(tester) == "Error: No trees in object.\n"
 
+def test_lazy_trees():
+    temp_file = MyFuncs.TempFile()
+    for tree_file in ["multi_tree.newick", "multi_tree.nex"]:
+        tester = Pb.PhyloBuddy(resource(tree_file), lazy=True)
+        assert isinstance(tester.trees, Pb.TreeStream)
+        eager = Pb.PhyloBuddy(resource(tree_file))
+        assert Pb.num_taxa(tester, split=True) == Pb.num_taxa(eager, split=True)
+
+        # Tools are queued up and only applied while the trees are being written
+        Pb.unroot(Pb.rename(tester, "[abc]", "X"))
+        Pb.unroot(Pb.rename(eager, "[abc]", "X"))
+        assert str(tester) == str(eager)
+        tester.write(temp_file.path)
+        with open(temp_file.path, "r") as ifile:
+            assert ifile.read() == str(eager)
+
+    with pytest.raises(TypeError):
+        Pb.PhyloBuddy("(A,B);", lazy=True)
+
+
+def test_compact_trees():
+    tester = Pb.PhyloBuddy(resource("multi_tree.newick"), compact=True)
+    eager = Pb.PhyloBuddy(resource("multi_tree.newick"))
+    assert len(tester.compact_trees) == 4
+    assert Pb.num_taxa(tester, split=True) == Pb.num_taxa(eager, split=True)
+    assert Pb.list_ids(tester) == Pb.list_ids(eager)
+
+    Pb.prune_taxa(Pb.rename(tester, "[abc]", "X"), "penSH")
+    Pb.prune_taxa(Pb.rename(eager, "[abc]", "X"), "penSH")
+    assert tester.compact_trees is not None
+    assert Pb.list_ids(tester) == Pb.list_ids(eager)
+
+    # The native writer output can be read straight back in
+    assert str(Pb.PhyloBuddy(str(tester), compact=True)) == str(tester)
+
+    # Anything else converts to dendropy the first time .trees is used
+    assert str(Pb.unroot(tester)) == str(Pb.unroot(eager))
+    assert tester.compact_trees is None
+
+    with pytest.raises(br.GuessError):
+        Pb.PhyloBuddy("((A,B),C;", "newick", compact=True)
+
+
 pb_objects = [Pb.PhyloBuddy(resource(x)) for x in phylo_files]
 
 # ################################################# HELPER FUNCTIONS ################################################# #
@@ -347,6 +391,25 @@ def test_consensus_tree_95(phylobuddy, next_hash):
     assert phylo_to_hash(tester) == next_hash
 
 
+def test_consensus_tree_stream():
+    temp_file = MyFuncs.TempFile()
+    tester = Pb.consensus_tree_stream(resource(phylo_files[0]), split_table=temp_file.path)
+    consensus = Pb.consensus_tree(Pb.make_copy(pb_objects[0]))
+    splits = Pb._tree_splits([tester.trees[0], consensus.trees[0]])
+    assert set([mask for mask, length in splits[0]]) == set([mask for mask, length in splits[1]])
+    with open(temp_file.path, "r") as ifile:
+        assert ifile.readline() == "split\tcount\tfrequency\tmean_length\n"
+
+    # Burn-in and thinning only count a subset of the trees
+    num_trees = len(pb_objects[0].trees)
+    taxon_bits, split_counts, counted = Pb.split_frequencies(Pb._yield_trees(resource(phylo_files[0])), 1, 2)
+    assert counted == len(range(1, num_trees, 2))
+    assert max([count for count, length_sum in split_counts.values()]) == counted
+
+    with pytest.raises(ValueError):
+        Pb.consensus_tree_stream(resource(phylo_files[0]), burnin=num_trees)
+
+
 # ###################### 'dt', '--display_trees' ###################### #
 def test_display_trees(monkeypatch):
     show = mock.Mock(return_value=True)
@@ -363,7 +426,7 @@ def test_display_trees_error():
 
 
 # ###################### 'dis', '--distance' ###################### #
-hashes = ['e39a8aadaec77680ad0d9004bab824ea', '3c49c6a7f06244c0b5d45812f6791519', '7df609f2e6ee613d3bf3c3d2aae26ad4']
+hashes = ['3c49c6a7f06244c0b5d45812f6791519', 'df0d56fe8bdc120a9898cbdf186182f6', '3c49c6a7f06244c0b5d45812f6791519']
 hashes = [(Pb.make_copy(pb_objects[x]), next_hash) for x, next_hash in enumerate(hashes)]
 
 
@@ -372,7 +435,7 @@ def test_distance_wrf(phylobuddy, next_hash):
     tester = str(Pb.distance(phylobuddy, method='wrf'))
     assert md5(tester.encode()).hexdigest() == next_hash
 
-hashes = ['c15d06fc5344da3149e19b134ca31c62', '6d087b86aa9f5bc5013113972173fe0f', '7ef096e3c32dbf898d4b1a035d5c9ad4']
+hashes = ['6d087b86aa9f5bc5013113972173fe0f', 'ec0b22eb92836fc0666ce89e89c17336', '6d087b86aa9f5bc5013113972173fe0f']
 hashes = [(Pb.make_copy(pb_objects[x]), next_hash) for x, next_hash in enumerate(hashes)]
 
 
@@ -381,7 +444,7 @@ def test_distance_uwrf(phylobuddy, next_hash):
     tester = str(Pb.distance(phylobuddy, method='uwrf'))
     assert md5(tester.encode()).hexdigest() == next_hash
 
-hashes = ['68942718c8baf4e4bdf5dd2992fbbf9d', '3dba6b10fdd04505b4e4482d926b67d3', '8d0b3a035015d62916b525f371684bf8']
+hashes = ['3dba6b10fdd04505b4e4482d926b67d3', 'a36937f19d7398dabe4309046506f1fe', '3dba6b10fdd04505b4e4482d926b67d3']
 hashes = [(Pb.make_copy(pb_objects[x]), next_hash) for x, next_hash in enumerate(hashes)]
 
 
@@ -396,6 +459,30 @@ def test_distance_unknown_method():
         Pb.distance(Pb.make_copy(pb_objects[0]), method='foo')
 
 
+def test_distance_reference_and_matrix(monkeypatch):
+    tester = Pb.make_copy(pb_objects[0])
+    output = Pb.distance(tester, method='uwrf')
+    keys, matrix = Pb.distance_matrix(tester, method='uwrf')
+    assert keys == list(output.keys())
+    for indx1, key1 in enumerate(keys):
+        assert matrix[indx1][indx1] == 0
+        for indx2, key2 in enumerate(keys):
+            if indx1 != indx2:
+                assert matrix[indx1][indx2] == output[key1][key2]
+                assert matrix[indx1][indx2] == treecompare.symmetric_difference(tester.trees[indx1],
+                                                                                tester.trees[indx2])
+
+    reference = Pb.distance(tester, method='wrf', reference=1)
+    assert list(reference.keys()) == [keys[1]]
+    assert reference[keys[1]] == Pb.distance(tester, method='wrf')[keys[1]]
+    with pytest.raises(ValueError):
+        Pb.distance(tester, reference="foo")
+
+    # Same result when the pairs are spread over several processes
+    monkeypatch.setattr(Pb, "DISTANCE_PARALLEL_SIZE", 1)
+    assert Pb.distance(tester, method='ed', max_processes=2) == Pb.distance(tester, method='ed', max_processes=1)
+
+
 # ######################  'gt', '--generate_trees' ###################### #
 # Hashes are for RAxML version 8.2.3
 @pytest.mark.generate_trees
@@ -464,6 +551,28 @@ def test_fasttree_multi_param():
     assert phylo_to_hash(tester) == '0877f4e8f46c3f77390dbf962d24ff71'
 
 
+@pytest.mark.generate_trees
+def test_generate_tree_batch(monkeypatch):
+    temp_dir = MyFuncs.TempDir()
+    alignbuddy = Alb.AlignBuddy(resource("Alignments_cds.phyr"))
+    tester, report = Pb.generate_tree_batch(Alb.make_copy(alignbuddy), 'fasttree', '-seed 12345', bootstraps=1,
+                                            max_processes=2, resume_dir="%s/resume" % temp_dir.path, quiet=True)
+    assert [x[1] for x in report] == ["ok"] * len(alignbuddy.alignments) * 2
+    assert len(tester.trees) == len(alignbuddy.alignments) * 2
+    serial = Pb.generate_tree(Alb.AlignBuddy([alignbuddy.alignments[0]]), 'fasttree', '-seed 12345', quiet=True)
+    assert tester.trees[0].as_string(schema="newick") == serial.trees[0].as_string(schema="newick")
+
+    # Finished trees are picked up from the resume directory instead of being rebuilt
+    monkeypatch.setattr(Pb, "generate_tree", lambda *args, **kwargs: 1 / 0)
+    resumed, report = Pb.generate_tree_batch(Alb.make_copy(alignbuddy), 'fasttree', '-seed 12345', bootstraps=1,
+                                             resume_dir="%s/resume" % temp_dir.path, quiet=True)
+    assert str(resumed) == str(tester)
+
+    with pytest.raises(ValueError):
+        Pb.generate_tree_batch(Alb.make_copy(alignbuddy), 'fasttree', '-seed 54321',
+                               resume_dir="%s/resume" % temp_dir.path)
+
+
 def test_generate_trees_edge_cases():
     temp_file = MyFuncs.TempFile()
     tester = Alb.AlignBuddy(resource("Mnemiopsis_cds.nex"))
@@ -544,6 +653,18 @@ def test_prune_taxa(phylobuddy, next_hash):
     assert phylo_to_hash(phylobuddy) == next_hash
 
 
+def test_prune_taxa_patterns():
+    # Patterns are combined into one search, except those that can't be joined safely
+    tester = Pb.prune_taxa(Pb.make_copy(pb_objects[0]), "fir", "(?i)OVI", r"pen(S)H3\1?0")
+    expect = Pb.make_copy(pb_objects[0])
+    for pattern in ["fir", "(?i)OVI", r"pen(S)H3\1?0"]:
+        Pb.prune_taxa(expect, pattern)
+    assert str(tester) == str(expect)
+
+    compact = Pb.prune_taxa(Pb.PhyloBuddy(resource("multi_tree.newick"), compact=True), "fir", "(?i)OVI")
+    assert Pb.list_ids(compact) == Pb.list_ids(Pb.prune_taxa(Pb.make_copy(pb_objects[0]), "fir", "ovi"))
+
+
 # ######################  'ri', '--rename_ids' ###################### #
 hashes = ['6843a620b725a3a0e0940d4352f2036f', '543d2fc90ca1f391312d6b8fe896c59c', '6ce146e635c20ad62e21a1ed6fddbd3a',
           '4dfed97b2a23b8957ee5141bf4681fe4', '77d00fdc512fa09bd1146037d25eafa0', '9b1014be1b38d27f6b7ef73d17003dae']
@@ -709,17 +830,17 @@ def test_distance_ui(capsys):
     test_in_args.distance = [False]
     Pb.command_line_ui(test_in_args, Pb.make_copy(pb_objects[0]), skip_exit=True)
     out, err = capsys.readouterr()
-    assert string2hash(out) == "7a9f9902ef30ca3d7ac97b63cfdd0b2e"
+    assert string2hash(out) == "66df36fa117e4c4660f04e2649c3fa6b"
 
     test_in_args.distance = ["uwrf"]
     Pb.command_line_ui(test_in_args, Pb.make_copy(pb_objects[0]), skip_exit=True)
     out, err = capsys.readouterr()
-    assert string2hash(out) == "6e520f6911aabdf91dfd075d1545bc1e"
+    assert string2hash(out) == "9dd162b4cc4fa28f402e6f31ef2fb349"
 
     test_in_args.distance = ["ed"]
     Pb.command_line_ui(test_in_args, Pb.make_copy(pb_objects[0]), skip_exit=True)
     out, err = capsys.readouterr()
-    assert string2hash(out) == "f0acdd9c751bce77fe14355cc77b69cc"
+    assert string2hash(out) == "a49e54a6c14ab4dbbf73d3f7d1d6aa82"
 
 
 # ###################### 'gt', '--generate_tree' ###################### #
@@ -32,7 +32,9 @@ import argparse
 import io
 from copy import deepcopy
 from collections import OrderedDict
+from array import array
 from unittest import mock
+from subprocess import Popen, PIPE
 
 from Bio.SeqFeature import FeatureLocation, CompoundLocation
 from Bio.Alphabet import IUPAC
@@ -336,6 +338,14 @@ def test_guesserror_in_handle():
             Sb.SeqBuddy(ifile)
 
 
+def test_lazy_imports():
+    # Heavy modules are only imported by the tools that need them, so they should not load with SeqBuddy itself
+    heavy = ["Bio.Restriction", "Bio.SeqUtils.ProtParam"]
+    check = "import sys, SeqBuddy; print([x for x in %s if x in sys.modules])" % str(heavy)
+    output = Popen([sys.executable, "-c", check], stdout=PIPE, cwd=os.path.dirname(os.path.abspath(Sb.__file__)))
+    assert output.communicate()[0].decode().strip() == "[]"
+
+
 def test_no__input():
     with pytest.raises(TypeError):
         # noinspection PyArgumentList
@@ -347,6 +357,21 @@ def test_make_copy():
     assert seqs_to_hash(Sb.make_copy(sb_objects[0])) == seqs_to_hash(sb_objects[0])
 
 
+# ######################  'estimate_resources' ###################### #
+def test_estimate_resources(monkeypatch):
+    seqbuddy = Sb.SeqBuddy(resource("Mnemiopsis_cds.gb"))
+    estimate = Sb.estimate_resources(resource("Mnemiopsis_cds.gb"), "translate6frames")
+    assert estimate["records"] == len(seqbuddy.records)
+    assert estimate["features"] == sum([len(rec.features) for rec in seqbuddy.records])
+    assert estimate["memory_mb"] > Sb.estimate_resources(resource("Mnemiopsis_cds.gb"), "uppercase")["memory_mb"]
+    assert estimate["memory_mb"] > Sb.estimate_resources(resource("Mnemiopsis_cds.gb"), "num_seqs")["memory_mb"]
+
+    # Only part of the file is parsed, and the counts are scaled up to the full file size
+    monkeypatch.setattr(Sb, "ESTIMATE_SAMPLE_SIZE", 2000)
+    sampled = Sb.estimate_resources(resource("Mnemiopsis_cds.fa"), "translate6frames")
+    assert 0.5 * len(sb_objects[0].records) < sampled["records"] < 2 * len(sb_objects[0].records)
+
+
 # ######################  '_check_for_blast_bin' ###################### #
 @pytest.mark.internet
 @pytest.mark.slow
@@ -1090,6 +1115,19 @@ def test_hash_seq_ids_errors():
     assert "Insufficient number of hashes available to cover all sequences." in str(e.value)
 
 
+def test_hash_seq_ids_restore():
+    tester = Sb.make_copy(sb_objects[0])
+    Sb.hash_ids(tester)
+    br.rename_records_from_map(tester.records, tester.hash_map)
+    assert seqs_to_hash(tester) == seqs_to_hash(sb_objects[0])
+
+    hash_map = OrderedDict([("Mle", "Foo"), ("Mle-Panx", "Bar")])
+    assert br.rename_from_map("Mle-Panxα1 Mle", hash_map) == "Barα1 Foo"
+    assert br.rename_from_map("Mle", hash_map) == "Foo"
+    assert br.rename_from_map("Mle", {}) == "Mle"
+    assert br.map_regex({}) is None
+
+
 # ##################### '-is', 'insert_seq' ###################### ##
 def test_insert_seqs_start():
     tester = Sb.make_copy(sb_objects[0])
@@ -1325,6 +1363,75 @@ def test_empty_file():
     assert type(tester) == Sb.SeqBuddy
     assert len(tester.records) == 0
 
+
+@pytest.mark.parametrize("key", ["d f", "p f", "d g"])
+def test_seq_index(key):
+    in_file = sb_resources.get_one(key, mode="paths")
+    tmp_file = "%s/%s" % (TEMP_DIR.path, os.path.basename(in_file))
+    with open(in_file, "r") as ifile, open(tmp_file, "w") as ofile:
+        ofile.write(ifile.read())
+    reference = Sb.SeqBuddy(in_file)
+    for _ in range(2):  # Second pass re-uses the .sbi file written by the first
+        tester = Sb.SeqBuddy(tmp_file, index=True)
+        assert os.path.isfile("%s.sbi" % tmp_file)
+        assert tester.index_only()
+        assert Sb.num_seqs(tester) == Sb.num_seqs(reference)
+        assert Sb.ave_seq_length(tester) == Sb.ave_seq_length(reference)
+        assert tester.index_only()
+        assert str(Sb.pull_recs(Sb.make_copy(tester), "α[1-5]")) == \
+            str(Sb.pull_recs(Sb.make_copy(reference), "α[1-5]"))
+        assert str(Sb.delete_records(Sb.make_copy(tester), "α[1-5]")) == \
+            str(Sb.delete_records(Sb.make_copy(reference), "α[1-5]"))
+        assert str(Sb.extract_regions(Sb.make_copy(tester), "10:50")) == \
+            str(Sb.extract_regions(Sb.make_copy(reference), "10:50"))
+    os.remove(tmp_file)
+    os.remove("%s.sbi" % tmp_file)
+
+
+@pytest.mark.parametrize("key", ["d f", "d g", "r f"])
+def test_pack(key):
+    reference = sb_resources.get_one(key)
+    tester = Sb.make_copy(reference).pack()
+    assert tester.packed_only()
+    assert Sb.num_seqs(tester) == Sb.num_seqs(reference)
+    assert Sb.ave_seq_length(tester) == Sb.ave_seq_length(reference)
+    assert str(Sb.make_copy(tester)) == str(reference)
+    assert str(Sb.complement(Sb.make_copy(tester))) == str(Sb.complement(Sb.make_copy(reference)))
+    assert str(Sb.reverse_complement(tester)) == str(Sb.reverse_complement(Sb.make_copy(reference)))
+    assert not tester.packed_only()
+
+    with pytest.raises(TypeError):
+        sb_resources.get_one("p f").pack()
+
+
+@pytest.mark.parametrize("key", ["d f", "p f"])
+def test_parse_parallel(key, monkeypatch):
+    in_file = sb_resources.get_one(key, mode="paths")
+    reference = sb_resources.get_one(key)
+    records = Sb._parse_parallel(in_file, "fasta", max_processes=3)
+    assert [(rec.id, rec.description, str(rec.seq)) for rec in records] == \
+        [(rec.id, rec.description, str(rec.seq)) for rec in reference.records]
+
+    monkeypatch.setattr(Sb, "PARALLEL_PARSE_SIZE", 0)
+    assert str(Sb.SeqBuddy(in_file)) == str(reference)
+    with open(in_file, "r") as ifile:
+        assert str(Sb.SeqBuddy(ifile)) == str(reference)
+    with open(in_file, "r") as ifile:
+        assert str(Sb.SeqBuddy(ifile.read())) == str(reference)
+    assert Sb._chunk_file(resource("Mnemiopsis_cds.gb"), "fastq", 3) is None
+
+
+def test_packed_seq():
+    packed = Sb.PackedSeq("acGTNNNCGgRta")
+    assert len(packed.packed) == 4
+    assert packed.unpack() == "acGTNNNCGgRta"
+    assert packed.reverse_complement().unpack() == "taYcCGNNNACgt"
+    assert packed.complement().unpack() == "tgCANNNGCcYat"
+    assert round(packed.gc_content(), 2) == 38.46
+    assert packed.kmer_counts(2) == {"AC": 1, "CG": 2, "GT": 1, "GG": 1, "TA": 1}
+    with pytest.raises(ValueError):
+        packed.kmer_counts(0)
+
 # ######################  '-ofa', '--order_features_alphabetically' ###################### #
 fwd_hashes = ["b831e901d8b6b1ba52bad797bad92d14", "21547b4b35e49fa37e5c5b858808befb",
               "cb1169c2dd357771a97a02ae2160935d", "503e23720beea201f8fadf5dabda75e4",
@@ -1427,6 +1534,27 @@ def test_order_ids_randomly2():
     assert seqs_to_hash(tester) == seqs_to_hash(Sb.order_ids_randomly(tester))
 
 
+# ######################  '-pl', '--pipeline' ###################### #
+def test_pipeline():
+    tester = Sb.Pipeline("clean_seq; uppercase; delete_small 1285").run(Sb.make_copy(sb_objects[0]))
+    expected = Sb.delete_small(Sb.uppercase(Sb.clean_seq(Sb.make_copy(sb_objects[0]))), 1285)
+    assert seqs_to_hash(tester) == seqs_to_hash(expected)
+
+    pipeline = Sb.Pipeline("-uc; ri Panx Foo 2").add_step("ns")
+    assert str(pipeline) == "uppercase; rename_ids Panx Foo 2; num_seqs"
+    assert len(pipeline) == 3
+    assert pipeline.run(Sb.make_copy(sb_objects[0])) == 13
+
+    with pytest.raises(AttributeError):
+        Sb.Pipeline("foo")
+    with pytest.raises(AttributeError):
+        Sb.Pipeline("_print_recs")
+    with pytest.raises(ValueError):
+        Sb.Pipeline("delete_small x")
+    with pytest.raises(TypeError):
+        Sb.Pipeline("num_seqs; uppercase").run(Sb.make_copy(sb_objects[0]))
+
+
 # #####################  '-prr', '--pull_random_recs' ###################### ##
 @pytest.mark.parametrize("seqbuddy", sb_objects)
 def test_pull_random_recs(seqbuddy):
@@ -1516,6 +1644,19 @@ def test_rename_ids2():
     assert "There are more replacement match" in str(e)
 
 
+def test_rename_ids_replacer():
+    replacer = br.Replacer("Panx", "Test")
+    assert replacer.literal
+    assert replacer.sub("Mle-Panxα1_Panx") == "Mle-Testα1_Test"
+
+    assert br.Replacer("aa", "?", -1).sub("aaa") == "a?"
+    assert br.Replacer("a{2}", "?", -1).sub("aaa") == "a?"
+    assert br.Replacer("a{2}", "?", -2).sub("aaaaa") == "a??"
+    assert br.Replacer("([a-z])([0-9])", "\\2\\1", -1).sub("a1b2c3") == "a1b23c"
+    assert br.Replacer("[0-9]", "#", 2).sub("a1b2c3") == "a#b#c3"
+    assert br.Replacer("x", "#", -2).sub("a1b2c3") == "a1b2c3"
+
+
 # ##################### '-rs', 'replace_subseq' ###################### ##
 def test_replace_subsequence():
     tester = Sb.make_copy(sb_objects[0])
@@ -1540,6 +1681,58 @@ def test_reverse_complement_pep_exception():  # Asserts that a TypeError will be
         Sb.reverse_complement(sb_objects[6])
     assert str(e.value) == "SeqBuddy object is protein. Nucleic acid sequences required."
 
+
+# ######################  FASTQ quality tools ###################### #
+fastq_reads = "@read1 first\nACGTACGTAC\n+\nIIIIIIII##\n@read2\nTTGCA\n+\n#####\n@read3\nGGCCAAT\n+\nIIII5##\n"
+
+
+def test_fastq_array_qualities():
+    tester = Sb.SeqBuddy(fastq_reads, in_format="fastq")
+    scores = tester.records[0].letter_annotations["phred_quality"]
+    assert type(scores) == array and list(scores) == [40] * 8 + [2, 2]
+    assert tester.records[0].description == "read1 first"
+
+    tester = Sb.reverse_complement(tester)
+    assert str(tester.records[2].seq) == "ATTGGCC"
+    assert list(tester.records[2].letter_annotations["phred_quality"]) == [2, 2, 20, 40, 40, 40, 40]
+    tester = Sb.pull_record_ends(tester, 3)
+    assert list(tester.records[2].letter_annotations["phred_quality"]) == [2, 2, 20]
+    tester = Sb.extract_regions(Sb.SeqBuddy(fastq_reads, in_format="fastq"), "2:4")
+    assert list(tester.records[0].letter_annotations["phred_quality"]) == [40, 40, 40]
+    assert "@read1 first\nCGT\n+\nIII\n" in str(tester)
+
+    with pytest.raises(ValueError):
+        Sb.SeqBuddy("@read1\nACGT\n+\nII I\n", in_format="fastq")
+
+    tester = Sb.SeqBuddy("@\nACGT\n+\nIIII\n", in_format="fastq")
+    assert tester.records[0].id == "" and tester.records[0].description == ""
+    assert list(tester.records[0].letter_annotations["phred_quality"]) == [40] * 4
+
+
+def test_fastq_quality_tools():
+    tester = Sb.delete_low_quality(Sb.SeqBuddy(fastq_reads, in_format="fastq"), 20)
+    assert [rec.id for rec in tester.records] == ["read1", "read3"]
+
+    tester = Sb.trim_quality(Sb.SeqBuddy(fastq_reads, in_format="fastq"), 20, 2)
+    assert [str(rec.seq) for rec in tester.records] == ["ACGTACGT", "", "GGCCA"]
+
+    summary = Sb.quality_summary(Sb.SeqBuddy(fastq_reads, in_format="fastq"))
+    assert summary[1] == [(40 + 2 + 40) / 3, 2, 40, 3]
+    assert summary[10] == [2, 2, 2, 1]
+
+    tester = Sb.convert_quality(Sb.SeqBuddy(fastq_reads, in_format="fastq"), "illumina")
+    assert tester.out_format == "fastq-illumina"
+    assert "@read1 first\nACGTACGTAC\n+\nhhhhhhhhBB\n" in str(tester)
+    tester = Sb.convert_quality(tester, "solexa")
+    assert list(tester.records[1].letter_annotations["solexa_quality"]) == [-2] * 5
+    tester = Sb.convert_quality(tester, "sanger")
+    assert str(tester) == str(Sb.SeqBuddy(fastq_reads, in_format="fastq"))
+
+    with pytest.raises(TypeError):
+        Sb.quality_summary(Sb.make_copy(sb_objects[0]))
+    with pytest.raises(ValueError):
+        Sb.convert_quality(Sb.SeqBuddy(fastq_reads, in_format="fastq"), "foo")
+
 # ######################  '-sfr', '--select_frame' ###################### #
 hashes = [(0, 1, "b831e901d8b6b1ba52bad797bad92d14"), (0, 2, "2de033b2bf2327f2795fe425db0bd78f"),
           (0, 3, "1c29898d4964e0d1b03207d7e67e1958"), (1, 1, "908744b00d9f3392a64b4b18f0db9fee"),
@@ -1675,6 +1868,67 @@ def test_translate_edges_and_exceptions(capsys):
 
 
 # ################################################# COMMAND LINE UI ################################################## #
+# ######################  '-bt', '--batch' ###################### #
+def test_batch_ui(capsys):
+    batch_dir = TEMP_DIR.subdir("batch")
+    for file_name in ["Mnemiopsis_cds.fa", "Mnemiopsis_cds.gb", "gibberish.fa"]:
+        with open(resource(file_name), "r") as ifile, open("%s/%s" % (batch_dir, file_name), "w") as ofile:
+            ofile.write(ifile.read())
+
+    test_in_args = deepcopy(in_args)
+    test_in_args.batch = True
+    test_in_args.quiet = True
+    test_in_args.uppercase = True
+    test_in_args.sequence = ["%s/*.*" % batch_dir]
+    test_in_args.out_dir = "%s/out" % batch_dir
+    Sb.command_line_ui(test_in_args, [], True)
+    out, err = capsys.readouterr()
+    report = [line.split("\t") for line in out.strip().split("\n")]
+    assert [os.path.basename(x[0]) for x in report] == ["Mnemiopsis_cds.fa", "Mnemiopsis_cds.gb", "gibberish.fa"]
+    assert [x[1] for x in report] == ["ok", "ok", "failed"]
+    assert "GuessError" in report[2][3]
+    for file_name in ["Mnemiopsis_cds.fa", "Mnemiopsis_cds.gb"]:
+        with open("%s/out/%s" % (batch_dir, file_name), "r") as ifile:
+            assert ifile.read() == "%s\n" % str(Sb.uppercase(Sb.SeqBuddy(resource(file_name)))).rstrip()
+
+    test_in_args.sequence = ["%s/*.foo" % batch_dir]
+    test_in_args.quiet = False  # Errors are silenced by -q, like everywhere else
+    Sb.command_line_ui(test_in_args, [], True)
+    out, err = capsys.readouterr()
+    assert "No files found matching" in err
+
+    # Errors raised by the command itself fail the file, even with -q
+    with open(resource("Mnemiopsis_pep.fa"), "r") as ifile, open("%s/Mnemiopsis_pep.fa" % batch_dir, "w") as ofile:
+        ofile.write(ifile.read())
+    test_in_args.quiet = True
+    test_in_args.uppercase = False
+    test_in_args.translate = True
+    test_in_args.sequence = ["%s/Mnemiopsis_cds.fa" % batch_dir, "%s/Mnemiopsis_pep.fa" % batch_dir]
+    Sb.command_line_ui(test_in_args, [], True)
+    out, err = capsys.readouterr()
+    report = [line.split("\t") for line in out.strip().split("\n")]
+    assert [x[1] for x in report] == ["ok", "failed"]
+    assert "TypeError: Nucleic acid sequence required, not protein." in report[1][3]
+    assert err == ""
+
+    # Outputs are never allowed to replace an input file, or each other
+    test_in_args.quiet = False
+    test_in_args.out_dir = batch_dir
+    Sb.command_line_ui(test_in_args, [], True)
+    out, err = capsys.readouterr()
+    assert "would overwrite an input file" in err
+    assert out == ""
+
+    other_dir = TEMP_DIR.subdir("batch_other")
+    with open(resource("Mnemiopsis_cds.fa"), "r") as ifile, open("%s/Mnemiopsis_cds.fa" % other_dir, "w") as ofile:
+        ofile.write(ifile.read())
+    test_in_args.out_dir = "%s/out" % batch_dir
+    test_in_args.sequence = ["%s/Mnemiopsis_cds.fa" % batch_dir, "%s/Mnemiopsis_cds.fa" % other_dir]
+    Sb.command_line_ui(test_in_args, [], True)
+    out, err = capsys.readouterr()
+    assert "More than one input file would be written to" in err
+
+
 # ##################### '-ano', '--annotate' ###################### ##
 def test_annotate_ui(capsys):
     test_in_args = deepcopy(in_args)
@@ -2454,6 +2708,21 @@ def test_order_ids_randomly_ui(capsys):
     assert seqs_to_hash(tester) == seqs_to_hash(Sb.order_ids(Sb.make_copy(sb_objects[0])))
 
 
+# ######################  '-pl', '--pipeline' ###################### #
+def test_pipeline_ui(capsys):
+    test_in_args = deepcopy(in_args)
+    test_in_args.pipeline = "uppercase; delete_small 1285"
+    Sb.command_line_ui(test_in_args, Sb.make_copy(sb_objects[0]), True)
+    out, err = capsys.readouterr()
+    assert string2hash(out) == seqs_to_hash(Sb.delete_small(Sb.uppercase(Sb.make_copy(sb_objects[0])), 1285))
+
+    test_in_args.pipeline = "uppercase; foo"
+    with pytest.raises(SystemExit):
+        Sb.command_line_ui(test_in_args, Sb.make_copy(sb_objects[0]))
+    out, err = capsys.readouterr()
+    assert "Unknown SeqBuddy tool 'foo'." in err
+
+
 # ######################  '-prr', '--pull_random_recs' ###################### #
 def test_pull_random_recs_ui(capsys):
     test_in_args = deepcopy(in_args)